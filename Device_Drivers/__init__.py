@@ -1,3 +1,7 @@
 from .lockin_driver import UHFLI
 from .move_stage_driver import NewPort_Delay_Stage_225
-from .stellarnet_driverLibs import stellarnet_driver3
+try:
+    from .stellarnet_driverLibs import stellarnet_driver3
+except (ImportError, OSError):
+    stellarnet_driver3 = None   # no build of the StellarNet driver for this platform/Python, use simulators.FakeStellarNet
+from .fly_scan import fly_scan
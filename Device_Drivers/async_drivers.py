@@ -0,0 +1,149 @@
+import asyncio
+from .instrument_worker import InstrumentWorker
+from .spectrum_acquisition import read_burst, spectrum_counts
+
+"""
+Asyncio Driver API
+Async versions of the drivers, so one asyncio program can run several instruments, a UI and a data writer together
+without threads or sleeps of its own:
+
+    stage = AsyncStage(NewPort_Delay_Stage_225())
+    lockin = AsyncLockin(UHFLI())
+    spec = await AsyncSpectrometer.open(stellarnet_driver3, channel=0)
+    await stage.move_to(150.0)
+    record, spectrum = await asyncio.gather(lockin.read_boxcars(), spec.read())
+
+Every blocking serial / zhinst / USB call runs on the instrument's own worker thread (see instrument_worker.py),
+so the event loop never waits on hardware and calls to one instrument still happen one at a time, in order.
+The wrapped driver objects can be the real ones or the simulators (FakeDAQServer, FakeDL225, FakeStellarNet).
+
+step_scan is the async scan loop: move, then read every instrument at the same time, at each position.
+
+"""
+class AsyncInstrument:
+    # This is the constructor for the async wrapper, it starts the worker thread that owns the instrument.
+    def __init__(self, instrument, name="instrument"):
+        self.instrument = instrument
+        self.worker = InstrumentWorker(instrument, name)
+
+    # This function runs an instrument method (by name) or any callable on the worker thread and waits for it without blocking the loop.
+    async def call(self, method, *args, **kwargs):
+        return await asyncio.wrap_future(self.worker.submit(method, *args, **kwargs))
+
+    # This function stops the worker thread (the instrument itself is closed by the subclasses' close()).
+    async def stop_worker(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.worker.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.stop_worker()
+
+
+class AsyncStage(AsyncInstrument):
+    # stage is a NewPort_Delay_Stage_225
+    def __init__(self, stage):
+        super().__init__(stage, "stage")
+
+    async def move_to(self, pos, tolerance=None, timeout=None, settle_time=0.0):
+        return await self.call("move_to", pos, tolerance, timeout, settle_time)
+
+    async def approach(self, pos, direction, backlash):
+        return await self.call("approach", pos, direction, backlash)
+
+    async def get_position(self):
+        return await self.call("get_position")
+
+    async def get_status(self):
+        return await self.call("get_status")
+
+    async def set_velocity(self, velocity):
+        return await self.call("set_velocity", velocity)
+
+    async def home_stage(self):
+        return await self.call("home_stage")
+
+    # Pure calculations, no I/O, so these answer right away.
+    def predict_move_time(self, distance, velocity=None, acceleration=None, tolerance=None):
+        return self.instrument.predict_move_time(distance, velocity, acceleration, tolerance)
+
+    def predict_scan_time(self, positions):
+        return self.instrument.predict_scan_time(positions)
+
+    async def close(self):
+        await self.call("close")
+        await self.stop_worker()
+
+
+class AsyncLockin(AsyncInstrument):
+    # lockin is a UHFLI
+    def __init__(self, lockin):
+        super().__init__(lockin, "lockin")
+
+    async def read_boxcars(self, channels=(0, 1), demods=()):
+        return await self.call("read_boxcars", channels, demods)
+
+    async def read_boxcar_voltage(self, channel):
+        return await self.call("read_boxcar_voltage", channel)
+
+    async def stream_boxcar_voltage(self, channel, duration=1.0):
+        return await self.call("stream_boxcar_voltage", channel, duration)
+
+    async def measure_boxcar_voltage(self, channel, target_sem=None, max_duration=10.0, min_samples=20, chunk=0.1):
+        return await self.call("measure_boxcar_voltage", channel, target_sem, max_duration, min_samples, chunk)
+
+    async def set_boxcar_baseline(self, channel, state):
+        return await self.call("set_boxcar_baseline", channel, state)
+
+    async def close(self):
+        await self.call("disconnect")
+        await self.stop_worker()
+
+
+class AsyncSpectrometer(AsyncInstrument):
+    # sn is the stellarnet_driver3 module (or a FakeStellarNet), spec and wav what sn.array_get_spec returned.
+    def __init__(self, sn, spec, wav):
+        super().__init__(sn, "spectrometer")
+        self.spec = spec
+        self.wav = wav
+
+    # This function connects to the spectrometer on `channel` (the connection itself also runs on a worker thread).
+    @classmethod
+    async def open(cls, sn, channel=0):
+        spec, wav = await asyncio.to_thread(sn.array_get_spec, channel)
+        return cls(sn, spec, wav)
+
+    async def set_params(self, integration_time, scans_avg=1, smooth=0, xtiming=3):
+        return await self.call("setParam", self.spec, integration_time, scans_avg, smooth, xtiming, clear=True)
+
+    # This function gives one spectrum (counts per pixel, float32), averaged by the driver's scans_avg.
+    async def read(self):
+        return spectrum_counts(await self.call("array_spectrum", self.spec, self.wav))
+
+    # This function gives `frames` spectra read through the burst FIFO as a (frames x pixels) array (enable_burst first).
+    async def read_burst(self, frames):
+        return await self.call(read_burst, self.instrument, self.spec, frames, len(self.wav))
+
+    async def enable_burst(self):
+        return await self.call("allowBurst", self.spec)
+
+    async def hot_pixels(self):
+        return await self.call("getDeviceHotPixels", self.spec)
+
+    async def close(self):
+        await self.call("reset", self.spec)
+        await self.stop_worker()
+
+
+# This async generator moves the stage to each position and yields (position, measured position, readings),
+# where readings is {name: result} from all the coroutine functions in reads, run at the same time at that position, e.g.
+#     async for pos, actual_pos, readings in step_scan(stage, positions, {"lockin": lockin.read_boxcars, "spectrum": spec.read}):
+async def step_scan(stage, positions, reads):
+    for pos in positions:
+        actual_pos = await stage.move_to(pos)
+        results = await asyncio.gather(*(read() for read in reads.values()))
+        yield pos, actual_pos, dict(zip(reads, results))
@@ -0,0 +1,111 @@
+from .move_stage_driver import MOVING_STATES
+import numpy as np
+import time
+
+"""
+Fly Scan (Continuous Delay Scan)
+The stage sweeps from start to stop at a constant velocity while the UHFLI streams boxcar samples.
+Every boxcar sample is given a stage position by interpolating the timestamped stage positions,
+then the samples are binned onto the requested position grid.
+The sweep starts and ends a run-up distance outside the grid (the distance the stage needs to reach the velocity, plus
+a couple of position readings and half a bin), so every bin is sampled at full speed.
+
+"""
+
+# This function runs a fly scan over `grid` (stage positions in mm, the bin centres) at `velocity` mm/s.
+# Returns {"positions": grid, "counts": samples per bin, "channels": {channel: {"mean": mV, "std": mV}},
+#          "stage": (host times, positions), "samples": {channel: (positions, values)}}
+def fly_scan(lockin, stage, grid, velocity, channels=(0, 1), poll_interval=0.05, timeout=None):
+    grid = np.asarray(grid, dtype=np.float64)
+    direction = 1 if grid[-1] >= grid[0] else -1
+    half_bin = abs(grid[1] - grid[0]) / 2 if len(grid) > 1 else 0.0
+    # speeding up, then two position readings at full speed before the first bin starts
+    run_up = velocity ** 2 / (2 * (stage.acceleration or stage.max_acceleration)) + 2 * velocity * poll_interval + half_bin
+    start, stop = grid[0] - direction * run_up, grid[-1] + direction * run_up
+    if timeout is None:
+        timeout = abs(stop - start) / velocity * 2 + 30
+    restore_velocity = stage.velocity
+
+    at_start = stage.move_to(start)
+    stage_times, stage_positions = [], []
+    chunks = {channel: ([], []) for channel in channels}
+    offsets = []
+    lockin.subscribe_boxcars(channels)
+    try:
+        stage.set_velocity(velocity)
+        # the stage stands still at the start until start_move, samples from before then belong there
+        stage_times.append(time.monotonic())
+        stage_positions.append(at_start)
+        stage.start_move(stop)
+        deadline = time.monotonic() + timeout
+        while True:
+            data = lockin.poll_boxcars(poll_interval, channels)
+            arrived = time.monotonic()
+            for channel, (timestamps, values) in data.items():
+                chunks[channel][0].append(timestamps)
+                chunks[channel][1].append(values)
+                if len(timestamps):
+                    # host time minus device time of the newest sample, the smallest one has the least transfer latency
+                    offsets.append(arrived - timestamps[-1])
+
+            # the position is stamped with the middle of the query round trip
+            sent = time.monotonic()
+            _, state, position = stage.get_status_and_position()
+            stage_times.append((sent + time.monotonic()) / 2)
+            stage_positions.append(position)
+            if state not in MOVING_STATES and len(stage_positions) > 2:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Fly scan did not finish within {timeout} s")
+    finally:
+        lockin.unsubscribe_boxcars(channels)
+        stage.set_velocity(restore_velocity)
+
+    if not offsets:
+        raise RuntimeError("No boxcar samples received during the fly scan")
+    offset = min(offsets)
+    stage_times = np.asarray(stage_times)
+    stage_positions = np.asarray(stage_positions)
+
+    result = {"positions": grid, "channels": {}, "stage": (stage_times, stage_positions), "samples": {}}
+    for channel, (timestamp_chunks, value_chunks) in chunks.items():
+        host_times = np.concatenate(timestamp_chunks) + offset
+        values = np.concatenate(value_chunks)
+        inside = (host_times >= stage_times[0]) & (host_times <= stage_times[-1])
+        sample_positions = np.interp(host_times[inside], stage_times, stage_positions)
+        mean, std, counts = bin_samples(sample_positions, values[inside], grid)
+        result["channels"][channel] = {"mean": mean, "std": std}
+        result["counts"] = counts
+        result["samples"][channel] = (sample_positions, values[inside])
+    return result
+
+
+# This function averages samples into the bins centred on the grid positions (bin edges halfway between neighbours).
+# Returns (mean, std, count) arrays in grid order, empty bins give NaN.
+def bin_samples(sample_positions, values, grid):
+    grid = np.asarray(grid, dtype=np.float64)
+    order = np.argsort(grid)
+    centres = grid[order]
+    edges = (centres[1:] + centres[:-1]) / 2
+    first = centres[0] - (edges[0] - centres[0]) if len(edges) else centres[0] - 0.5
+    last = centres[-1] + (centres[-1] - edges[-1]) if len(edges) else centres[0] + 0.5
+    keep = (sample_positions >= first) & (sample_positions <= last)
+    index = np.searchsorted(edges, sample_positions[keep])
+    values = np.asarray(values, dtype=np.float64)[keep]
+
+    counts = np.bincount(index, minlength=len(centres))
+    sums = np.bincount(index, weights=values, minlength=len(centres))
+    squares = np.bincount(index, weights=values ** 2, minlength=len(centres))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        variance = (squares - counts * mean ** 2) / (counts - 1)
+    std = np.sqrt(np.clip(variance, 0, None))
+
+    # put the results back in the order the grid was given in
+    result_mean = np.empty_like(mean)
+    result_std = np.empty_like(std)
+    result_counts = np.empty_like(counts)
+    result_mean[order] = mean
+    result_std[order] = std
+    result_counts[order] = counts
+    return result_mean, result_std, result_counts
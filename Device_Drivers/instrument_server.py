@@ -0,0 +1,407 @@
+from .instrument_worker import InstrumentWorker
+from .spectrum_acquisition import enable_burst, read_burst, spectrum_counts
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+import argparse
+import contextlib
+import functools
+import numpy as np
+import os
+import secrets
+import threading
+import time
+import uuid
+
+"""
+Instrument Server
+A long-running local process that owns the instruments (UHFLI, DL225 stage, StellarNet spectrometer), so scripts and
+notebooks attach to warm connections in milliseconds instead of importing zhinst, opening the serial port (2 s wait),
+initializing the stage and loading the spectrometer driver every time they start.
+
+Start it once (add --simulate to serve the simulated instruments, see simulators.py):
+
+    python -m Device_Drivers.instrument_server
+
+then attach from any script or notebook on the same PC:
+
+    client = InstrumentClient()
+    stage, lockin = client.instrument("stage"), client.instrument("lockin")
+    stage.move_to(50.0)
+    lockin.read_boxcars((0, 1))
+    with client.lock():             # keep the instruments to yourself for a whole scan
+        ...
+    client.close()                  # detaches, the instruments stay connected in the server
+
+The proxies have the same methods as the drivers (lockinV1.py --attach runs a whole scan through them). Calls go over
+multiprocessing.connection (TCP on localhost, with an authentication key), every instrument has its own worker thread
+in the server (see instrument_worker.py), so calls to one instrument from all clients run one at a time, in order.
+close() / disconnect() on a proxy only detach it, the server closes the instruments when it stops (Ctrl-C).
+Arguments and results must be picklable (numbers, strings, lists, dicts, NumPy arrays), so methods that take callbacks
+(e.g. the stage's find_peak) can't be called remotely. Attributes that aren't methods can be read when they hold plain
+data (e.g. stage.position, stage.velocity), objects such as the stage's serial port stay in the server.
+
+Requests are pickles, and unpickling runs code, so only someone with the key may connect. The key is random per user:
+the server makes it on its first start and keeps it in ~/.instrument_server_key (readable by you only), clients on the
+same account read it from there. The INSTRUMENT_SERVER_KEY environment variable overrides the file. The server only
+listens on localhost, a network address (--address 0.0.0.0:6340) needs the key set explicitly with
+INSTRUMENT_SERVER_KEY on both sides.
+
+InstrumentServer   -> serves a dict of instruments
+InstrumentClient   -> connection to the server, gives a RemoteInstrument proxy per instrument
+SpectrometerHandle -> the StellarNet driver and its device handle as one object with methods, for serving
+
+"""
+
+DEFAULT_ADDRESS = ("localhost", 6340)
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# Where the authentication key is kept (the environment variable wins over the file)
+AUTHKEY_ENV = "INSTRUMENT_SERVER_KEY"
+AUTHKEY_FILE = Path.home() / ".instrument_server_key"
+
+# Methods the server never runs for a client (the proxies detach instead)
+CLOSING_METHODS = ("close", "disconnect", "reset")
+
+
+# This function turns "host:port" (or just a port) into an address tuple.
+def parse_address(text):
+    host, _, port = str(text).rpartition(":")
+    return (host or "localhost", int(port))
+
+
+# This function gives the authentication key: authkey if given, else INSTRUMENT_SERVER_KEY, else the key file.
+# create=True (the server) makes a random key file, readable by this user only, when there is none yet.
+# Addresses other than localhost are refused unless the key was given explicitly (argument or environment variable).
+def load_authkey(address, authkey=None, create=False):
+    if authkey is None and os.environ.get(AUTHKEY_ENV):
+        authkey = os.environ[AUTHKEY_ENV]
+    if authkey is not None:
+        return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+    if address[0] not in LOCAL_HOSTS:
+        raise PermissionError(f"{address[0]} isn't localhost: set the key explicitly ({AUTHKEY_ENV}) to use the server over the network")
+    if not AUTHKEY_FILE.exists():
+        if not create:
+            raise FileNotFoundError(f"No key in {AUTHKEY_FILE}, start the instrument server first (it makes the key)")
+        try:
+            fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass                                # another server made it just now
+    return AUTHKEY_FILE.read_text().strip().encode()
+
+
+# This function tells whether an attribute value is plain data that may be sent to a client: numbers, strings, None,
+# NumPy arrays of numbers and lists/tuples/dicts of those.
+def is_plain_data(value):
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.number, np.bool_)):
+        return True
+    if isinstance(value, np.ndarray):
+        return value.dtype != object
+    if isinstance(value, (list, tuple)):
+        return all(is_plain_data(item) for item in value)
+    if isinstance(value, dict):
+        return all(is_plain_data(key) and is_plain_data(item) for key, item in value.items())
+    return False
+
+
+class SpectrometerHandle:
+    # sn is the stellarnet_driver3 module (or a simulators.FakeStellarNet), channel the spectrometer to open.
+    def __init__(self, sn, channel=0):
+        self.sn = sn
+        self.spec, self.wav = sn.array_get_spec(channel)
+
+    def device_id(self):
+        return str(self.sn.getDeviceId(self.spec))
+
+    def wavelengths(self):
+        return np.ravel(self.wav).astype(float)
+
+    def set_params(self, integration_time, scans_avg=1, smooth=0, xtiming=3):
+        self.sn.setParam(self.spec, integration_time, scans_avg, smooth, xtiming, clear=True)
+
+    # This function gives one spectrum (counts per pixel, float32), averaged by the driver's scans_avg.
+    def read(self):
+        return spectrum_counts(self.sn.array_spectrum(self.spec, self.wav))
+
+    # This function gives `frames` spectra through the burst FIFO as a (frames x pixels) array (enable_burst first).
+    def read_burst(self, frames):
+        return read_burst(self.sn, self.spec, frames, len(self.wav))
+
+    def enable_burst(self):
+        enable_burst(self.sn, self.spec)
+
+    def hot_pixels(self):
+        return [int(p) for p in np.ravel(self.sn.getDeviceHotPixels(self.spec)) if int(p) > 0]
+
+    def close(self):
+        self.sn.reset(self.spec)
+
+
+class InstrumentServer:
+    # instruments maps a name to a connected instrument object, e.g. {"lockin": UHFLI(), "stage": NewPort_Delay_Stage_225()}.
+    # address is (host, port), port 0 picks a free one (see .address). authkey defaults to the user's key (see load_authkey).
+    def __init__(self, instruments, address=DEFAULT_ADDRESS, authkey=None):
+        authkey = load_authkey(address, authkey, create=True)
+        self.instruments = instruments
+        self.workers = {name: InstrumentWorker(instrument, name) for name, instrument in instruments.items()}
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self._owner = None                      # client holding the lock (see InstrumentClient.lock)
+        self._lock_conn = None                  # and the connection it locked with
+        self._turn = threading.Condition()
+        self._closed = threading.Event()
+        self._thread = None
+
+    # This function accepts clients until close() is called, each client connection is served on its own thread.
+    def serve_forever(self):
+        while not self._closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self._closed.is_set():
+                    return
+                continue                        # e.g. a client with the wrong key
+            threading.Thread(target=self._serve, args=(conn,), name="instrument client", daemon=True).start()
+
+    # This function runs serve_forever on a background thread (for tests and notebooks) and returns the server.
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="instrument server", daemon=True)
+        self._thread.start()
+        return self
+
+    # This function stops accepting clients and stops the worker threads (the instruments themselves are closed by the caller).
+    def close(self):
+        self._closed.set()
+        self.listener.close()
+        for worker in self.workers.values():
+            worker.close()
+
+    # This function answers one client connection until it is closed.
+    def _serve(self, conn):
+        client_id = None
+        try:
+            kind, client_id = conn.recv()       # every connection starts with ("hello", client id)
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", self._answer(client_id, request, conn))
+                except Exception as e:
+                    reply = ("error", e)
+                try:
+                    conn.send(reply)
+                except Exception as e:
+                    # the result (or the exception) doesn't pickle
+                    conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+        except (EOFError, OSError):
+            pass
+        finally:
+            # a client that disconnects without unlocking gives the lock up
+            with self._turn:
+                if self._owner is not None and self._owner == client_id and self._lock_conn is conn:
+                    self._owner = None
+                    self._turn.notify_all()
+            conn.close()
+
+    def _answer(self, client_id, request, conn):
+        kind = request[0]
+        if kind == "call":
+            name, method, args, kwargs = request[1:]
+            if method.startswith("_") or method in CLOSING_METHODS:
+                raise PermissionError(f"{method} can't be called through the server")
+            self._wait_turn(client_id)
+            return self.workers[name].submit(method, *args, **kwargs).result()
+        if kind == "getattr":
+            name, attribute = request[1:]
+            if attribute.startswith("_"):
+                raise AttributeError(attribute)
+            value = getattr(self.instruments[name], attribute)
+            if not is_plain_data(value):
+                raise PermissionError(f"{name}.{attribute} isn't plain data, it can't be read through the server")
+            return value
+        if kind == "describe":
+            return {name: {"class": type(instrument).__name__,
+                           "methods": [m for m in dir(instrument) if not m.startswith("_") and callable(getattr(instrument, m, None))]}
+                    for name, instrument in self.instruments.items()}
+        if kind == "lock":
+            with self._turn:
+                if not self._turn.wait_for(lambda: self._owner in (None, client_id), timeout=request[1]):
+                    raise TimeoutError("the instruments are locked by another client")
+                self._owner = client_id
+                self._lock_conn = conn
+            return True
+        if kind == "unlock":
+            with self._turn:
+                if self._owner == client_id:
+                    self._owner = None
+                    self._turn.notify_all()
+            return True
+        if kind == "ping":
+            return time.time()
+        raise ValueError(f"unknown request {kind}")
+
+    # While another client holds the lock, calls wait for it to be released.
+    def _wait_turn(self, client_id):
+        with self._turn:
+            self._turn.wait_for(lambda: self._owner in (None, client_id))
+
+
+class InstrumentClient:
+    # This connects to a running InstrumentServer (ConnectionRefusedError if there is none).
+    # authkey defaults to the user's key (see load_authkey).
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = parse_address(address) if isinstance(address, (str, int)) else tuple(address)
+        self.authkey = load_authkey(self.address, authkey)
+        self.client_id = uuid.uuid4().hex
+        self._conn = self._connect()
+        self._conn_lock = threading.Lock()
+        self._proxies = []
+        self.instruments = self._request(("describe",))      # name -> {"class", "methods"}
+
+    # This function gives a proxy for one served instrument. It has its own connection, so calls to different
+    # instruments (e.g. from InstrumentWorker threads) still run at the same time.
+    def instrument(self, name):
+        if name not in self.instruments:
+            raise KeyError(f"the server has no {name} (it has {', '.join(self.instruments)})")
+        proxy = RemoteInstrument(self, name, self.instruments[name]["methods"])
+        self._proxies.append(proxy)
+        return proxy
+
+    # This function gives the round trip time to the server (s).
+    def ping(self):
+        start = time.perf_counter()
+        self._request(("ping",))
+        return time.perf_counter() - start
+
+    # This context manager keeps the instruments to this client: other clients' calls wait until the with block ends
+    # (or this client disconnects). timeout (s) limits the wait for another client's lock.
+    @contextlib.contextmanager
+    def lock(self, timeout=None):
+        self._request(("lock", timeout))
+        try:
+            yield self
+        finally:
+            self._request(("unlock",))
+
+    # This function detaches from the server (the instruments stay connected there).
+    def close(self):
+        for proxy in self._proxies:
+            proxy.close()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        conn = Client(self.address, authkey=self.authkey)
+        conn.send(("hello", self.client_id))
+        return conn
+
+    def _request(self, request):
+        with self._conn_lock:
+            return _exchange(self._conn, request)
+
+
+class RemoteInstrument:
+    # Made by InstrumentClient.instrument: driver methods run in the server, other attributes are read from the server.
+    def __init__(self, client, name, methods):
+        self._name = name
+        self._methods = set(methods)
+        self._conn = client._connect()
+        self._conn_lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        if attribute in self._methods:
+            return functools.partial(self._call, attribute)
+        return self._request(("getattr", self._name, attribute))
+
+    def _call(self, method, *args, **kwargs):
+        return self._request(("call", self._name, method, args, kwargs))
+
+    def _request(self, request):
+        with self._conn_lock:
+            return _exchange(self._conn, request)
+
+    # These only detach this proxy, the server keeps the instrument connected.
+    def close(self):
+        with self._conn_lock:
+            if not self._conn.closed:
+                self._conn.close()
+
+    def disconnect(self):
+        self.close()
+
+    def __repr__(self):
+        return f"<remote {self._name}>"
+
+
+# This function sends one request and returns its result, exceptions raised in the server are raised here.
+def _exchange(conn, request):
+    conn.send(request)
+    status, value = conn.recv()
+    if status == "error":
+        raise value
+    return value
+
+
+if __name__ == "__main__":
+    from . import NewPort_Delay_Stage_225, UHFLI, stellarnet_driver3
+    from .simulators import SimulatedLab
+
+    parser = argparse.ArgumentParser(description="Keep the instruments connected and serve them to scripts on this PC")
+    parser.add_argument("--address", default=f"{DEFAULT_ADDRESS[0]}:{DEFAULT_ADDRESS[1]}", help=f"host:port to listen on (default localhost:6340, other hosts need {AUTHKEY_ENV} set)")
+    parser.add_argument("--simulate", action="store_true", help="serve simulated instruments (Device_Drivers/simulators.py)")
+    parser.add_argument("--port", default="COM5", help="serial port of the delay stage")
+    parser.add_argument("--channel", type=int, default=0, help="spectrometer channel")
+    parser.add_argument("--no-lockin", action="store_true", help="don't connect the UHFLI")
+    parser.add_argument("--no-stage", action="store_true", help="don't connect the delay stage")
+    parser.add_argument("--no-spectrometer", action="store_true", help="don't connect the spectrometer")
+    args = parser.parse_args()
+    address = parse_address(args.address)
+    try:
+        load_authkey(address, create=True)      # before connecting anything
+    except PermissionError as e:
+        parser.error(str(e))
+
+    lab = SimulatedLab() if args.simulate else None
+    sn = lab.stellarnet if lab else stellarnet_driver3
+    instruments = {}
+    try:
+        if not args.no_lockin:
+            instruments["lockin"] = UHFLI(daq=lab.daq) if lab else UHFLI()
+            print("UHFLI connected")
+        if not args.no_stage:
+            instruments["stage"] = NewPort_Delay_Stage_225(port=lab.stage.port if lab else args.port)
+            print("Delay stage connected")
+        if not args.no_spectrometer:
+            if sn is None:
+                print("No StellarNet driver for this platform/Python, serving without the spectrometer")
+            else:
+                instruments["spectrometer"] = SpectrometerHandle(sn, args.channel)
+                print("Spectrometer connected")
+        server = InstrumentServer(instruments, address)
+        print(f"Serving {', '.join(instruments)} on {server.address[0]}:{server.address[1]} (Ctrl-C to stop)")
+        server.start()
+        try:
+            while True:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("\nStopping the server.")
+        finally:
+            server.close()
+    finally:
+        for name, close in (("stage", "close"), ("lockin", "disconnect"), ("spectrometer", "close")):
+            if name in instruments:
+                try:
+                    getattr(instruments[name], close)()
+                except Exception:
+                    pass
+        print("Devices disconnected.")
@@ -0,0 +1,129 @@
+from concurrent.futures import Future
+import queue
+import threading
+
+"""
+Instrument Worker Threads
+Gives each instrument its own thread and command queue, so slow instrument I/O can overlap with everything else.
+
+InstrumentWorker -> runs calls on one instrument (UHFLI, NewPort_Delay_Stage_225, the stellarnet module, ...) in order,
+                    on its own thread. submit() returns a Future right away, so the caller is free to do other work or
+                    to start reads on other instruments at the same time.
+acquire_ahead    -> scan engine for step scans: at each position the stage moves, then all the instruments read at the
+                    same time. It runs one step ahead of the caller, so processing, printing and saving step i overlap
+                    with the move and the reads of step i+1.
+
+Example (lock-in and spectrometer read together at each position):
+
+    stage_worker = InstrumentWorker(stage, "stage")
+    lockin_worker = InstrumentWorker(lockin, "lockin")
+    spec_worker = InstrumentWorker(sn, "spectrometer")
+    steps = acquire_ahead(positions, lambda pos: stage_worker.submit("move_to", pos),
+                          {"boxcars": lambda: lockin_worker.submit("read_boxcars", (0, 1)),
+                           "spectrum": lambda: spec_worker.submit("array_spectrum", spec, wav)})
+    for pos, actual_pos, readings in steps:
+        ...
+
+"""
+class InstrumentWorker:
+    # This is the constructor for the worker, it starts the thread that owns the instrument.
+    # Only this thread should talk to the instrument while the worker is running.
+    def __init__(self, instrument, name="instrument"):
+        self.instrument = instrument
+        self.name = name
+        self._commands = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"{name} worker", daemon=True)
+        self._thread.start()
+
+    # This function queues a call and returns a Future for its result (or exception).
+    # method is the name of an instrument method (e.g. "move_to") or any callable (run as method(*args, **kwargs)).
+    def submit(self, method, *args, **kwargs):
+        future = Future()
+        if not self._thread.is_alive():
+            future.set_exception(RuntimeError(f"The {self.name} worker is closed"))
+            return future
+        self._commands.put((method, args, kwargs, future))
+        return future
+
+    # This function queues a call and waits for its result.
+    def call(self, method, *args, timeout=None, **kwargs):
+        return self.submit(method, *args, **kwargs).result(timeout)
+
+    # This function stops the worker after the calls already queued (wait=True waits until they are done).
+    def close(self, wait=True):
+        self._commands.put(None)
+        if wait and threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            method, args, kwargs, future = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                function = getattr(self.instrument, method) if isinstance(method, str) else method
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        # anything queued after close() is cancelled
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is not None:
+                command[3].cancel()
+
+
+# This function runs the acquisition of a step scan on a background thread and yields (position, move result, readings)
+# for each position, in order. move(pos) and every read() in reads return Futures (e.g. from InstrumentWorker.submit);
+# all reads of one position are started together, so different instruments measure at the same time.
+# readings is {name: result} with the names used in reads. At most `depth` finished steps wait for the caller.
+# An error on the acquisition thread is raised in the caller at the step where it happened.
+def acquire_ahead(positions, move, reads, depth=1):
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run():
+        try:
+            for pos in positions:
+                if stop.is_set():
+                    return
+                actual_pos = move(pos).result()
+                futures = {name: read() for name, read in reads.items()}
+                put((pos, actual_pos, {name: future.result() for name, future in futures.items()}))
+        except BaseException as e:
+            put(e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=run, name="acquire_ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,278 @@
+from . import scan_trace
+from .scan_analysis import block_mean
+import matplotlib.pyplot as plt
+import numpy as np
+import queue
+import threading
+import time
+
+"""
+Live View
+Live plots that never hold up the scan. The acquisition loop (moves, reads, calculations, saving) runs on its own thread
+and only put()s new data on a queue; the plots are redrawn on the main thread (where the GUI has to live) at most
+`fps` times per second, with whatever arrived since the last redraw.
+
+Redraws use blitting: the axes, ticks and labels are drawn once and kept as a background image, each redraw only
+pastes that back and draws the data artists on top. The full figure is only redrawn when the data leaves the axes
+limits (the limits then grow with some room to spare, so that happens a few times per scan) or the window changes.
+
+LiveView          -> the queue, frame-rate limit and blitting, subclasses say what to draw
+LockinLiveView    -> dT per step and the stage position bar for lockinlive.py
+SpectrumLiveView  -> delay x wavelength image for spectrometerV1.py, one row filled in per step
+
+    view = LockinLiveView()
+    def acquisition(stop):
+        for ...:
+            if stop.is_set():
+                break
+            ...
+            view.put("point", dT)
+            view.put("position", pos)
+    view.run(acquisition)       # returns when the acquisition is done (Ctrl-C stops it after the current step)
+    view.finish()               # final, normal figures for plt.show()
+
+"""
+class LiveView:
+    # fps is the highest redraw rate, data that arrives in between is drawn together at the next redraw.
+    def __init__(self, fps=10.0):
+        self.interval = 1.0 / fps
+        self.updates = queue.Queue()
+        self.figures = []               # (figure, artists redrawn by blitting)
+        self._backgrounds = {}
+        self._changed = False
+
+    # This function hands new data to the view (from any thread, never waits). The subclass's handle() gets it later.
+    def put(self, kind, *values):
+        self.updates.put((kind, values))
+
+    # This function registers a figure and the artists that change during the scan.
+    def add_figure(self, figure, artists):
+        for artist in artists:
+            artist.set_animated(True)
+        # every full draw (first show, resize, new limits) takes a new background
+        figure.canvas.mpl_connect("draw_event", lambda event, figure=figure: self._capture(figure))
+        self.figures.append((figure, artists))
+
+    # This function runs acquisition(stop) on a background thread and keeps the plots updated until it returns.
+    # stop is a threading.Event the acquisition should check every step; it is set on Ctrl-C, and the
+    # KeyboardInterrupt is raised again once the acquisition has stopped (a second Ctrl-C stops waiting for it).
+    # Errors in the acquisition are raised here.
+    def run(self, acquisition):
+        stop = threading.Event()
+        errors = []
+
+        def target():
+            try:
+                acquisition(stop)
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, name="acquisition", daemon=True)
+        thread.start()
+        last_draw = 0.0
+        try:
+            while thread.is_alive():
+                self._drain()
+                now = time.monotonic()
+                if self._changed and now - last_draw >= self.interval:
+                    self.redraw()
+                    last_draw = now
+                self._wait(max(self.interval - (time.monotonic() - last_draw), 0.01))
+        except KeyboardInterrupt:
+            stop.set()
+            print("\nStopping after the current step (Ctrl-C again to stop waiting)...")
+            try:
+                while thread.is_alive():
+                    thread.join(0.1)
+            except KeyboardInterrupt:
+                print("Not waiting for the acquisition thread any longer")
+            raise
+        thread.join()
+        self._drain()
+        self.redraw()
+        if errors:
+            raise errors[0]
+
+    # This function draws everything that arrived (blitting, or a full draw of figures whose limits changed).
+    def redraw(self):
+        with scan_trace.phase("plot"):
+            rescaled = self.refresh()
+            for figure, artists in self.figures:
+                if figure in rescaled or figure not in self._backgrounds:
+                    figure.canvas.draw()
+                else:
+                    self._blit(figure, artists)
+                figure.canvas.flush_events()
+            self._changed = False
+
+    # This function turns the live artists back into normal ones, so the figures can be shown / saved after the scan.
+    def finish(self):
+        self._drain()
+        self.refresh()
+        for figure, artists in self.figures:
+            for artist in artists:
+                artist.set_animated(False)
+            figure.canvas.draw_idle()
+
+    # Subclasses: handle(kind, values) takes one put() (on the main thread), refresh() puts the data on the artists
+    # and returns the figures whose axes limits it changed.
+    def handle(self, kind, values):
+        raise NotImplementedError
+
+    def refresh(self):
+        return []
+
+    def _drain(self):
+        while True:
+            try:
+                kind, values = self.updates.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(kind, values)
+            self._changed = True
+
+    def _capture(self, figure):
+        self._backgrounds[figure] = figure.canvas.copy_from_bbox(figure.bbox)
+        for f, artists in self.figures:
+            if f is figure:
+                self._draw_artists(figure, artists)
+
+    def _blit(self, figure, artists):
+        figure.canvas.restore_region(self._backgrounds[figure])
+        self._draw_artists(figure, artists)
+        figure.canvas.blit(figure.bbox)
+
+    def _draw_artists(self, figure, artists):
+        for artist in artists:
+            figure.draw_artist(artist)
+
+    # This function lets the GUI handle its events (window moves, resizes, ...) for `seconds` without redrawing anything.
+    def _wait(self, seconds):
+        if self.figures:
+            self.figures[0][0].canvas.start_event_loop(seconds)
+        else:
+            time.sleep(seconds)
+
+
+class LockinLiveView(LiveView):
+    # The dT of every step (in the order measured) and a bar showing where the stage is on its travel (mm).
+    def __init__(self, fps=10.0, travel=225):
+        super().__init__(fps)
+        plt.ion()
+        # Live plot for dT
+        self.fig_dT, self.ax_dT = plt.subplots(figsize=(8, 4))
+        self.line_dT, = self.ax_dT.plot([], [], 'o', label='dT (mV)')
+        self.ax_dT.set_xlabel('Step value')
+        self.ax_dT.set_ylabel('dT (mV)')
+        self.ax_dT.set_title('Live dT vs Step')
+        self.ax_dT.legend()
+        self.ax_dT.grid(True)
+        self.ax_dT.set_xlim(0, 10)
+
+        # Live current position bar for the move stage (in mm)
+        self.fig_pos, ax_pos = plt.subplots(figsize=(8, 2))
+        ax_pos.set_xlim(0, travel)
+        ax_pos.set_ylim(0, 1)
+        ax_pos.set_yticks([])
+        ax_pos.set_xlabel('Position (mm)')
+        ax_pos.set_ylabel('Current Position of stage')
+        ax_pos.set_xticks(np.arange(0, travel + 1, 25))
+        ax_pos.set_xticks(np.arange(0, travel + 1, 5), minor=True)
+        ax_pos.grid(which='minor', linestyle=':', linewidth=0.5)
+        self.bar = ax_pos.barh(y=0.5, width=0, left=0, height=0.3, color='red', edgecolor='black')[0]
+
+        self.add_figure(self.fig_dT, [self.line_dT])
+        self.add_figure(self.fig_pos, [self.bar])
+        self.dT = np.full(1024, np.nan)
+        self.count = 0
+        self.position = 0.0
+        self._y_set = False             # the y limits are only set once there is data
+
+    # put("point", dT in mV) adds a step, put("position", mm) moves the bar
+    def handle(self, kind, values):
+        if kind == "point":
+            if self.count == len(self.dT):
+                self.dT = np.concatenate([self.dT, np.full(len(self.dT), np.nan)])
+            self.dT[self.count] = values[0]
+            self.count += 1
+        elif kind == "position":
+            self.position = values[0]
+
+    def refresh(self):
+        self.line_dT.set_data(np.arange(self.count), self.dT[:self.count])
+        self.bar.set_width(self.position)
+        return [self.fig_dT] if self._grow_limits() else []
+
+    # This function widens the dT axes when a point falls outside them (with room for more, so it rarely happens).
+    def _grow_limits(self):
+        changed = False
+        x_low, x_high = self.ax_dT.get_xlim()
+        if self.count > x_high:
+            self.ax_dT.set_xlim(x_low, 2 * self.count)
+            changed = True
+        values = self.dT[:self.count]
+        values = values[np.isfinite(values)]
+        if len(values):
+            low, high = float(values.min()), float(values.max())
+            y_low, y_high = self.ax_dT.get_ylim()
+            if self._y_set:
+                low, high = min(low, y_low), max(high, y_high)
+            if not self._y_set or low < y_low or high > y_high:
+                margin = 0.25 * max(high - low, abs(high) * 0.01, 1e-3)
+                self.ax_dT.set_ylim(low - margin, high + margin)
+                self._y_set = True
+                changed = True
+        return changed
+
+
+class SpectrumLiveView(LiveView):
+    # An image of the spectra (or dT/T) with the wavelength across and the delay up, filled in one row per step.
+    # The delay axis has `rows` rows from delays[0] to delays[1] (ps), each step goes into the row nearest its delay
+    # (a later step at the same row replaces it, e.g. the running average of repeated passes).
+    # Level of detail: the image never has more than max_rows x max_columns cells, so a big scan (thousands of pixels,
+    # hundreds of steps) costs the same to redraw as a small one. Pixels are averaged in blocks down to max_columns,
+    # preview_bin > 1 averages blocks of that many pixels for a coarser (less noisy) preview.
+    # (the image assumes evenly spaced wavelengths, fine for a preview, the stored data keeps the real axis)
+    def __init__(self, wavelengths, delays, rows, label="Counts", fps=5.0, max_rows=500, max_columns=1000, preview_bin=1):
+        super().__init__(fps)
+        wavelengths = np.asarray(wavelengths, dtype=float)
+        self.columns = max(min(max_columns, len(wavelengths) // max(preview_bin, 1)), 1)
+        self.rows = max(min(rows, max_rows), 1)
+        self.delays = (float(min(delays)), float(max(delays)))
+        self.image = np.full((self.rows, self.columns), np.nan, dtype=np.float32)
+        self.low, self.high = np.inf, -np.inf      # data range so far (sets the colour scale)
+        self.clim = None                            # the colour scale is only set once there is data
+
+        plt.ion()
+        self.fig, ax = plt.subplots(figsize=(9, 6))
+        self.im = ax.imshow(self.image, aspect="auto", origin="lower", cmap="plasma", interpolation="nearest",
+                            extent=[wavelengths[0], wavelengths[-1], self.delays[0], self.delays[1]])
+        ax.set_xlabel("Wavelength (nm)")
+        ax.set_ylabel("Delay (ps)")
+        ax.set_title(f"Live {label} (delay x wavelength)")
+        self.fig.colorbar(self.im, ax=ax, label=label)
+        self.add_figure(self.fig, [self.im])
+
+    # put("row", delay in ps, values per pixel) fills in one row
+    def handle(self, kind, values):
+        if kind == "row":
+            delay, row = values
+            span = self.delays[1] - self.delays[0]
+            index = int(round((delay - self.delays[0]) / span * (self.rows - 1))) if span > 0 else 0
+            row = block_mean(row, self.columns)
+            self.image[min(max(index, 0), self.rows - 1)] = row
+            finite = row[np.isfinite(row)]
+            if len(finite):
+                self.low, self.high = min(self.low, float(finite.min())), max(self.high, float(finite.max()))
+
+    def refresh(self):
+        self.im.set_data(self.image)
+        if not np.isfinite(self.low):
+            return []
+        # the colour scale only grows (with room to spare), each change redraws the colour bar
+        if self.clim is not None and self.clim[0] <= self.low and self.high <= self.clim[1]:
+            return []
+        margin = 0.1 * max(self.high - self.low, abs(self.high) * 0.01, 1e-12)
+        self.clim = (self.low - margin, self.high + margin)
+        self.im.set_clim(*self.clim)
+        return [self.fig]
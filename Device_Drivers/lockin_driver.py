@@ -1,4 +1,9 @@
-from zhinst.ziPython import ziDAQServer
+try:
+    from zhinst.ziPython import ziDAQServer
+except ImportError:
+    ziDAQServer = None          # zhinst not installed: only UHFLI(daq=...) with a simulators.FakeDAQServer works
+from . import scan_trace
+import numpy as np
 import time
 
 """
@@ -8,11 +13,15 @@ This gives a simple interface to interact with the Lock-In Amplifier device.
 """
 class UHFLI:
     # This is the constructor for the class, it initializes the device and connects to it.
-    def __init__(self, device_id="DEV2245", host="localhost", port=8004, api_level=6):
+    # An already created daq object (for example a FakeDAQServer from simulators.py) can be passed in instead of connecting to the real server.
+    def __init__(self, device_id="DEV2245", host="localhost", port=8004, api_level=6, daq=None):
         self.device_id = device_id
-        self.daq = ziDAQServer(host, port, api_level)
+        if daq is None and ziDAQServer is None:
+            raise ImportError("The zhinst package is needed to connect to the UHFLI (pip install zhinst)")
+        self.daq = daq if daq is not None else ziDAQServer(host, port, api_level)
         self.daq.connectDevice(self.device_id, "USB")
-    
+        self._clockbase = None
+
     # This function is used to average the voltage readings from the boxcar.
     def average_boxcar_voltage(self, channel, duration=5, interval=0.1):
         readings = []
@@ -22,21 +31,147 @@ class UHFLI:
             readings.append(mv)
             time.sleep(interval)
         return sum(readings) / len(readings)
-   
+
     # This function is used to read the voltage from the boxcar.
     def read_boxcar_voltage(self, channel):
         return self.daq.getDouble(f"/{self.device_id}/boxcars/{channel}/value") * 1000
 
+    # This function reads several boxcars (and optionally demodulators) in a single server request.
+    # All values come back as one record so dT and dR belong to the same instant:
+    # {"timestamp": s, "boxcars": {channel: mV}, "demods": {index: {"x", "y", "r", "theta"}}}
+    def read_boxcars(self, channels=(0, 1), demods=()):
+        boxcar_paths = {channel: f"/{self.device_id}/boxcars/{channel}/value".lower() for channel in channels}
+        demod_paths = {index: f"/{self.device_id}/demods/{index}/sample".lower() for index in demods}
+        # boxcar values and demod samples are streaming nodes, get() leaves them out unless settingsonly=False
+        with scan_trace.phase("read", instrument="lockin"):
+            data = self.daq.get(",".join(list(boxcar_paths.values()) + list(demod_paths.values())), flat=True,
+                                settingsonly=False)
+        timestamps = []
+        record = {"boxcars": {}, "demods": {}}
+        for channel, path in boxcar_paths.items():
+            node = data[path]
+            record["boxcars"][channel] = float(node["value"][-1]) * 1000
+            timestamps.append(node["timestamp"][-1])
+        for index, path in demod_paths.items():
+            node = data[path]
+            x = float(node["x"][-1])
+            y = float(node["y"][-1])
+            record["demods"][index] = {"x": x, "y": y, "r": float(np.hypot(x, y)), "theta": float(np.arctan2(y, x))}
+            timestamps.append(node["timestamp"][-1])
+        record["timestamp"] = float(max(timestamps)) / self.clockbase() if timestamps else None
+        return record
+
+    # This function checks that the data server answers for the device.
+    def is_connected(self):
+        try:
+            return self.daq.getInt(f"/{self.device_id}/clockbase") > 0
+        except Exception:
+            return False
+
+    # This function returns the device clock rate (ticks per second) used to convert timestamps to seconds.
+    def clockbase(self):
+        if self._clockbase is None:
+            self._clockbase = float(self.daq.getInt(f"/{self.device_id}/clockbase"))
+        return self._clockbase
+
+    # This function subscribes to the streaming sample node of each boxcar channel so every sample can be polled.
+    def subscribe_boxcars(self, channels=(0, 1)):
+        for channel in channels:
+            self.daq.subscribe(self._boxcar_sample_path(channel))
+        self.daq.sync()
+
+    # This function stops streaming the boxcar channels.
+    def unsubscribe_boxcars(self, channels=(0, 1)):
+        for channel in channels:
+            self.daq.unsubscribe(self._boxcar_sample_path(channel))
+
+    # This function polls the subscribed boxcars for `duration` seconds.
+    # Returns {channel: (timestamps in s, values in mV)} with one NumPy array entry per boxcar sample.
+    def poll_boxcars(self, duration, channels=(0, 1), timeout_ms=100):
+        with scan_trace.phase("read", instrument="lockin"):
+            data = self.daq.poll(duration, timeout_ms, 0, True)
+        clockbase = self.clockbase()
+        result = {}
+        for channel in channels:
+            node = data.get(self._boxcar_sample_path(channel), {})
+            timestamps = np.asarray(node.get("timestamp", []), dtype=np.float64) / clockbase
+            values = np.asarray(node.get("value", []), dtype=np.float64) * 1000
+            result[channel] = (timestamps, values)
+        return result
+
+    # This function streams every boxcar sample the device produces over `duration` seconds.
+    # It is the fast replacement for average_boxcar_voltage: one subscribe/poll instead of a getDouble + sleep per sample.
+    def stream_boxcar_voltage(self, channel, duration=1.0):
+        self.subscribe_boxcars([channel])
+        try:
+            timestamps, values = self.poll_boxcars(duration, [channel])[channel]
+        finally:
+            self.unsubscribe_boxcars([channel])
+        if len(values) == 0:
+            raise RuntimeError(f"No samples received from boxcar {channel} in {duration} s")
+        return {
+            "timestamps": timestamps,
+            "values": values,
+            "mean": float(np.mean(values)),
+            "std": float(np.std(values, ddof=1)) if len(values) > 1 else 0.0,
+            "count": len(values),
+        }
+
+    # This function keeps streaming a boxcar until the standard error of the mean drops below target_sem (mV)
+    # or max_duration (s) runs out, so quiet signals finish quickly and noisy ones get the averaging they need.
+    # With target_sem=None it simply streams for max_duration.
+    # Returns {"mean", "sem", "std", "count", "duration", "converged"} (mV, s).
+    def measure_boxcar_voltage(self, channel, target_sem=None, max_duration=10.0, min_samples=20, chunk=0.1):
+        count, mean, m2 = 0, 0.0, 0.0
+        sem = float("inf")
+        converged = False
+        started = time.monotonic()
+        self.subscribe_boxcars([channel])
+        try:
+            while True:
+                elapsed = time.monotonic() - started
+                if elapsed >= max_duration:
+                    break
+                values = self.poll_boxcars(min(chunk, max_duration - elapsed), [channel])[channel][1]
+                if len(values) == 0:
+                    continue
+                # merge the chunk into the running mean/variance (Chan et al. parallel form of Welford's update)
+                chunk_count = len(values)
+                chunk_mean = float(np.mean(values))
+                chunk_m2 = float(np.sum((values - chunk_mean) ** 2))
+                total = count + chunk_count
+                delta = chunk_mean - mean
+                mean += delta * chunk_count / total
+                m2 += chunk_m2 + delta ** 2 * count * chunk_count / total
+                count = total
+                if count > 1:
+                    sem = (m2 / (count - 1) / count) ** 0.5
+                if target_sem is not None and count >= min_samples and sem <= target_sem:
+                    converged = True
+                    break
+        finally:
+            self.unsubscribe_boxcars([channel])
+        if count == 0:
+            raise RuntimeError(f"No samples received from boxcar {channel} in {max_duration} s")
+        return {
+            "mean": mean,
+            "sem": sem,
+            "std": (m2 / (count - 1)) ** 0.5 if count > 1 else 0.0,
+            "count": count,
+            "duration": time.monotonic() - started,
+            "converged": converged,
+        }
+
     # This function turns the boxcar baseline on or off for either channel 1 or 2. (aka 0 or 1)
     def set_boxcar_baseline(self, channel, state):
         if channel == 1:
             self.daq.setInt(f"/{self.device_id}/boxcars/0/baseline", int(state))    #check if its /0/ or /1/ for both channels
         elif channel == 2:
             self.daq.setInt(f"/{self.device_id}/boxcars/1/baseline", int(state))
-        
+
     def disconnect(self):
         self.daq.disconnectDevice(self.device_id)
 
-
-
-
+    # Node paths are returned lower case by poll, so they are built lower case here.
+    def _boxcar_sample_path(self, channel):
+        return f"/{self.device_id}/boxcars/{channel}/sample".lower()
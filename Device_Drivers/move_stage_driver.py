@@ -1,9 +1,19 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from . import scan_trace
+import logging
+import queue
 import serial
+import threading
 import time
 
 "Application Level Driver For the DL225 Stage"
 "Provides a simple interface to interact with the DL225 stage device."
 
+log = logging.getLogger(__name__)
+
+# Controller states (last two characters of the TS reply) in which the stage is still travelling
+MOVING_STATES = ("1E", "1F", "28")
+
 class NewPort_Delay_Stage_225:
    
     # This is the constructor for the class, it initializes the serial connection to the stage.
@@ -11,78 +21,314 @@ class NewPort_Delay_Stage_225:
     # The default port is set to 'COM5' and baud rate to 9600, be sure to change the COM port to the one the stage is connected to.
     # You can also change the baud rate if needed, but 9600 is the standard for the DL225 so it should work fine without any adjustments.
     
-    def __init__(self, port='COM5', baud=9600):
-        self.ser = serial.Serial(port=port, baudrate=baud, bytesize=serial.EIGHTBITS,parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
-        time.sleep(2)
+    # position_tolerance (mm) is how close the measured position has to be to the target before a move counts as done.
+    # max_velocity (mm/s) and max_acceleration (mm/s^2) bound the motion profiles picked for each move (see plan_move),
+    # fine_acceleration is used instead when a move has to settle tighter than fine_tolerance (mm).
+    # With auto_profile=False every move keeps whatever velocity/acceleration was last set.
+    # The port can also be a pyserial URL such as "loop://", the pty of a simulators.FakeDL225 for testing without the stage,
+    # or an already open serial-like object (e.g. the port of FakeDL225(transport="loop"), which also works on Windows).
+    def __init__(self, port='COM5', baud=9600, position_tolerance=0.001, max_velocity=50.0, max_acceleration=100.0,
+                 fine_acceleration=20.0, fine_tolerance=0.0005, auto_profile=True):
+        self.position_tolerance = position_tolerance
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.fine_acceleration = fine_acceleration
+        self.fine_tolerance = fine_tolerance
+        self.auto_profile = auto_profile
+        self.settle_overhead = 0.05         # status polling and settling added on top of the profile time (s)
+        self.velocity = None                # last VA/AC sent, so they are only resent when they change
+        self.acceleration = None
+        self.position = None                # last measured position
+        if not isinstance(port, str):
+            self.ser = port
+        else:
+            self.ser = serial.serial_for_url(port, baudrate=baud, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.1)
+            time.sleep(2)   # give the controller time to come up after the port opens (an open port is already up)
         self.ser.reset_input_buffer()
         self.ser.reset_output_buffer()
+        self._write_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = []                  # (reply prefix, Future) for every query still waiting on its reply
+        self._responses = queue.Queue()     # replies that did not belong to any pending query
+        self._closed = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, name="DL225-reader", daemon=True)
+        self._reader.start()
         self.initialize_stage()
 
-    # This function sends a command to the stage and waits for a response.
+    # This function sends a command to the stage without waiting for anything.
+    # Commands and replies are logged at debug level (enable with logging.basicConfig(level=logging.DEBUG))
+    # and recorded in the scan trace when one is running (see scan_trace.py).
     def send_command(self, cmd):
         full = cmd + '\r\n'
-        print(f">>> {cmd}")
-        self.ser.write(full.encode('ascii'))
-        self.ser.flush()
-        time.sleep(0.1)
+        log.debug(">>> %s", cmd)
+        with self._write_lock:
+            self.ser.write(full.encode('ascii'))
+            self.ser.flush()
+        scan_trace.event("command", cmd=cmd)
 
-    # This function reads the response from the stage within a specified timeout period.
+    # This function returns the next reply that was not claimed by a query, or None if nothing arrives within the timeout.
     def read_response(self, timeout=2.0):
-        self.ser.timeout = 0.1
+        try:
+            return self._responses.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # This function sends a query (e.g. "1TP") without blocking and returns a Future for the value part of its reply.
+    # Replies are matched to queries by their command prefix, so several different queries can be in flight at once.
+    def submit(self, cmd):
+        future = Future()
+        with self._pending_lock:
+            self._pending.append((cmd.rstrip("?"), future))
+        self.send_command(cmd)
+        return future
+
+    # This function sends a query and waits for its reply.
+    def query(self, cmd, timeout=2.0):
+        try:
+            with scan_trace.phase("query", cmd=cmd):
+                future = self.submit(cmd)
+                return future.result(timeout)
+        except FutureTimeoutError:
+            self._forget(future)
+            raise TimeoutError(f"No reply to {cmd} from the stage") from None
+
+    # This function checks that the controller answers on the serial port.
+    def is_connected(self):
+        if not self.ser.is_open:
+            return False
+        try:
+            self.get_status()
+            return True
+        except (TimeoutError, serial.SerialException, OSError):
+            return False
+
+    # This function reads the current stage position (mm) from the controller.
+    def get_position(self):
+        self.position = float(self.query("1TP"))
+        return self.position
+
+    # This function reads the controller status, returning (error code, controller state) as hex strings.
+    # The state is "28" while moving, "1E"/"1F" while homing and "32" to "38" when ready.
+    def get_status(self):
+        reply = self.query("1TS")
+        return reply[:-2], reply[-2:].upper()
+
+    # This function asks for status and position in one go (both queries in flight together).
+    # Returns (error code, controller state, position in mm).
+    def get_status_and_position(self, timeout=2.0):
+        try:
+            with scan_trace.phase("query", cmd="1TS+1TP"):
+                status = self.submit("1TS")
+                position = self.submit("1TP")
+                reply = status.result(timeout)
+                value = float(position.result(timeout))
+        except FutureTimeoutError:
+            self._forget(status)
+            self._forget(position)
+            raise TimeoutError("No status/position reply from the stage") from None
+        self.position = value
+        return reply[:-2], reply[-2:].upper(), value
+
+    # This function reads the error code of the last command ("@" means no error).
+    def get_error(self):
+        return self.query("1TE")
+
+    # This function polls the controller until it has stopped within tolerance of the target and returns the measured position.
+    def wait_for_motion(self, target, tolerance=None, timeout=60.0, poll_interval=0.01):
+        tolerance = self.position_tolerance if tolerance is None else tolerance
         deadline = time.time() + timeout
         while time.time() < deadline:
-            line = self.ser.readline().decode('ascii', errors='ignore').strip()
-            if line:
-                print(f"<<< {line}")
-                return line
-        return None
-    
+            _, state, position = self.get_status_and_position()
+            if state not in MOVING_STATES and abs(position - target) <= tolerance:
+                return position
+            time.sleep(poll_interval)
+        raise TimeoutError(f"Stage did not reach {target} mm within {timeout} s")
+
     # This function initializes the stage with default settings (You can modify these settings as needed).
     def initialize_stage(self):
-        self.send_command("1AC100")  # Acceleration (set to 100 mm/s^2) as the LabVIEW code had
-        self.read_response()
-        self.send_command("1VA0.02")  # Velocity (set to 0.02 mm/s) 
-        self.read_response()
+        self.set_acceleration(100)   # Acceleration (set to 100 mm/s^2) as the LabVIEW code had
+        self.set_velocity(0.02)      # Velocity (set to 0.02 mm/s), moves pick their own profile unless auto_profile is off
         self.send_command("1MO")      # Motor ON
-        self.read_response()
+        error = self.get_error()
+        if error not in ("@", "0", ""):
+            print(f"Stage reported error code {error} during initialization")
+        self.position = self.get_position()
 
     # This function moves the stage to a specified position.
-    def move_to(self, pos):
-        self.send_command(f"1PA{pos}") # Move to position defined in the send_command function
-        self.read_response()
-        self.send_command("1WS")
-        self.read_response()
-
-
-    # This function assists with quick sweep for reading the max value 
-    def quick_sweep(self, start, stop, coarse_step):
-        print("Starting Quick Sweep Scan")
-        self.send_command("1AC100")  # Temporary high acceleration (check labVIEW code for value)
-        self.read_response()
-        self.send_command("1VA1")     # Temporary high velocity (check labVIEW code for value)
-        self.read_response()
-        positions = []
-        pos = start
-        while pos <= stop:
-            self.move_to(round(pos, 2)) 
-            positions.append(round(pos, 2))
-            time.sleep(0.2) 
-            pos += coarse_step
-        self.send_command("1AC100")  
-        self.read_response()
-        self.send_command("1VA0.02")
-        self.read_response()
-        return positions
-    
+    # It returns as soon as the controller reports the stage stopped within tolerance, and gives back the measured final position.
+    # The velocity/acceleration come from plan_move (only resent when they change), and the timeout defaults
+    # to a few times the predicted move time. settle_time is an optional extra dwell (s) after the stage is in position.
+    def move_to(self, pos, tolerance=None, timeout=None, settle_time=0.0):
+        tolerance = self.position_tolerance if tolerance is None else tolerance
+        distance = abs(pos - self.position) if self.position is not None else None
+        if self.auto_profile and distance:
+            velocity, acceleration = self.plan_move(distance, tolerance)
+            self.set_acceleration(acceleration)
+            self.set_velocity(velocity)
+        if timeout is None:
+            timeout = 3 * self.predict_move_time(distance) + 5 if distance is not None else 600.0
+        with scan_trace.phase("motion", target=pos):
+            self.start_move(pos)
+            position = self.wait_for_motion(pos, tolerance, timeout)
+        if settle_time:
+            with scan_trace.phase("settle"):
+                time.sleep(settle_time)
+        return position
+
+    # This function picks (velocity, acceleration) for a move of `distance` mm that has to settle within `tolerance` mm.
+    # Moves needing tighter settling than fine_tolerance use the gentler fine_acceleration to limit overshoot.
+    # The velocity is the highest the profile can actually reach over that distance (capped at max_velocity),
+    # rounded to 3 significant figures so equal-sized steps reuse the same setting and nothing is resent.
+    def plan_move(self, distance, tolerance=None):
+        tolerance = self.position_tolerance if tolerance is None else tolerance
+        acceleration = self.max_acceleration if tolerance >= self.fine_tolerance else self.fine_acceleration
+        velocity = min(self.max_velocity, (acceleration * max(distance, 1e-6)) ** 0.5)
+        velocity = float(f"{velocity:.3g}")
+        return velocity, acceleration
+
+    # This function predicts how long (s) a move of `distance` mm takes, including the settle overhead.
+    # velocity/acceleration default to what plan_move would pick (or the current setting with auto_profile off).
+    def predict_move_time(self, distance, velocity=None, acceleration=None, tolerance=None):
+        if velocity is None or acceleration is None:
+            if self.auto_profile:
+                planned_velocity, planned_acceleration = self.plan_move(distance, tolerance)
+            else:
+                planned_velocity, planned_acceleration = self.velocity, self.acceleration
+            velocity = planned_velocity if velocity is None else velocity
+            acceleration = planned_acceleration if acceleration is None else acceleration
+        return move_time(distance, velocity, acceleration) + self.settle_overhead
+
+    # This function predicts the total motion time (s) of visiting the positions in order, starting from the current position.
+    def predict_scan_time(self, positions):
+        total = 0.0
+        current = self.position if self.position is not None else positions[0]
+        for pos in positions:
+            total += self.predict_move_time(abs(pos - current))
+            current = pos
+        return total
+
+    # This function moves to pos so the stage arrives travelling in `direction` (+1 or -1).
+    # It first stops `backlash` mm short of pos, which takes up the mechanical play after a direction reversal.
+    def approach(self, pos, direction, backlash):
+        if backlash:
+            self.move_to(pos - direction * backlash)
+        return self.move_to(pos)
+
+    # This function sets the travel velocity (mm/s) used by the following moves, the command is only sent if it changed.
+    def set_velocity(self, velocity):
+        if velocity != self.velocity:
+            self.send_command(f"1VA{velocity}")
+            self.velocity = velocity
+
+    # This function sets the acceleration (mm/s^2) used by the following moves, the command is only sent if it changed.
+    def set_acceleration(self, acceleration):
+        if acceleration != self.acceleration:
+            self.send_command(f"1AC{acceleration}")
+            self.acceleration = acceleration
+
+    # This function starts a move and returns immediately, use get_status_and_position/wait_for_motion to follow it.
+    def start_move(self, pos):
+        self.send_command(f"1PA{pos}")
+
+    # This function finds the stage position where read_signal() is largest between start and stop (e.g. the pump-probe overlap).
+    # The signal is read at every position right after the stage gets there: first a coarse sweep with coarse_step,
+    # then a golden-section search inside the bracket around the best coarse point until it is narrower than precision (mm).
+    # Returns (peak position, peak signal, list of every (measured position, signal) reading taken).
+    def find_peak(self, read_signal, start, stop, coarse_step, precision=0.005):
+        scan_trace.event("peak_search", start=start, stop=stop, coarse_step=coarse_step, precision=precision)
+        readings = []
+
+        def measure(pos):
+            actual = self.move_to(round(pos, 4))
+            value = read_signal()
+            readings.append((actual, value))
+            return value
+
+        # whole steps that fit between start and stop (never past stop), then stop itself if the steps don't land on it
+        count = int(abs(stop - start) / coarse_step + 1e-9) + 1
+        coarse = [start + i * coarse_step * (1 if stop >= start else -1) for i in range(count)]
+        if abs(coarse[-1] - stop) > 1e-9:
+            coarse.append(stop)
+        values = [measure(pos) for pos in coarse]
+        best = max(range(len(values)), key=values.__getitem__)
+        low = coarse[max(best - 1, 0)]
+        high = coarse[min(best + 1, len(coarse) - 1)]
+        if low > high:
+            low, high = high, low
+
+        # golden-section search, each round moves the stage once
+        ratio = (5 ** 0.5 - 1) / 2
+        left = high - ratio * (high - low)
+        right = low + ratio * (high - low)
+        left_value = measure(left)
+        right_value = measure(right)
+        while high - low > precision:
+            if left_value >= right_value:
+                high, right, right_value = right, left, left_value
+                left = high - ratio * (high - low)
+                left_value = measure(left)
+            else:
+                low, left, left_value = left, right, right_value
+                right = low + ratio * (high - low)
+                right_value = measure(right)
+
+        peak_pos, peak_value = max(readings, key=lambda reading: reading[1])
+        return peak_pos, peak_value, readings
+
     def home_stage(self):
-        self.send_command("1PA0")
-        self.read_response()
         self.send_command("1MO")
-        self.read_response()
-        self.send_command("1WS")
-        self.read_response()
-        
+        return self.move_to(0)
 
-    # This function closes the serial connection to the stage.
+    # This function stops the reader thread and closes the serial connection to the stage.
     def close(self):
-        self.ser.close()
\ No newline at end of file
+        self._closed.set()
+        self._reader.join(timeout=1.0)
+        with self._pending_lock:
+            for _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+        self.ser.close()
+
+    # This runs on the reader thread: it splits the incoming bytes into lines and hands each line
+    # to the oldest query with a matching prefix, or to the read_response queue if no query claims it.
+    def _read_loop(self):
+        buffer = b""
+        while not self._closed.is_set():
+            try:
+                chunk = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                break
+            if not chunk:
+                continue
+            buffer += chunk
+            while b"\n" in buffer:
+                raw, buffer = buffer.split(b"\n", 1)
+                line = raw.decode('ascii', errors='ignore').strip()
+                if line:
+                    log.debug("<<< %s", line)
+                    scan_trace.event("response", line=line)
+                    self._dispatch(line)
+
+    def _dispatch(self, line):
+        with self._pending_lock:
+            for i, (prefix, future) in enumerate(self._pending):
+                if line.startswith(prefix):
+                    del self._pending[i]
+                    future.set_result(line[len(prefix):].strip())
+                    return
+        self._responses.put(line)
+
+    def _forget(self, future):
+        with self._pending_lock:
+            self._pending = [(prefix, f) for prefix, f in self._pending if f is not future]
+
+
+# This function gives the time (s) a trapezoidal move of `distance` mm takes at the given velocity and acceleration.
+def move_time(distance, velocity, acceleration):
+    if distance <= 0:
+        return 0.0
+    ramp_time = velocity / acceleration
+    ramp_distance = 0.5 * acceleration * ramp_time ** 2
+    if 2 * ramp_distance >= distance:
+        return 2 * (distance / acceleration) ** 0.5
+    return 2 * ramp_time + (distance - 2 * ramp_distance) / velocity
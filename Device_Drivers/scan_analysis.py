@@ -0,0 +1,208 @@
+import numpy as np
+import sys
+from pathlib import Path
+
+"""
+Scan Analysis
+The pump-probe math shared by the lockin scripts, on NumPy arrays so the same functions work on one step while
+scanning and on a whole stored scan (any size, the ScanStore columns are memory-mapped) afterwards:
+
+    position_to_delay_ps  -> stage position (mm) to delay (ps), two-way (the beam goes to the retroreflector and back,
+                             so 1 mm of stage travel is 2 mm of path) or one-way, relative to a zero position
+    delay_ps_to_position  -> the other way round
+    normalize             -> dA = -(dT + dR) and dT, dR, dA in % of the reference transmission T_ref
+    fit_time_zero         -> time zero from a fit of the rise of the signal (error function rise, optionally with an
+                             exponential decay), falls back to the largest |signal| if the fit doesn't describe the data
+    reference_delays      -> fits time zero of a stored lockin scan and rewrites its delay column relative to it
+    block_mean            -> averages blocks of a large array down to a given size (fits, plots)
+
+The fit needs no SciPy: the shape parameters (time zero, rise width, decay) are found by a grid search that is zoomed
+in around the best point a few times, amplitude and offset are solved exactly (linear least squares) for every grid point.
+Re-analyse a stored scan (e.g. with one-way delays, or after changing the fit) with:
+
+    python Device_Drivers/scan_analysis.py <scan folder> [--one-way] [--argmax]
+
+"""
+
+# Speed of light used for all delays (m/s)
+SPEED_OF_LIGHT = 3e8
+
+# Scans with more points than this are averaged down (in position order) before fitting time zero
+FIT_POINTS = 1000
+
+
+# This function converts stage positions (mm, a number or an array) to delays (ps) relative to zero_mm.
+# two_way=True counts the stage travel twice (the path to the retroreflector and back).
+def position_to_delay_ps(position_mm, zero_mm=0.0, two_way=True):
+    path_mm = (np.asarray(position_mm, dtype=float) - zero_mm) * (2 if two_way else 1)
+    return (path_mm / 1000) / SPEED_OF_LIGHT * 1e12   # Convert mm to m, then to seconds, then to picoseconds
+
+
+# This function converts delays (ps) back to stage positions (mm), the inverse of position_to_delay_ps.
+def delay_ps_to_position(delay_ps, zero_mm=0.0, two_way=True):
+    path_mm = np.asarray(delay_ps, dtype=float) / 1e12 * SPEED_OF_LIGHT * 1000
+    return path_mm / (2 if two_way else 1) + zero_mm
+
+
+# This function gives {"dA_mV", "dT_pct", "dR_pct", "dA_pct"} from dT and dR (mV, numbers or arrays) and T_ref (mV).
+def normalize(dT, dR, T_ref):
+    dT = np.asarray(dT, dtype=float)
+    dR = np.asarray(dR, dtype=float)
+    dA = -(dT + dR)
+    return {"dA_mV": dA, "dT_pct": dT / T_ref * 100, "dR_pct": dR / T_ref * 100, "dA_pct": dA / T_ref * 100}
+
+
+# This function averages `values` down to at most `size` entries along `axis` (blocks of neighbouring entries, NaNs
+# ignored). Arrays that are already small enough are returned as they are.
+def block_mean(values, size, axis=0):
+    values = np.asarray(values, dtype=float)
+    n = values.shape[axis]
+    if n <= size:
+        return values
+    starts = np.linspace(0, n, size + 1).astype(int)[:-1]
+    finite = np.isfinite(values)
+    sums = np.add.reduceat(np.where(finite, values, 0.0), starts, axis=axis)
+    counts = np.add.reduceat(finite, starts, axis=axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+# This function is exp(a) * erfc(x) for arrays, without overflow where exp(a) alone would be huge.
+# erfc uses the Abramowitz & Stegun 7.1.26 approximation (error below 1.5e-7). exp(a - x**2) is passed in as tail_exp
+# (for the rise model below it is a Gaussian that never overflows).
+def _exp_erfc(a, x, tail_exp):
+    t = 1.0 / (1.0 + 0.3275911 * np.abs(x))
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    tail = poly * tail_exp                                  # exp(a) * erfc(|x|)
+    return np.where(x >= 0, tail, 2 * np.exp(np.minimum(a, 0.0)) - tail)
+
+
+# This function is the rise model with unit amplitude at offsets dx from time zero (mm): a step smoothed by a Gaussian
+# of width sigma (the pump-probe cross-correlation), times an exponential decay with rate (1/mm, 0 = no decay).
+# All arguments broadcast against each other.
+def rise_model(dx, sigma, rate):
+    a = -rate * dx + (rate * sigma) ** 2 / 2
+    x = (rate * sigma ** 2 - dx) / (sigma * np.sqrt(2))
+    return 0.5 * _exp_erfc(a, x, np.exp(-dx ** 2 / (2 * sigma ** 2)))
+
+
+# This function takes time zero at the largest |signal| and returns it in the form of a fit_time_zero result
+# (method "argmax", the fit values NaN).
+def argmax_time_zero(position_mm, signal):
+    x = np.asarray(position_mm, dtype=float)
+    y = np.asarray(signal, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    if not keep.any():
+        raise ValueError("no finite points to fit")
+    peak = float(x[keep][np.argmax(np.abs(y[keep]))])
+    return {"time_zero_mm": peak, "width_mm": np.nan, "decay_mm": np.nan, "amplitude": np.nan, "offset": np.nan,
+            "direction": 1, "r_squared": np.nan, "method": "argmax", "fit": None}
+
+
+# This function fits rise_model to (position, signal) for time zero and returns
+# {"time_zero_mm", "width_mm" (Gaussian sigma), "decay_mm" (inf = no decay), "amplitude", "offset", "direction"
+# (+1 if the signal rises towards larger positions), "r_squared", "method" ("fit", or "argmax" when the fit explains
+# less than min_r_squared of the variance), "fit" (the fitted signal at each position)}.
+# rounds is how many times the grid is zoomed in, the final resolution is far below the step size.
+def fit_time_zero(position_mm, signal, rounds=6, min_r_squared=0.5):
+    x = np.asarray(position_mm, dtype=float)
+    y = np.asarray(signal, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    argmax = argmax_time_zero(x, y)
+    if len(x) < 5 or np.ptp(y) == 0:
+        return argmax
+
+    # large scans are fitted on block averages (in position order), that keeps the grid search small
+    order = np.argsort(x, kind="stable")
+    xs, ys = block_mean(x[order], FIT_POINTS), block_mean(y[order], FIT_POINTS)
+    span = xs[-1] - xs[0]
+    step = np.min(np.diff(np.unique(xs))) if len(np.unique(xs)) > 1 else span
+    y_centered = ys - ys.mean()
+    total = float(np.sum(y_centered ** 2))
+
+    # grid: time zero (linear), log10 sigma, log10 decay rate (plus rate 0, a plain step), both directions
+    center = np.array([(xs[0] + xs[-1]) / 2, np.log10(max(span / 20, step / 2)), np.log10(1 / span)])
+    half = np.array([span / 2, 1.5, 1.5])
+    counts = (41, 9, 9)
+    best = None
+    for _ in range(rounds):
+        grids = [np.linspace(c - h, c + h, n) for c, h, n in zip(center, half, counts)]
+        # widths and decays much shorter than the step can't be told apart from the data (and make the fit run away)
+        grids[1] = np.maximum(grids[1], np.log10(step / 4))
+        grids[2] = np.minimum(grids[2], np.log10(4 / step))
+        rates = np.concatenate([[0.0], 10.0 ** grids[2]])
+        t0, rate = np.meshgrid(grids[0], rates, indexing="ij")
+        # one width at a time keeps the arrays at (time zeros x rates x points)
+        for log_sigma, direction in ((w, d) for w in grids[1] for d in (1, -1)):
+            dx = direction * (xs - t0[..., None])
+            f = rise_model(dx, 10.0 ** log_sigma, rate[..., None])
+            f_centered = f - f.mean(axis=-1, keepdims=True)
+            variance = np.sum(f_centered ** 2, axis=-1)
+            covariance = np.sum(f_centered * y_centered, axis=-1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                residual = np.where(variance > 1e-12, total - covariance ** 2 / variance, np.inf)
+            index = np.unravel_index(np.argmin(residual), residual.shape)
+            if best is None or residual[index] < best[0]:
+                best = (float(residual[index]), direction, t0[index], log_sigma, rate[index],
+                        covariance[index] / variance[index])
+        # zoom in: the new grid spans two old grid steps either side of the best point
+        center = np.array([best[2], best[3], np.log10(best[4]) if best[4] > 0 else center[2]])
+        half = 2 * np.array([g[1] - g[0] for g in grids])
+
+    residual, direction, time_zero, log_sigma, rate, amplitude = best
+    sigma = 10.0 ** log_sigma
+    shape = rise_model(direction * (x - time_zero), sigma, rate)
+    offset = float(np.mean(y) - amplitude * np.mean(shape))
+    r_squared = 1 - residual / total
+    if not r_squared >= min_r_squared:
+        return dict(argmax, r_squared=r_squared)
+    return {"time_zero_mm": float(time_zero), "width_mm": float(sigma), "decay_mm": float(1 / rate) if rate > 0 else np.inf,
+            "amplitude": float(amplitude), "offset": offset, "direction": direction, "r_squared": float(r_squared),
+            "method": "fit", "fit": amplitude * shape + offset}
+
+
+# This function finds time zero of a stored lockin scan (a ScanStore opened for writing) from its dT column and
+# rewrites the delay column relative to it. method="fit" uses fit_time_zero, "argmax" the largest |dT| like before.
+# The result is saved in the scan metadata (time_zero_mm) and returned.
+def reference_delays(store, two_way=True, method="fit"):
+    targets = np.asarray(store.column("target_mm"), dtype=float)
+    dT = np.asarray(store.column("dT_mV"), dtype=float)
+    result = fit_time_zero(targets, dT) if method == "fit" else argmax_time_zero(targets, dT)
+    time_zero = result["time_zero_mm"]
+    store.column("delay_ps")[:] = position_to_delay_ps(targets, time_zero, two_way)
+    store.update_metadata(time_zero_mm=time_zero, two_way_delay=two_way,
+                          time_zero_fit={name: value for name, value in result.items() if name != "fit"})
+    return result
+
+
+# This function formats a fit_time_zero result for printing.
+def format_time_zero(result, two_way=True):
+    if result["method"] != "fit":
+        return f"Time zero at {result['time_zero_mm']:.4f} mm (largest |dT|, the rise fit didn't describe the data)"
+    width_ps = float(position_to_delay_ps(result["width_mm"], two_way=two_way))
+    decay = (f"decay {float(position_to_delay_ps(result['decay_mm'], two_way=two_way)):.2f} ps"
+             if np.isfinite(result["decay_mm"]) else "no decay")
+    return (f"Time zero at {result['time_zero_mm']:.4f} mm (rise fit: width {width_ps:.3f} ps, {decay}, "
+            f"amplitude {result['amplitude']:.3f} mV, R^2 {result['r_squared']:.3f})")
+
+
+if __name__ == "__main__":
+    from scan_store import ScanStore
+
+    if len(sys.argv) < 2 or sys.argv[1].startswith("-"):
+        print("Usage: python scan_analysis.py <scan folder> [--one-way] [--argmax]")
+        sys.exit(1)
+    store = ScanStore(sys.argv[1])
+    if "dT_mV" not in store.columns:
+        print(f"{sys.argv[1]} is not a lockin scan (no dT column)")
+        sys.exit(1)
+    two_way = "--one-way" not in sys.argv
+    T_ref = store.metadata.get("summary", {}).get("Absolute Transmission")
+    if T_ref:
+        # recalculated in bulk from the stored dT and dR
+        for name, values in normalize(store.column("dT_mV"), store.column("dR_mV"), T_ref).items():
+            store.column(name)[:] = values
+    print(format_time_zero(reference_delays(store, two_way, "argmax" if "--argmax" in sys.argv else "fit"), two_way))
+    store.close()
+    print(f"Updated {len(store)} rows in {Path(sys.argv[1])}")
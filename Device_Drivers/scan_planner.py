@@ -0,0 +1,97 @@
+import math
+
+"""
+Scan Planning
+Builds the list of stage positions for a scan.
+
+uniform_positions -> the evenly spaced positions the scripts have always used
+serpentine_order  -> repeated passes over the same positions, every other pass backwards
+AdaptivePlanner   -> a coarse pass first, then extra points where the signal is large or changes fastest,
+                     until a total point budget is used up
+
+"""
+
+# This function gives `steps` evenly spaced positions from start to end (inclusive), rounded to `decimals`.
+def uniform_positions(start, end, steps, decimals=2):
+    step_size = (end - start) / (steps - 1)
+    return [round(start + i * step_size, decimals) for i in range(steps)]
+
+
+# This function gives the (pass, index, position) visiting order for `passes` repeats of the positions.
+# Every other pass runs backwards, so the stage never has to travel back to the start between passes.
+# first_pass skips the passes already done (e.g. when resuming an interrupted scan).
+def serpentine_order(positions, passes, first_pass=0):
+    for scan_pass in range(first_pass, passes):
+        indices = range(len(positions)) if scan_pass % 2 == 0 else range(len(positions) - 1, -1, -1)
+        for index in indices:
+            yield scan_pass, index, positions[index]
+
+
+class AdaptivePlanner:
+    # coarse_steps evenly spaced points are measured first, then points are added one at a time
+    # until `budget` points have been measured in total.
+    # A new point goes in the middle of the interval with the largest score:
+    #   score = length of the interval on the (position, signal) curve, both axes scaled to their full range
+    #           + amplitude_weight * (scaled interval width) * (largest |signal| at either end, scaled)
+    # so steep parts (the rise at time zero) and large signals (fast dynamics after it) get the extra points,
+    # while the flat baseline before time zero keeps roughly the coarse spacing.
+    # Intervals narrower than 2 * min_step are never split.
+    def __init__(self, start, end, coarse_steps, budget, min_step=0.01, amplitude_weight=1.0, decimals=2):
+        if coarse_steps < 2:
+            raise ValueError("The coarse pass needs at least 2 steps")
+        self.start = start
+        self.end = end
+        self.budget = max(budget, coarse_steps)
+        self.min_step = min_step
+        self.amplitude_weight = amplitude_weight
+        self.decimals = decimals
+        self.positions = []          # measured positions in the order they were measured
+        self.values = []
+        self._coarse = uniform_positions(start, end, coarse_steps, decimals)
+        self._measured = {}
+
+    # This function gives the next position to measure, or None when the budget is used up
+    # (or no interval can be split any more).
+    def next_position(self):
+        if len(self.positions) >= self.budget:
+            return None
+        for pos in self._coarse:
+            if pos not in self._measured:
+                return pos
+        return self._best_split()
+
+    # Iterating over the planner gives the positions one by one, add() must be called for each before asking for the next.
+    def __iter__(self):
+        pos = self.next_position()
+        while pos is not None:
+            yield pos
+            pos = self.next_position()
+
+    # This function records the signal measured at a position (e.g. dT in mV) so the next position can be chosen.
+    def add(self, pos, value):
+        self.positions.append(pos)
+        self.values.append(value)
+        self._measured[pos] = value
+
+    def _best_split(self):
+        points = sorted(self._measured.items())
+        if len(points) < 2:
+            return None
+        values = [value for _, value in points]
+        x_range = abs(self.end - self.start) or 1.0
+        y_range = (max(values) - min(values)) or 1.0
+        y_scale = max(abs(value) for value in values) or 1.0
+
+        best, best_score = None, -1.0
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if x1 - x0 < 2 * self.min_step:
+                continue
+            middle = round((x0 + x1) / 2, self.decimals)
+            if middle in self._measured or middle <= x0 or middle >= x1:
+                continue
+            dx = (x1 - x0) / x_range
+            dy = (y1 - y0) / y_range
+            score = math.hypot(dx, dy) + self.amplitude_weight * dx * max(abs(y0), abs(y1)) / y_scale
+            if score > best_score:
+                best, best_score = middle, score
+        return best
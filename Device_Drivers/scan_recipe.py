@@ -0,0 +1,139 @@
+from .scan_planner import uniform_positions
+from pathlib import Path
+import math
+import yaml
+
+"""
+Scan Recipes
+Lockin scans described in a YAML file instead of answered at the input() prompts, so a series of scans can run
+unattended (see lockin/batch_runner.py). A recipe file is a list of scans, or defaults shared by its scans:
+
+    defaults:
+      references: previous        # reuse the references of the scan before (no prompts)
+      export: xlsx
+    scans:
+      - name: coarse
+        start_mm: 45
+        end_mm: 55
+        steps: 101
+        references: measure       # prompts for the sample like the scripts do (first scan of a series)
+      - name: fine
+        start_mm: 49.5
+        end_mm: 51
+        steps: 151
+        passes: 4                 # back-and-forth repeats averaged per point
+        backlash: 0.05
+        repeat: 3                 # three scans of this recipe, each in its own folder
+
+Keys (defaults in RECIPE_DEFAULTS):
+    name            -> added to the scan folder name (default: the file name and the scan number)
+    start_mm, end_mm, steps, decimals  -> evenly spaced positions (decimals: rounding in mm, by default one digit
+                       finer than the step), or
+    positions       -> an explicit list of positions (mm), not for adaptive scans (they pick their own positions
+                       between start_mm and end_mm, rounded to decimals)
+    mode            -> step, fly (needs fly_velocity in mm/s) or adaptive (needs budget, the total number of points)
+    passes, backlash -> repeated back-and-forth passes for step scans
+    references      -> measure (prompts), previous, a scan folder to copy them from, or
+                       {T_ref: ..., NormT: ..., NormR: ...} in mV
+    target_sem      -> precision of measured references (mV)
+    export          -> n, xlsx, csv or npz, written into the scan folder
+    repeat          -> how many times to run the scan
+
+"""
+
+RECIPE_DEFAULTS = {"name": None, "start_mm": None, "end_mm": None, "steps": None, "decimals": None, "positions": None,
+                   "mode": "step", "fly_velocity": None, "budget": None, "passes": 1, "backlash": 0.0,
+                   "references": "previous", "target_sem": 0.01, "export": "n", "repeat": 1}
+MODES = ("step", "fly", "adaptive")
+EXPORTS = ("n", "xlsx", "csv", "npz")
+
+
+# This function reads recipe files and gives one checked recipe (a dict with every key) per scan to run, in order,
+# with repeats expanded. Mistakes raise ValueError naming the file and scan, before any instrument is touched.
+def load_recipes(paths):
+    recipes = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            content = yaml.safe_load(f) or []
+        if isinstance(content, dict) and "scans" in content:
+            defaults, scans = content.get("defaults") or {}, content["scans"]
+        elif isinstance(content, dict):
+            defaults, scans = {}, [content]
+        else:
+            defaults, scans = {}, content
+        for number, scan in enumerate(scans, 1):
+            source = f"{Path(path).name}, scan {number}"
+            if not isinstance(scan, dict):
+                raise ValueError(f"{source}: expected the settings of a scan, got {scan!r}")
+            recipe = check_recipe({**RECIPE_DEFAULTS, **defaults, **scan}, source)
+            if recipe["name"] is None:
+                recipe["name"] = f"{Path(path).stem}_{number}"
+            for repeat in range(recipe["repeat"]):
+                name = recipe["name"] if recipe["repeat"] == 1 else f"{recipe['name']}_{repeat + 1}"
+                recipes.append(dict(recipe, name=name, source=source))
+    return recipes
+
+
+# This function checks one recipe (defaults already filled in) and works out its positions.
+def check_recipe(recipe, source="recipe"):
+    unknown = set(recipe) - set(RECIPE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"{source}: unknown keys {sorted(unknown)} (known: {sorted(RECIPE_DEFAULTS)})")
+    try:
+        explicit = recipe["positions"] is not None
+        if explicit:
+            recipe["positions"] = [float(pos) for pos in recipe["positions"]]
+            if len(recipe["positions"]) < 2:
+                raise ValueError("positions needs at least 2 entries")
+            recipe["start_mm"], recipe["end_mm"] = recipe["positions"][0], recipe["positions"][-1]
+            recipe["steps"] = len(recipe["positions"])
+        else:
+            if None in (recipe["start_mm"], recipe["end_mm"], recipe["steps"]):
+                raise ValueError("needs start_mm, end_mm and steps (or positions)")
+            recipe["steps"] = int(recipe["steps"])
+            if recipe["steps"] < 2:
+                raise ValueError("steps should be at least 2")
+            start, end = float(recipe["start_mm"]), float(recipe["end_mm"])
+            if recipe["decimals"] is None:
+                step = abs(end - start) / (recipe["steps"] - 1)
+                recipe["decimals"] = max(2, math.ceil(-math.log10(step)) + 1) if step > 0 else 2
+            recipe["positions"] = uniform_positions(start, end, recipe["steps"], int(recipe["decimals"]))
+        if len(set(recipe["positions"])) != len(recipe["positions"]):
+            raise ValueError("positions repeat (steps finer than decimals?), use passes or repeat to measure a point again")
+        if recipe["mode"] not in MODES:
+            raise ValueError(f"mode should be one of {MODES}")
+        if recipe["mode"] == "fly" and not recipe["fly_velocity"]:
+            raise ValueError("fly scans need fly_velocity (mm/s)")
+        if recipe["mode"] == "adaptive" and explicit:
+            raise ValueError("adaptive scans pick their own positions, give start_mm, end_mm and steps instead of positions")
+        if recipe["mode"] == "adaptive" and (recipe["budget"] or 0) < recipe["steps"]:
+            raise ValueError("adaptive scans need a budget of at least steps points")
+        if recipe["mode"] != "step" and int(recipe["passes"]) > 1:
+            raise ValueError("repeated passes only work with step scans")
+        if str(recipe["export"]) not in EXPORTS and recipe["export"] is not False:
+            raise ValueError(f"export should be one of {EXPORTS}")
+        references = recipe["references"]
+        if isinstance(references, dict) and set(references) != {"T_ref", "NormT", "NormR"}:
+            raise ValueError("references should give T_ref, NormT and NormR (mV)")
+        if isinstance(references, str) and references not in ("measure", "previous") and not (Path(references) / "metadata.json").exists():
+            raise ValueError(f"references should be measure, previous, a scan folder or values, {references} is none of these")
+        if int(recipe["repeat"]) < 1:
+            raise ValueError("repeat should be at least 1")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{source}: {e}") from None
+    recipe["export"] = "n" if recipe["export"] is False else str(recipe["export"])
+    recipe["passes"], recipe["repeat"] = int(recipe["passes"]), int(recipe["repeat"])
+    return recipe
+
+
+# This function gives the scan plan (as saved in the scan folder, see lockinV1.create_scan) for a recipe.
+def recipe_plan(recipe):
+    passes, mode = recipe["passes"], recipe["mode"]
+    return {
+        "start_mm": recipe["start_mm"], "end_mm": recipe["end_mm"], "steps": recipe["steps"],
+        "mode": "serpentine" if mode == "step" and passes > 1 else mode,
+        "positions": recipe["positions"],
+        "settings": {"fly_velocity": recipe["fly_velocity"], "budget": recipe["budget"] if mode == "adaptive" else recipe["steps"],
+                     "passes": passes, "backlash": float(recipe["backlash"]) if passes > 1 else 0.0, "decimals": recipe["decimals"],
+                     "export_excel": False, "export": recipe["export"], "recipe": recipe["name"]},
+    }
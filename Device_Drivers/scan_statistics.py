@@ -0,0 +1,72 @@
+import numpy as np
+import os
+
+"""
+Scan Statistics
+Online (Welford) mean and variance per scan point, so repeated passes can be averaged
+without keeping every pass in memory.
+
+"""
+class RunningStats:
+    # size is the number of scan points, channels the number of values recorded at each point
+    # (e.g. 3 for position, dT, dR or the number of pixels for a spectrum).
+    def __init__(self, size, channels=1):
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros((size, channels), dtype=np.float64)
+        self._m2 = np.zeros((size, channels), dtype=np.float64)
+
+    # This function adds one reading (a value or an array with one value per channel) to scan point `index`.
+    def add(self, index, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        self.count[index] += 1
+        delta = values - self.mean[index]
+        self.mean[index] += delta / self.count[index]
+        self._m2[index] += delta * (values - self.mean[index])
+
+    # This function adds a block of readings (one row per reading) to scan point `index` in one step
+    # (the parallel form of Welford's update by Chan et al., e.g. all frames of a spectrometer burst).
+    def add_many(self, index, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.mean.shape[1])
+        count = len(values)
+        if count == 0:
+            return
+        block_mean = values.mean(axis=0)
+        block_m2 = ((values - block_mean) ** 2).sum(axis=0)
+        total = self.count[index] + count
+        delta = block_mean - self.mean[index]
+        self.mean[index] += delta * count / total
+        self._m2[index] += block_m2 + delta ** 2 * self.count[index] * count / total
+        self.count[index] = total
+
+    # This function gives the sample variance per point and channel (NaN where a point has fewer than 2 readings).
+    def variance(self):
+        counts = self.count[:, None]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 1, self._m2 / (counts - 1), np.nan)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    # This function gives the standard error of each mean.
+    def std_error(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.std() / np.sqrt(self.count[:, None])
+
+    # This function saves the running sums to a .npz file (written to a temporary file and renamed, so it is never half written).
+    def save(self, path):
+        temporary = str(path) + ".tmp"
+        with open(temporary, "wb") as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self._m2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    # This function loads running sums saved with save(), so averaging can carry on where it stopped.
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            stats = cls(*data["mean"].shape)
+            stats.count[:] = data["count"]
+            stats.mean[:] = data["mean"]
+            stats._m2[:] = data["m2"]
+        return stats
@@ -0,0 +1,220 @@
+import json
+import numpy as np
+import os
+import sys
+from pathlib import Path
+
+"""
+Scan Storage
+Writes every scan step to disk the moment it is measured, so a crash or Ctrl-C keeps everything up to the last step.
+
+A scan is a folder:
+    metadata.json       -> header: the columns (dtype and shape per row) and how many rows are filled
+    scan_metadata.json  -> free-form metadata such as the scan settings, positions and reference values
+    <column>.npy        -> one preallocated, memory-mapped NumPy array per column (one row per scan step)
+    <name>.npy          -> extra arrays stored once for the whole scan (e.g. the wavelength axis)
+
+The row count in metadata.json is only updated after the row itself has been flushed to disk,
+so a reader never sees a half-written row. The header is rewritten for every row, so it stays small: the metadata
+(which can hold every position of the scan) is only written when it changes. Excel, CSV or NumPy (.npz) files are made
+afterwards from the folder:
+
+    python Device_Drivers/scan_store.py <scan folder> <output.xlsx | output.csv | output.npz>
+
+"""
+class ScanStore:
+    # This opens an existing scan folder, use ScanStore.create to start a new one.
+    def __init__(self, path, mode="r+"):
+        self.path = Path(path)
+        self.mode = mode
+        with open(self.path / "metadata.json") as f:
+            header = json.load(f)
+        self._column_specs = header["columns"]
+        self.columns = {name: (np.dtype(spec["dtype"]), tuple(spec["shape"])) for name, spec in header["columns"].items()}
+        self.count = header["count"]
+        self.capacity = header["capacity"]
+        if (self.path / "scan_metadata.json").exists():
+            with open(self.path / "scan_metadata.json") as f:
+                self.metadata = json.load(f)
+        else:
+            self.metadata = {}
+        self._arrays = {name: np.load(self._column_file(name), mmap_mode=mode) for name in self.columns}
+
+    # This function makes a new scan folder with room for `capacity` rows (it grows by doubling if more are appended).
+    # columns maps a column name to a dtype, or to (dtype, shape) for rows that are arrays (e.g. one spectrum per step).
+    @classmethod
+    def create(cls, path, columns, capacity=1024, metadata=None):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=False)
+        specs = {}
+        for name, spec in columns.items():
+            dtype, shape = spec if isinstance(spec, tuple) else (spec, ())
+            shape = (shape,) if isinstance(shape, int) else tuple(shape)
+            specs[name] = {"dtype": np.dtype(dtype).str, "shape": list(shape)}
+            array = np.lib.format.open_memmap(path / f"{name}.npy", mode="w+", dtype=np.dtype(dtype), shape=(capacity,) + shape)
+            array.flush()
+            del array
+        _write_json(path / "scan_metadata.json", metadata or {})
+        _write_json(path / "metadata.json", {"columns": specs, "count": 0, "capacity": capacity})
+        return cls(path)
+
+    def __len__(self):
+        return self.count
+
+    # This function writes one scan step (a value for every column) and makes it durable before returning.
+    def append(self, row):
+        if self.count == self.capacity:
+            self._grow(self.capacity * 2)
+        for name, array in self._arrays.items():
+            array[self.count] = row[name]
+            array.flush()
+        self.count += 1
+        self._write_header()
+
+    # This function gives the filled rows of a column (a view onto the file, no copy).
+    def column(self, name):
+        return self._arrays[name][:self.count]
+
+    # This function adds or replaces entries in the free-form metadata (saved immediately).
+    def update_metadata(self, **values):
+        self.metadata.update(values)
+        self._write_metadata()
+
+    # These functions keep extra arrays that belong to the whole scan rather than to one step (e.g. the wavelength axis).
+    def save_array(self, name, values):
+        np.save(self.path / f"{name}.npy", np.asarray(values))
+
+    def load_array(self, name):
+        return np.load(self.path / f"{name}.npy")
+
+    # This function writes changes made through column() views to disk.
+    def flush(self):
+        for array in self._arrays.values():
+            array.flush()
+
+    # This function gives the columns as a pandas DataFrame (optionally only some, optionally renamed, optionally sorted by a column).
+    # Without names, the columns listed in headers are used (all columns if there are no headers).
+    # Array columns (e.g. a spectrum per step) become one DataFrame column per element, their header is a list of names.
+    def to_dataframe(self, names=None, headers=None, sort_by=None):
+        import pandas as pd
+        order = self._order(sort_by)
+        headers = headers or {}
+        names = names or list(headers) or list(self.columns)
+        return pd.concat([pd.DataFrame(values, columns=column_headers) for values, column_headers in self._table(names, headers, order)], axis=1)
+
+    # This function writes the scan to an Excel file: a summary table (e.g. reference values) and the data table next to it.
+    # headers and summary default to the "headers" and "summary" entries of the metadata, if the scan saved them.
+    def export_excel(self, path, names=None, headers=None, summary=None, sort_by=None, sheet_name="Sheet1"):
+        import pandas as pd
+        headers = headers if headers is not None else self.metadata.get("headers")
+        summary = summary if summary is not None else self.metadata.get("summary")
+        table = self.to_dataframe(names, headers, sort_by)
+        with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+            startcol = 0
+            if summary:
+                pd.DataFrame([list(summary.values())], columns=list(summary.keys())).to_excel(writer, index=False, startrow=0, startcol=0, sheet_name=sheet_name)
+                startcol = len(summary) + 1
+            table.to_excel(writer, index=False, startrow=0, startcol=startcol, sheet_name=sheet_name)
+
+    # This function writes the columns to a CSV file with a header line (names and headers as for to_dataframe).
+    # A block of rows is formatted with a single % operation (one format string per block, no Python loop over values),
+    # which keeps scans with a whole spectrum per step fast. float32 columns get 7 significant digits, float64 ones 10.
+    def export_csv(self, path, names=None, headers=None, sort_by=None, block=64):
+        headers = headers if headers is not None else (self.metadata.get("headers") or {})
+        names = names or list(headers) or list(self.columns)
+        order = self._order(sort_by)
+        table = self._table(names, headers, order)
+        row_format = ",".join(_text_format(values.dtype) for values, column_headers in table for _ in column_headers) + "\n"
+        with open(path, "w", newline="") as f:
+            f.write(",".join(column for _, column_headers in table for column in column_headers) + "\n")
+            for start in range(0, self.count, block):
+                rows = np.hstack([values[start:start + block].astype(np.float64) for values, _ in table])
+                f.write(row_format * len(rows) % tuple(rows.ravel().tolist()))
+
+    # This function writes the columns and the whole-scan arrays (e.g. the wavelength axis) to one NumPy .npz file,
+    # the fastest way to hand a scan to other analysis code (np.load gives the arrays back unchanged).
+    def export_npz(self, path, names=None, sort_by=None):
+        order = self._order(sort_by)
+        arrays = {name: np.asarray(self.column(name))[order] for name in (names or self.columns)}
+        for extra in sorted(self.path.glob("*.npy")):
+            if extra.stem not in self.columns:
+                arrays[extra.stem] = np.load(extra)
+        np.savez(path, **arrays)
+
+    def close(self):
+        for array in self._arrays.values():
+            if self.mode != "r":
+                array.flush()
+        self._arrays = {}
+
+    # Row order for exports: as measured, or sorted by a column (e.g. adaptive scans sorted by position).
+    def _order(self, sort_by):
+        if sort_by is None:
+            return slice(None)
+        return np.argsort(self.column(sort_by), kind="stable")
+
+    # Each column as a 2D block of rows with its list of headers.
+    def _table(self, names, headers, order):
+        table = []
+        for name in names:
+            values = np.asarray(self.column(name))[order].reshape(self.count, -1)
+            column_headers = headers.get(name, name)
+            if isinstance(column_headers, str):
+                column_headers = [column_headers] if values.shape[1] == 1 else [f"{column_headers} {k}" for k in range(values.shape[1])]
+            table.append((values, list(column_headers)))
+        return table
+
+    def _column_file(self, name):
+        return self.path / f"{name}.npy"
+
+    def _write_header(self):
+        _write_json(self.path / "metadata.json", {"columns": self._column_specs, "count": self.count, "capacity": self.capacity})
+
+    def _write_metadata(self):
+        _write_json(self.path / "scan_metadata.json", self.metadata)
+
+    # This function copies every column into a bigger file and swaps it in.
+    def _grow(self, capacity):
+        for name, (dtype, shape) in self.columns.items():
+            old = self._arrays.pop(name)
+            grown_file = self.path / f"{name}.grow.npy"
+            grown = np.lib.format.open_memmap(grown_file, mode="w+", dtype=dtype, shape=(capacity,) + shape)
+            grown[:self.count] = old[:self.count]
+            grown.flush()
+            del grown, old
+            os.replace(grown_file, self._column_file(name))
+            self._arrays[name] = np.load(self._column_file(name), mmap_mode=self.mode)
+        self.capacity = capacity
+        self._write_header()
+
+
+# printf style format for one value of a column in text exports.
+def _text_format(dtype):
+    if dtype.kind in "iub":
+        return "%d"
+    return "%.7g" if dtype.itemsize <= 4 else "%.10g"
+
+
+# The header and the metadata are written to a temporary file and renamed over the old one, so they are never half written.
+def _write_json(path, data):
+    temporary = Path(str(path) + ".tmp")
+    with open(temporary, "w") as f:
+        json.dump(data, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python scan_store.py <scan folder> <output.xlsx | output.csv | output.npz>")
+        sys.exit(1)
+    store = ScanStore(sys.argv[1], mode="r")
+    suffix = Path(sys.argv[2]).suffix.lower()
+    if suffix == ".csv":
+        store.export_csv(sys.argv[2])
+    elif suffix == ".npz":
+        store.export_npz(sys.argv[2])
+    else:
+        store.export_excel(sys.argv[2])
+    print(f"Exported {len(store)} rows to {sys.argv[2]}")
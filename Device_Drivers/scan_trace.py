@@ -0,0 +1,164 @@
+from collections import deque
+import contextlib
+import json
+import numpy as np
+from pathlib import Path
+import threading
+import time
+
+"""
+Scan Trace
+Timing of every phase of a scan, recorded by the drivers and the scan scripts while they run:
+
+    command / response -> each line sent to / received from the delay stage (events, no duration)
+    query              -> command sent until its reply arrived
+    motion             -> move command sent until the controller reports the stage in position
+    settle             -> extra dwell after a move
+    read               -> a lock-in or spectrometer reading
+    compute            -> calculations on a step in the scan script
+    persist            -> writing a step to the ScanStore
+    plot               -> updating the plots
+
+start_trace(path) switches tracing on; every event is then written as one JSON line (time.monotonic() seconds since
+the trace started in "t", duration in "dt" for phases, the thread, and the event's own fields) to the path, normally
+trace.jsonl in the scan folder. Events are buffered and written in blocks, so tracing can stay on during real scans
+(around 10 microseconds per event). stop_trace() writes the rest and a last "summary" line (count, total, mean and
+percentiles per phase) and returns that summary. With tracing off, event() and phase() do next to nothing.
+
+    start_trace(scan_dir / "trace.jsonl")
+    with phase("compute"):
+        ...
+    print(format_summary(stop_trace()))
+
+"""
+
+# Percentiles in the summary
+PERCENTILES = (50, 90, 99)
+
+_active = None          # the running ScanTrace, None while tracing is off
+_off = contextlib.nullcontext()
+
+
+class ScanTrace:
+    # path is the JSON-lines file (appended to, so a resumed scan adds to its trace), None keeps only the summary.
+    # flush_every is how many events are buffered before they are written.
+    def __init__(self, path=None, flush_every=1000):
+        self.path = Path(path) if path is not None else None
+        self.flush_every = flush_every
+        self.start = time.monotonic()
+        self.durations = {}             # phase -> durations (s)
+        self.counts = {}                # event -> how many
+        self._events = deque()
+        self._flush_lock = threading.Lock()
+        self._count_lock = threading.Lock()     # events come from several threads (scan loop, instrument workers)
+        self._file = open(self.path, "a", encoding="utf-8") if self.path is not None else None
+        self.event("trace_start", time=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    # This function records an event that has no duration (e.g. a command sent).
+    def event(self, name, **fields):
+        with self._count_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+        self._events.append((time.monotonic(), None, name, threading.current_thread().name, fields))
+        if len(self._events) >= self.flush_every:
+            self.flush()
+
+    # This function records a phase that started at `start` (time.monotonic()) and took `duration` seconds.
+    def record(self, name, start, duration, **fields):
+        with self._count_lock:
+            self.durations.setdefault(name, []).append(duration)
+        self._events.append((start, duration, name, threading.current_thread().name, fields))
+        if len(self._events) >= self.flush_every:
+            self.flush()
+
+    # This function times the code inside the with block as one phase.
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic() - start, **fields)
+
+    # This function writes the buffered events to the trace file.
+    def flush(self):
+        with self._flush_lock:
+            lines = []
+            while self._events:
+                t, duration, name, thread, fields = self._events.popleft()
+                entry = {"t": round(t - self.start, 6), "event": name, "thread": thread}
+                if duration is not None:
+                    entry["dt"] = round(duration, 6)
+                entry.update(fields)
+                lines.append(json.dumps(entry, default=str))
+            if self._file is not None and lines:
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+
+    # This function gives {"phases": {phase: {"count", "total_s", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"}},
+    # "events": {event: count}, "elapsed_s": time since the trace started}.
+    def summary(self):
+        with self._count_lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+            counts = dict(self.counts)
+        phases = {}
+        for name, values in durations.items():
+            ms = np.asarray(values) * 1000
+            phases[name] = {"count": len(ms), "total_s": round(float(ms.sum()) / 1000, 6), "mean_ms": float(ms.mean()),
+                            **{f"p{p}_ms": float(np.percentile(ms, p)) for p in PERCENTILES}, "max_ms": float(ms.max())}
+        events = {name: count for name, count in counts.items() if name != "trace_start"}
+        return {"phases": phases, "events": events, "elapsed_s": time.monotonic() - self.start}
+
+    # This function writes everything left and the summary line, then closes the file. Returns the summary.
+    def close(self):
+        summary = self.summary()
+        self.flush()
+        with self._flush_lock:
+            if self._file is not None:
+                self._file.write(json.dumps({"t": round(summary["elapsed_s"], 6), "event": "summary", **summary}) + "\n")
+                self._file.close()
+                self._file = None
+        return summary
+
+
+# This function switches tracing on (stopping any trace already running) and returns the new ScanTrace.
+def start_trace(path=None, flush_every=1000):
+    global _active
+    stop_trace()
+    _active = ScanTrace(path, flush_every)
+    return _active
+
+
+# This function switches tracing off and returns the summary (None if no trace was running).
+def stop_trace():
+    global _active
+    trace, _active = _active, None
+    return trace.close() if trace is not None else None
+
+
+# These go to the running trace, and do nothing while tracing is off. _active is read once, as stop_trace may clear it
+# from another thread in between (an event that arrives after the trace closed is dropped).
+def event(name, **fields):
+    trace = _active
+    if trace is not None:
+        trace.event(name, **fields)
+
+
+def phase(name, **fields):
+    trace = _active
+    if trace is not None:
+        return trace.phase(name, **fields)
+    return _off
+
+
+# This function formats a summary as a table for printing.
+def format_summary(summary):
+    if not summary:
+        return "No trace recorded."
+    lines = [f"Timing over {summary['elapsed_s']:.1f} s (ms):",
+             f"  {'phase':10s} {'count':>7s} {'total s':>9s} {'mean':>9s} {'p50':>9s} {'p90':>9s} {'p99':>9s} {'max':>9s}"]
+    for name, stats in sorted(summary["phases"].items(), key=lambda item: -item[1]["total_s"]):
+        lines.append(f"  {name:10s} {stats['count']:7d} {stats['total_s']:9.2f} {stats['mean_ms']:9.3f} {stats['p50_ms']:9.3f} "
+                     f"{stats['p90_ms']:9.3f} {stats['p99_ms']:9.3f} {stats['max_ms']:9.3f}")
+    if summary["events"]:
+        lines.append("  events: " + ", ".join(f"{name} {count}" for name, count in summary["events"].items()))
+    return "\n".join(lines)
@@ -0,0 +1,522 @@
+from .move_stage_driver import move_time
+import math
+import numpy as np
+import os
+import threading
+import time
+try:
+    import select
+    import tty
+except ImportError:
+    tty = None                  # no ptys on Windows, FakeDL225(transport="loop") still works
+
+"""
+Simulated Instruments For Offline Development
+These objects stand in for the real hardware so the drivers can be exercised without a lab.
+
+PumpProbeSignal -> the sample: dT/T as a function of the stage position (erf rise at time zero, exponential decay)
+FakeDAQServer   -> in-process replacement for zhinst's ziDAQServer, pass it to UHFLI(daq=FakeDAQServer())
+FakeDL225       -> DL225 controller speaking the ASCII protocol, pass NewPort_Delay_Stage_225(port=FakeDL225().port)
+                   on a pty (Linux/macOS) or, with transport="loop", on an in-process serial port (any OS)
+FakeStellarNet  -> stand-in for the stellarnet_driver3 module, use an instance wherever the scripts use `sn`
+SimulatedLab    -> all of the above wired together: the lock-in and the spectrometer see the signal at the fake stage's
+                   position, so whole scans can be run, profiled and tested without the lab (the scripts' --simulate)
+
+"""
+class PumpProbeSignal:
+    # dT/T = amplitude * (1 + erf(t / rise_ps)) / 2 * exp(-t / decay_ps) at the delay t (ps) from time zero,
+    # with t worked out from the stage position the same way the scripts do (two-way path, 2 * mm / c).
+    # The spectrometer sees it as a Gaussian band (center_nm, width_nm) across the spectrum.
+    def __init__(self, time_zero_mm=50.0, amplitude=0.01, rise_ps=0.3, decay_ps=3.0, center_nm=650.0, width_nm=80.0):
+        self.time_zero_mm = time_zero_mm
+        self.amplitude = amplitude
+        self.rise_ps = rise_ps
+        self.decay_ps = decay_ps
+        self.center_nm = center_nm
+        self.width_nm = width_nm
+
+    def delay_ps(self, position_mm):
+        return (2 * (np.asarray(position_mm, dtype=np.float64) - self.time_zero_mm) / 1000) / 3e8 * 1e12
+
+    # This function gives dT/T at one or many stage positions (mm).
+    def at(self, position_mm):
+        t = self.delay_ps(position_mm)
+        step = 0.5 * (1 + np.vectorize(math.erf, otypes=[float])(t / self.rise_ps))
+        return self.amplitude * step * np.exp(-np.clip(t, 0, None) / self.decay_ps)
+
+    # This function gives the relative strength of the signal at each wavelength (1 at center_nm).
+    def spectrum(self, wavelengths):
+        return np.exp(-0.5 * ((np.asarray(wavelengths, dtype=np.float64) - self.center_nm) / self.width_nm) ** 2)
+
+
+class FakeDAQServer:
+    # This is the constructor for the fake server.
+    # boxcar_levels are the mean boxcar outputs in volts per channel, noise is the standard deviation in volts
+    # and sample_rate is how many boxcar samples per second the streaming nodes produce.
+    # With realtime=True poll() sleeps for the recording time like the real server does.
+    # demod_levels are the (x, y) outputs in volts per demodulator.
+    # With a signal (PumpProbeSignal) and a stage (FakeDL225) the boxcars in signal_channels read level * (1 + dT/T)
+    # at the stage position when each sample was taken, so step and fly scans both see the pump-probe trace.
+    def __init__(self, boxcar_levels=None, demod_levels=None, noise=0.001, sample_rate=1000.0, clockbase=1.8e9, realtime=False, seed=None,
+                 signal=None, stage=None, signal_channels=(0,)):
+        self.boxcar_levels = boxcar_levels if boxcar_levels is not None else {0: 0.1, 1: 0.05}
+        self.demod_levels = demod_levels if demod_levels is not None else {0: (0.01, 0.0)}
+        self.noise = noise
+        self.sample_rate = sample_rate
+        self.clockbase = clockbase
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.nodes = {}
+        self.devices = set()
+        self.subscribed = set()
+        self.device_time = 0.0                  # device clock (s), runs with the host clock when realtime
+        self._clock_start = time.monotonic()
+        self._last_poll = None
+        self.signal = signal
+        self.stage = stage
+        self.signal_channels = tuple(signal_channels)
+        self.probe_blocked = False           # beam blocks (SimulatedLab.block): no probe -> 0 V, no pump -> no signal
+        self.pump_blocked = False
+
+    def connectDevice(self, device_id, interface):
+        self.devices.add(device_id.lower())
+
+    def disconnectDevice(self, device_id):
+        self.devices.discard(device_id.lower())
+
+    def getInt(self, path):
+        if path.lower().endswith("/clockbase"):
+            return int(self.clockbase)
+        return int(self.nodes.get(path.lower(), 0))
+
+    def getDouble(self, path):
+        path = path.lower()
+        if path.endswith("/value") and "/boxcars/" in path:
+            return float(self._boxcar_samples(path, 1)[0])
+        return float(self.nodes.get(path, 0.0))
+
+    def setInt(self, path, value):
+        self.nodes[path.lower()] = int(value)
+
+    def setDouble(self, path, value):
+        self.nodes[path.lower()] = float(value)
+
+    # This function answers a comma separated list of value/sample nodes in the flat dictionary layout of ziDAQServer.get.
+    # Like the real server, streaming nodes (boxcar values, demod samples) are left out unless settingsonly=False.
+    def get(self, paths, flat=False, settingsonly=True):
+        if self.realtime:
+            self.device_time = time.monotonic() - self._clock_start
+        timestamp = np.array([int(self.device_time * self.clockbase)], dtype=np.uint64)
+        data = {}
+        for path in paths.lower().split(","):
+            path = path.strip()
+            if settingsonly and ("/boxcars/" in path and path.endswith("/value") or "/demods/" in path and path.endswith("/sample")):
+                continue
+            if "/boxcars/" in path:
+                data[path] = {"timestamp": timestamp, "value": self._boxcar_samples(path, 1)}
+            elif "/demods/" in path:
+                index = int(path.split("/demods/")[1].split("/")[0])
+                x, y = self.demod_levels.get(index, (0.0, 0.0))
+                data[path] = {
+                    "timestamp": timestamp,
+                    "x": np.array([x + self.noise * self.rng.standard_normal()]),
+                    "y": np.array([y + self.noise * self.rng.standard_normal()]),
+                }
+            else:
+                data[path] = {"timestamp": timestamp, "value": np.array([self.nodes.get(path, 0.0)])}
+        return data
+
+    def subscribe(self, path):
+        self.subscribed.add(path.lower())
+
+    def unsubscribe(self, path):
+        self.subscribed.discard(path.lower())
+        if not self.subscribed:
+            self._last_poll = None
+
+    def sync(self):
+        pass
+
+    # This function returns the samples the subscribed nodes produced during the recording time,
+    # in the same {path: {"timestamp": ..., "value": ...}} layout the real server uses with flat=True.
+    # With realtime=True it waits for the recording time and, like the real server, returns every sample
+    # taken since the previous poll (the device keeps sampling in between).
+    def poll(self, recording_time, timeout_ms, flags=0, flat=True):
+        if self.realtime:
+            time.sleep(recording_time)
+            now = time.monotonic()
+            since = self._last_poll if self._last_poll is not None else now - recording_time
+            self._last_poll = now
+            count = int((now - since) * self.sample_rate)
+            times = since + np.arange(count) / self.sample_rate
+            seconds = times - self._clock_start
+            self.device_time = now - self._clock_start
+        else:
+            count = int(round(recording_time * self.sample_rate))
+            times = None
+            seconds = self.device_time + np.arange(count) / self.sample_rate
+            self.device_time += recording_time
+        timestamps = (seconds * self.clockbase).astype(np.uint64)
+        data = {}
+        for path in self.subscribed:
+            data[path] = {"timestamp": timestamps, "value": self._boxcar_samples(path, count, times)}
+        return data
+
+    # This function makes `count` noisy boxcar readings (in volts) for the channel named in the node path.
+    # times are the time.monotonic() values of the samples (None = now), used to look up the stage position.
+    def _boxcar_samples(self, path, count, times=None):
+        channel = int(path.split("/boxcars/")[1].split("/")[0])
+        level = 0.0 if self.probe_blocked else self.boxcar_levels.get(channel, 0.0)
+        if self.signal is not None and self.stage is not None and channel in self.signal_channels and not self.pump_blocked:
+            positions = self.stage.position() if times is None else self.stage.positions_at(times)
+            level = level * (1 + self.signal.at(positions))
+        return level + self.noise * self.rng.standard_normal(count)
+
+
+class FakeDL225:
+    # This is the constructor for the fake controller, it starts answering commands on its port.
+    # Moves follow a trapezoidal profile using the VA (mm/s) and AC (mm/s^2) values the driver sends.
+    # transport="pty" gives a pty path as .port, transport="loop" an in-process serial port object (works on any OS).
+    # With baud set, every command and reply takes as long to transfer as on the real RS-232 line (10 bits per byte).
+    def __init__(self, position=0.0, velocity=0.02, acceleration=100.0, transport="pty", baud=None):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.baud = baud
+        self.motor_on = False
+        self.last_error = "@"
+        self.commands = []                   # every command received, handy for checking what the driver sent
+        self._start = position
+        self._target = position
+        self._move_started = time.monotonic()
+        self._move_time = 0.0
+        self._profile = (velocity, acceleration)     # VA/AC of the current move (new values apply to the next move)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        if transport == "loop":
+            self.port = LoopSerial(self)
+            self._thread = None
+        elif transport == "pty":
+            if tty is None:
+                raise RuntimeError('ptys are not available on this OS, use FakeDL225(transport="loop")')
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._slave)
+            self.port = os.ttyname(self._slave)
+            self._thread = threading.Thread(target=self._serve, name="FakeDL225", daemon=True)
+            self._thread.start()
+        else:
+            raise ValueError(f"Unknown transport {transport!r} (pty or loop)")
+
+    # This function gives the stage position right now, following the current move profile.
+    def position(self):
+        with self._lock:
+            return self._position_at(time.monotonic())
+
+    # This function gives the stage positions at several earlier time.monotonic() values of the current move.
+    def positions_at(self, times):
+        with self._lock:
+            return np.array([self._position_at(t) for t in np.ravel(times)])
+
+    def is_moving(self):
+        with self._lock:
+            return time.monotonic() - self._move_started < self._move_time
+
+    def close(self):
+        self._closed.set()
+        if self._thread is None:
+            self.port.close()
+        else:
+            self._thread.join(timeout=1.0)
+            os.close(self._master)
+            os.close(self._slave)
+
+    # This function interprets one command line and returns the reply line (or None for set commands).
+    def handle(self, line):
+        self.commands.append(line)
+        cmd = line[1:3].upper() if len(line) >= 3 else ""
+        arg = line[3:].strip()
+        now = time.monotonic()
+        with self._lock:
+            if cmd == "PA" or cmd == "PR":
+                try:
+                    target = float(arg)
+                except ValueError:
+                    self.last_error = "B"
+                    return None
+                current = self._position_at(now)
+                self._start = current
+                self._target = target if cmd == "PA" else current + target
+                self._move_started = now
+                self._profile = (self.velocity, self.acceleration)
+                self._move_time = move_time(abs(self._target - current), self.velocity, self.acceleration)
+                return None
+            if cmd == "TP":
+                return f"1TP{self._position_at(now):.6f}"
+            if cmd == "TS":
+                moving = now - self._move_started < self._move_time
+                return "1TS0000" + ("28" if moving else "33")
+            if cmd == "TE":
+                error, self.last_error = self.last_error, "@"
+                return f"1TE{error}"
+            if cmd in ("VA", "AC"):
+                if arg.endswith("?"):
+                    return f"1{cmd}{self.velocity if cmd == 'VA' else self.acceleration}"
+                try:
+                    value = float(arg)
+                except ValueError:
+                    self.last_error = "B"
+                    return None
+                if cmd == "VA":
+                    self.velocity = value
+                else:
+                    self.acceleration = value
+                return None
+            if cmd == "MO":
+                self.motor_on = True
+                return None
+            if cmd == "MF":
+                self.motor_on = False
+                return None
+            if cmd == "ST":
+                self._start = self._target = self._position_at(now)
+                self._move_time = 0.0
+                return None
+            if cmd == "WS":
+                return None
+        self.last_error = "A"
+        return None
+
+    def _position_at(self, now):
+        return profile_position(self._start, self._target, max(now - self._move_started, 0.0), *self._profile)
+
+    # This function answers one received line (bytes) and returns the reply bytes, taking the line's transfer time.
+    def _reply(self, raw):
+        line = raw.decode("ascii", errors="ignore").strip()
+        if not line:
+            return b""
+        self._transfer(len(raw) + 1)
+        reply = self.handle(line)
+        if reply is None:
+            return b""
+        reply = (reply + "\r\n").encode("ascii")
+        self._transfer(len(reply))
+        return reply
+
+    def _transfer(self, size):
+        if self.baud:
+            time.sleep(size * 10 / self.baud)
+
+    def _serve(self):
+        buffer = b""
+        while not self._closed.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                buffer += os.read(self._master, 1024)
+            except OSError:
+                break
+            while b"\n" in buffer:
+                raw, buffer = buffer.split(b"\n", 1)
+                reply = self._reply(raw)
+                if reply:
+                    os.write(self._master, reply)
+
+
+class LoopSerial:
+    # In-process serial port connected to a FakeDL225 (its .port with transport="loop"), with the parts of the
+    # pyserial Serial interface the stage driver uses. The controller answers each line on a thread of its own,
+    # like the real one does on the other end of the cable.
+    def __init__(self, controller, timeout=0.1):
+        self.controller = controller
+        self.port = "loop://FakeDL225"
+        self.timeout = timeout
+        self.is_open = True
+        self._received = b""
+        self._sent = b""
+        self._condition = threading.Condition()
+        self._lines = []
+        self._thread = threading.Thread(target=self._serve, name="FakeDL225", daemon=True)
+        self._thread.start()
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return len(self._received)
+
+    def write(self, data):
+        with self._condition:
+            self._sent += bytes(data)
+            while b"\n" in self._sent:
+                raw, self._sent = self._sent.split(b"\n", 1)
+                self._lines.append(raw)
+            self._condition.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        with self._condition:
+            self._condition.wait_for(lambda: self._received or not self.is_open, self.timeout)
+            data, self._received = self._received[:size], self._received[size:]
+            return data
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._received = b""
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        with self._condition:
+            self.is_open = False
+            self._condition.notify_all()
+
+    def _serve(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._lines or not self.is_open)
+                if not self.is_open:
+                    return
+                raw = self._lines.pop(0)
+            reply = self.controller._reply(raw)
+            if reply:
+                with self._condition:
+                    self._received += reply
+                    self._condition.notify_all()
+
+
+# This function gives the position `elapsed` seconds into a trapezoidal move from start to target.
+def profile_position(start, target, elapsed, velocity, acceleration):
+    distance = abs(target - start)
+    total = move_time(distance, velocity, acceleration)
+    if elapsed >= total:
+        return target
+    direction = 1.0 if target >= start else -1.0
+    ramp_time = min(velocity / acceleration, total / 2)
+    peak_velocity = acceleration * ramp_time
+    if elapsed < ramp_time:
+        travelled = 0.5 * acceleration * elapsed ** 2
+    elif elapsed < total - ramp_time:
+        travelled = 0.5 * acceleration * ramp_time ** 2 + peak_velocity * (elapsed - ramp_time)
+    else:
+        travelled = distance - 0.5 * acceleration * (total - elapsed) ** 2
+    return start + direction * travelled
+
+
+class FakeStellarNet:
+    # This is the constructor for the fake spectrometer driver, an instance has the same functions as the stellarnet_driver3 module.
+    # The spectrum is a lamp shaped peak of `counts` (at 100 ms integration) on top of a `dark` offset, with Gaussian `noise`
+    # per frame (reduced by the scan averaging), plus hot pixels that always read near saturation.
+    # Each getBurstFifo_Y call returns `fifo_depth` frames. With realtime=True reads take the integration time like the device.
+    # With a signal (PumpProbeSignal) and a stage (FakeDL225) the probe is also changed by dT/T at the stage position.
+    def __init__(self, pixels=2048, wavelength_range=(200.0, 1100.0), counts=20000.0, dark=1000.0, noise=50.0,
+                 hot_pixels=(), fifo_depth=16, realtime=False, seed=None, signal=None, stage=None):
+        self.pixels = pixels
+        self.wavelengths = np.linspace(wavelength_range[0], wavelength_range[1], pixels)
+        center = np.mean(wavelength_range)
+        width = (wavelength_range[1] - wavelength_range[0]) / 6
+        self.lamp = counts * np.exp(-0.5 * ((self.wavelengths - center) / width) ** 2)
+        self.dark = dark
+        self.noise = noise
+        self.hot_pixels = list(hot_pixels)
+        self.fifo_depth = fifo_depth
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.transmission = np.ones(pixels)      # multiplies the lamp spectrum, e.g. a sample or a pump-probe signal
+        self.params = {"int_time": 100, "scans_to_avg": 1, "x_smooth": 0, "x_timing": 3}
+        self.burst = False
+        self.frames_read = 0
+        self.signal = signal
+        self.stage = stage
+        self.probe_blocked = False           # beam blocks (SimulatedLab.block): no probe -> dark only, no pump -> no signal
+        self.pump_blocked = False
+        self._signal_band = signal.spectrum(self.wavelengths) if signal is not None else None
+
+    def version(self):
+        return "FakeStellarNet"
+
+    def total_device_count(self):
+        return 1
+
+    # The device handle is a plain dict, the wavelength array has one row per pixel like the real driver's.
+    def array_get_spec(self, channel):
+        return {"channel": channel}, self.wavelengths.reshape(-1, 1).copy()
+
+    def array_get_spec_only(self, channel):
+        return {"channel": channel}
+
+    def getDeviceId(self, spec):
+        return "FAKE-SPEC"
+
+    def deviceConnectionCheck(self, spec):
+        return True
+
+    def setParam(self, spec, inttime, scansavg, smooth, xtiming, clear=False):
+        self.params = {"int_time": int(inttime), "scans_to_avg": int(scansavg), "x_smooth": int(smooth), "x_timing": int(xtiming)}
+
+    def getDeviceParam(self, spec):
+        return dict(self.params)
+
+    def getDeviceHotPixels(self, spec):
+        return list(self.hot_pixels)
+
+    # Returns [wavelength, counts] pairs, one row per pixel.
+    def array_spectrum(self, spec, wav):
+        averages = max(self.params["scans_to_avg"], 1)
+        self._wait(averages)
+        counts = self._frames(1, self.noise / np.sqrt(averages))[0]
+        return np.column_stack([np.asarray(wav).reshape(-1), counts])
+
+    def getSpectrum_Y(self, spec):
+        return self.array_spectrum(spec, self.wavelengths)[:, 1]
+
+    def allowBurst(self, spec):
+        self.burst = True
+
+    # Returns the frames buffered in the FIFO (fifo_depth of them), one row per frame.
+    def getBurstFifo_Y(self, spec):
+        if not self.burst:
+            raise RuntimeError("Burst mode is not enabled (call allowBurst first)")
+        self._wait(self.fifo_depth)
+        return self._frames(self.fifo_depth, self.noise)
+
+    def reset(self, spec):
+        self.burst = False
+
+    def _frames(self, count, noise):
+        self.frames_read += count
+        scale = self.params["int_time"] / 100.0
+        transmission = 0.0 if self.probe_blocked else self.transmission
+        if self.signal is not None and self.stage is not None and not self.pump_blocked:
+            transmission = transmission * (1 + self.signal.at(self.stage.position()) * self._signal_band)
+        frames = self.dark + scale * self.lamp * transmission + noise * self.rng.standard_normal((count, self.pixels))
+        frames[:, self.hot_pixels] = 65000.0
+        return np.clip(frames, 0, 65535)
+
+    def _wait(self, frames):
+        if self.realtime:
+            time.sleep(frames * self.params["int_time"] / 1000.0)
+
+
+class SimulatedLab:
+    # This is the constructor for a whole simulated setup: a FakeDL225, and a FakeDAQServer and FakeStellarNet that both see
+    # the signal (a PumpProbeSignal, default one if None) at the fake stage's position. realtime=True gives the real timing
+    # (stage moves, 9600 baud serial line, lock-in recording and spectrometer integration times).
+    # Connect the drivers with UHFLI(daq=lab.daq), NewPort_Delay_Stage_225(port=lab.stage.port) and use lab.stellarnet as `sn`.
+    def __init__(self, signal=None, realtime=True, seed=None, transport=None, **spectrometer_options):
+        self.signal = signal if signal is not None else PumpProbeSignal()
+        transport = transport or ("pty" if tty is not None else "loop")
+        self.stage = FakeDL225(transport=transport, baud=9600 if realtime else None)
+        self.daq = FakeDAQServer(noise=0.0002, realtime=realtime, seed=seed, signal=self.signal, stage=self.stage)
+        self.stellarnet = FakeStellarNet(realtime=realtime, seed=seed, signal=self.signal, stage=self.stage, **spectrometer_options)
+
+    # This function blocks / unblocks the beams for both detectors (what the scripts ask for before dark and reference spectra).
+    def block(self, probe=False, pump=False):
+        for detector in (self.daq, self.stellarnet):
+            detector.probe_blocked = probe
+            detector.pump_blocked = pump
+
+    def close(self):
+        self.stage.close()
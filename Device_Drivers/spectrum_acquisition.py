@@ -0,0 +1,63 @@
+import numpy as np
+import time
+
+"""
+Spectrometer Acquisition Helpers
+Functions around the StellarNet driver (stellarnet_driver3, or FakeStellarNet from simulators.py) used by the spectrometer scan.
+The driver module is passed in as `sn`, so the same code runs against the real spectrometer and the simulator.
+
+spectrum_counts -> the intensity (Y) values of whatever array_spectrum returned
+enable_burst    -> switches the spectrometer to burst mode (frames are buffered in the device FIFO)
+read_burst      -> reads N frames in high-speed FIFO transfers, as one (frames x pixels) float32 array
+burst_spectrum  -> mean, standard deviation and standard error per pixel over the frames of one burst
+
+In burst mode the driver's own scan averaging should be 1 (each frame is one exposure) and the averaging is done
+here in NumPy, which also gives a noise estimate for every pixel of every scan point.
+
+"""
+
+# This function gives the intensity values as a 1D float32 array.
+# array_spectrum returns [wavelength, counts] pairs (one row per pixel), plain counts are passed through.
+def spectrum_counts(data):
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2 and data.shape[1] == 2:
+        return data[:, 1]
+    return data.reshape(-1)
+
+
+# This function switches burst mode on. Not every detector supports it (the driver reports that when it doesn't).
+def enable_burst(sn, spec):
+    sn.allowBurst(spec)
+
+
+# This function reads `frames` spectra through the burst FIFO.
+# Every getBurstFifo_Y call empties the FIFO (one or more frames), calls repeat until enough frames have arrived.
+# When the FIFO is empty the next frame is still being exposed, so the loop sleeps a quarter of the integration time
+# (asked from the driver the first time) instead of polling the USB link in a tight loop.
+# Returns a (frames x pixels) float32 array.
+def read_burst(sn, spec, frames, pixels, timeout=30.0):
+    blocks = []
+    received = 0
+    wait = None
+    deadline = time.monotonic() + timeout
+    while received < frames:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Only {received} of {frames} burst frames arrived in {timeout} s")
+        block = np.asarray(sn.getBurstFifo_Y(spec), dtype=np.float32).reshape(-1, pixels)
+        if len(block) == 0:
+            if wait is None:
+                wait = sn.getDeviceParam(spec)["int_time"] / 1000 / 4
+            time.sleep(wait)
+            continue
+        blocks.append(block)
+        received += len(block)
+    return np.concatenate(blocks)[:frames]
+
+
+# This function averages the frames of one burst.
+# Returns {"mean", "std", "sem"} (one value per pixel) and "frames" (how many frames went in).
+def burst_spectrum(frames):
+    count = len(frames)
+    mean = frames.mean(axis=0, dtype=np.float64)
+    std = frames.std(axis=0, ddof=1, dtype=np.float64) if count > 1 else np.zeros_like(mean)
+    return {"mean": mean, "std": std, "sem": std / np.sqrt(count), "frames": count}
@@ -0,0 +1,122 @@
+import numpy as np
+from pathlib import Path
+
+"""
+Spectrum Calibration
+Corrections applied to every spectrum between the spectrometer and the scan storage, all vectorized
+(a whole burst of frames is corrected in one go):
+
+1. hot pixels (from getDeviceHotPixels) are replaced by interpolating their good neighbours
+2. the dark spectrum (probe blocked) is subtracted
+3. only the wavelength region of interest (ROI) is kept
+4. neighbouring pixels are binned (averaged) together
+
+With a reference spectrum (probe on, pump blocked) each corrected spectrum also gives the
+pump-probe signal dT/T = corrected / reference - 1.
+
+Dark and reference spectra only depend on the spectrometer settings, so they are kept in a
+CalibrationCache folder per setting and reused by later scans with the same settings.
+
+"""
+class SpectrumCalibration:
+    # wavelengths is the spectrometer's wavelength axis (one per pixel), hot_pixels the pixel indices to interpolate over,
+    # roi=(min_nm, max_nm) keeps only that wavelength range (None = all) and binning averages that many neighbouring pixels.
+    def __init__(self, wavelengths, hot_pixels=(), roi=None, binning=1):
+        self.raw_wavelengths = np.asarray(wavelengths, dtype=np.float64).reshape(-1)
+        pixels = len(self.raw_wavelengths)
+        self.binning = max(int(binning), 1)
+        self.hot_pixels = np.array(sorted({int(p) for p in hot_pixels if 0 <= int(p) < pixels}), dtype=np.int64)
+        self._hot_left, self._hot_right, self._hot_weight = _neighbours(self.hot_pixels, pixels)
+
+        # pixels kept by the ROI, trimmed to a whole number of bins
+        if roi is None:
+            keep = np.arange(pixels)
+        else:
+            low, high = min(roi), max(roi)
+            keep = np.flatnonzero((self.raw_wavelengths >= low) & (self.raw_wavelengths <= high))
+        keep = keep[:len(keep) - len(keep) % self.binning]
+        if len(keep) == 0:
+            raise ValueError(f"No whole bin of {self.binning} pixels inside the wavelength range {roi}")
+        self._roi = slice(int(keep[0]), int(keep[-1]) + 1)
+        self.wavelengths = self._bin(self.raw_wavelengths[self._roi])
+        self.dark = None              # full length, hot pixels already interpolated
+        self.reference = None         # corrected (ROI and binning applied)
+
+    # This function sets the dark spectrum (raw counts, one value per pixel, e.g. the mean of a burst with the probe blocked).
+    def set_dark(self, dark):
+        self.dark = self._fix_hot_pixels(np.asarray(dark, dtype=np.float64).reshape(-1))
+
+    # This function sets the reference spectrum (raw counts with the probe on and the pump blocked), used for dT/T.
+    def set_reference(self, reference):
+        self.reference = self.correct(reference).astype(np.float64)
+
+    # This function applies the corrections to one spectrum (pixels,) or a block of frames (frames x pixels).
+    # Returns float32 counts on the calibrated wavelength axis (self.wavelengths).
+    def correct(self, raw):
+        raw = np.array(raw, dtype=np.float64)
+        raw = self._fix_hot_pixels(raw)
+        if self.dark is not None:
+            raw -= self.dark
+        return self._bin(raw[..., self._roi]).astype(np.float32)
+
+    # This function gives dT/T for corrected spectra (NaN where the reference is zero).
+    def delta_t(self, corrected):
+        if self.reference is None:
+            raise ValueError("dT/T needs a reference spectrum (set_reference)")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = np.asarray(corrected, dtype=np.float64) / np.where(self.reference != 0, self.reference, np.nan)
+        return (ratio - 1.0).astype(np.float32)
+
+    # Saved with the scan so the corrections can be redone or checked afterwards.
+    def settings(self):
+        return {"hot_pixels": self.hot_pixels.tolist(), "binning": self.binning,
+                "roi_pixels": [self._roi.start, self._roi.stop], "pixels_out": len(self.wavelengths)}
+
+    def _fix_hot_pixels(self, raw):
+        if len(self.hot_pixels):
+            raw[..., self.hot_pixels] = (1 - self._hot_weight) * raw[..., self._hot_left] + self._hot_weight * raw[..., self._hot_right]
+        return raw
+
+    def _bin(self, values):
+        if self.binning == 1:
+            return values
+        return values.reshape(values.shape[:-1] + (-1, self.binning)).mean(axis=-1)
+
+
+# This function finds, for every hot pixel, the nearest good pixel on each side and the interpolation weight of the right one.
+# At the edges of the detector the one good neighbour is copied.
+def _neighbours(hot_pixels, pixels):
+    good = np.setdiff1d(np.arange(pixels), hot_pixels)
+    if len(hot_pixels) == 0 or len(good) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    right_index = np.searchsorted(good, hot_pixels)
+    left_index = right_index - 1
+    left = good[np.clip(left_index, 0, len(good) - 1)]
+    right = good[np.clip(right_index, 0, len(good) - 1)]
+    left = np.where(left_index < 0, right, left)
+    right = np.where(right_index >= len(good), left, right)
+    span = (right - left).astype(np.float64)
+    weight = np.where(span > 0, (hot_pixels - left) / np.where(span > 0, span, 1), 0.0)
+    return left, right, weight
+
+
+class CalibrationCache:
+    # Dark and reference spectra are kept as .npy files in `folder`, one per device and spectrometer setting.
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    # This function gives the saved spectrum of this kind ("dark" or "reference") for the settings, or None.
+    def load(self, kind, settings):
+        path = self._path(kind, settings)
+        return np.load(path) if path.exists() else None
+
+    def save(self, kind, settings, spectrum):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        np.save(self._path(kind, settings), np.asarray(spectrum, dtype=np.float64).reshape(-1))
+
+    # settings is a dict such as {"device": ..., "int_time": ..., "averaging": ...}, every value goes into the file name
+    def _path(self, kind, settings):
+        key = "_".join(f"{name}{value}" for name, value in sorted(settings.items()))
+        key = "".join(c if c.isalnum() or c in "-_." else "-" for c in key)
+        return self.folder / f"{kind}_{key}.npy"
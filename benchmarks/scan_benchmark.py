@@ -0,0 +1,260 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+sys.path.append(str(Path(__file__).resolve().parents[1] / "lockin"))
+sys.path.append(str(Path(__file__).resolve().parents[1] / "spectrometer"))
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from Device_Drivers import NewPort_Delay_Stage_225, UHFLI
+from Device_Drivers.scan_analysis import normalize, position_to_delay_ps
+from Device_Drivers.scan_store import ScanStore
+from Device_Drivers.scan_trace import format_summary, phase, start_trace, stop_trace
+from Device_Drivers.simulators import SimulatedLab
+from Device_Drivers.spectrum_acquisition import burst_spectrum, enable_burst
+from Device_Drivers.spectrum_calibration import SpectrumCalibration
+import lockinV1
+import spectrometerV1
+import argparse
+import contextlib
+import io
+import json
+import numpy as np
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+"""
+Scan Throughput Benchmark
+Runs representative scans against the simulated instruments (Device_Drivers/simulators.py) through the same scan loops
+the scripts use (lockinV1.step_scan_readings and spectrometerV1.scan_frames), and reports for each case:
+
+- points/s over the whole scan
+- latency percentiles per phase, timed by Device_Drivers/scan_trace.py like in a real scan: the phases the drivers
+  record (motion, settle and query for the stage, read for the lock-in and the spectrometer, on the worker threads),
+  compute, persist (ScanStore.append), plot (live plot redraw, every --plot-every points), step (time the scan loop
+  waits for + spends on each point) and export (CSV/NumPy export of the finished scan, once)
+- peak Python/NumPy memory (tracemalloc, which is on for every case and slows the Python-heavy phases a little)
+
+By default the simulators answer instantly and the stage moves at 1000 mm/s, so the numbers are the software overhead
+of the drivers and the scan loop. --realtime uses the real timing (stage profile, 9600 baud, integration times).
+
+Results are printed and written as JSON (benchmarks/results/<date>_<time>.json unless --output is given).
+--compare <old result.json> prints the points/s change against an earlier run, to catch regressions.
+
+    python benchmarks/scan_benchmark.py
+    python benchmarks/scan_benchmark.py --points 100 1000 --spectra 1 16 --compare benchmarks/results/20250101_120000.json
+
+"""
+
+# This function connects the drivers to a fresh simulated lab (fast stage limits unless realtime).
+def connect(realtime, **spectrometer_options):
+    lab = SimulatedLab(realtime=realtime, seed=0, **spectrometer_options)
+    limits = {} if realtime else {"max_velocity": 1000.0, "max_acceleration": 1e6}
+    stage = NewPort_Delay_Stage_225(port=lab.stage.port, **limits)
+    return lab, stage
+
+
+# This function benchmarks a lock-in step scan of `points` positions, like lockinV1 does it.
+def lockin_case(points, folder, realtime, plot_every):
+    lab, stage = connect(realtime)
+    lockin = UHFLI(daq=lab.daq)
+    positions = list(np.round(np.linspace(49.0, 49.0 + 0.01 * points, points), 4))
+    T_ref = 100.0
+    # the same scan folder lockinV1 makes (the metadata holds every position, like a real scan's)
+    plan = {"start_mm": positions[0], "end_mm": positions[-1], "steps": points, "mode": "step", "positions": positions,
+            "settings": {"fly_velocity": None, "budget": points, "passes": 1, "backlash": 0.0, "export_excel": False}}
+    with contextlib.redirect_stdout(io.StringIO()):
+        store = lockinV1.create_scan(plan, {"Absolute Transmission": T_ref, "NormT": T_ref, "NormR": T_ref / 2},
+                                     scan_dir=folder / f"lockin_{points}")
+    fig, ax = plt.subplots()
+    line, = ax.plot([], [])
+
+    trace = start_trace()
+    start = time.monotonic()
+    step_start = start
+    readings = lockinV1.step_scan_readings(lockin, stage, positions)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, pos, actual_pos, dt, dr in readings:
+            with phase("compute"):
+                # the same calculations as lockinV1.collect_scan
+                values = normalize(dt, dr, T_ref)
+                row = {"target_mm": pos, "position_mm": actual_pos, "delay_ps": position_to_delay_ps(pos, positions[0]),
+                       "dT_mV": dt, "dR_mV": dr, **values}
+                print(f"Step {i}/{points}: dT = {dt:.3f} mV, dR = {dr:.3f} mV, dA = {values['dA_mV']:.3f} mV")
+            with phase("persist"):
+                store.append(row)
+            if (i + 1) % plot_every == 0:
+                with phase("plot"):
+                    line.set_data(store.column("delay_ps"), store.column("dT_mV"))
+                    ax.relim()
+                    ax.autoscale_view()
+                    fig.canvas.draw()
+            now = time.monotonic()
+            trace.record("step", step_start, now - step_start)
+            step_start = now
+    elapsed = time.monotonic() - start
+
+    with phase("export"):
+        store.export_csv(folder / f"lockin_{points}.csv")
+    summary = stop_trace()
+    plt.close(fig)
+    store.close()
+    lockin.disconnect()
+    stage.close()
+    lab.close()
+    return elapsed, summary
+
+
+# This function benchmarks a calibrated spectrometer step scan of `points` positions with `spectra` spectra per point
+# (1 = one driver reading, more = that many burst frames averaged per point), like spectrometerV1 does it.
+def spectrometer_case(points, spectra, folder, realtime, plot_every, pixels):
+    lab, stage = connect(realtime, pixels=pixels, fifo_depth=max(spectra, 1))
+    sn = lab.stellarnet
+    spec, wav = sn.array_get_spec(0)
+    burst_frames = spectra if spectra > 1 else 0
+    sn.setParam(spec, 10, 1, 0, 3, clear=True)
+    if burst_frames:
+        enable_burst(sn, spec)
+    spectrometerV1.sn = sn
+    calibration = SpectrumCalibration(wav, sn.getDeviceHotPixels(spec))
+    lab.block(probe=True)
+    calibration.set_dark(spectrometerV1.take_frames(spec, wav, burst_frames).mean(axis=0))
+    lab.block(pump=True)
+    calibration.set_reference(spectrometerV1.take_frames(spec, wav, burst_frames).mean(axis=0))
+    lab.block()
+    wavelengths = calibration.wavelengths
+
+    columns = {"target_mm": "f8", "position_mm": "f8", "delay_ps": "f8", "spectrum": ("f4", len(wavelengths)), "dT_T": ("f4", len(wavelengths))}
+    if burst_frames:
+        columns.update({"spectrum_std": ("f4", len(wavelengths)), "frames": "i4"})
+    positions = list(np.round(np.linspace(49.0, 49.0 + 0.01 * points, points), 4))
+    # the same metadata spectrometerV1 saves (new_scan_settings, plus what main adds when it creates the folder)
+    metadata = {
+        "script": Path(spectrometerV1.__file__).name,
+        "integration_time_ms": 10, "scans_avg": 1, "smooth": 0, "xtiming": 3, "channel": 0, "burst_frames": burst_frames,
+        "roi_nm": None, "binning": 1, "calibrate": True,
+        "start_mm": positions[0], "stop_mm": positions[-1], "steps": points, "mode": "step", "positions": positions,
+        "settings": {"budget": points, "passes": 1, "backlash": 0.0, "export": "npz"},
+        "device_id": str(sn.getDeviceId(spec)),
+        "headers": {"position_mm": "Stage Position (mm)", "delay_ps": "Delay Time (ps)", "spectrum": [f"{w:.2f} nm" for w in wavelengths],
+                    "dT_T": [f"dT/T {w:.2f} nm" for w in wavelengths]},
+        "calibration": calibration.settings(),
+    }
+    store = ScanStore.create(folder / f"spectrometer_{points}x{spectra}", columns, capacity=points, metadata=metadata)
+    fig, ax = plt.subplots()
+    line, = ax.plot(wavelengths, np.zeros(len(wavelengths)))
+
+    trace = start_trace()
+    start = time.monotonic()
+    step_start = start
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, pos, actual_pos, frames in spectrometerV1.scan_frames(stage, spec, wav, burst_frames, positions):
+            with phase("compute"):
+                result = burst_spectrum(calibration.correct(frames))
+                spectrum = result["mean"]
+                row = {"target_mm": pos, "position_mm": actual_pos, "delay_ps": spectrometerV1.delay_ps(pos), "spectrum": spectrum,
+                       "dT_T": calibration.delta_t(spectrum)}
+                if burst_frames:
+                    row.update({"spectrum_std": result["std"], "frames": result["frames"]})
+                print(f"Step {i+1}/{points} at {actual_pos:.4f} mm")
+            with phase("persist"):
+                store.append(row)
+            if (i + 1) % plot_every == 0:
+                with phase("plot"):
+                    line.set_ydata(row["dT_T"])
+                    ax.relim()
+                    ax.autoscale_view()
+                    fig.canvas.draw()
+            now = time.monotonic()
+            trace.record("step", step_start, now - step_start)
+            step_start = now
+    elapsed = time.monotonic() - start
+
+    with phase("export"):
+        store.export_npz(folder / f"spectrometer_{points}x{spectra}.npz")
+    summary = stop_trace()
+    spectrometerV1.sn = None
+    plt.close(fig)
+    store.close()
+    sn.reset(spec)
+    stage.close()
+    lab.close()
+    return elapsed, summary
+
+
+# This function runs one case with tracemalloc on and gives its result entry.
+def run_case(name, function, points, *args):
+    tracemalloc.start()
+    try:
+        elapsed, summary = function(points, *args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {"case": name, "points": points, "elapsed_s": elapsed, "points_per_s": points / elapsed,
+              "peak_memory_mb": peak / 2**20, "phases": summary["phases"], "events": summary["events"]}
+    print(f"\n{name}: {points} points in {elapsed:.2f} s = {result['points_per_s']:.1f} points/s, peak memory {result['peak_memory_mb']:.1f} MB")
+    print(format_summary(summary))
+    return result
+
+
+# This function prints the points/s of every case against the same case in an earlier result file.
+def compare(results, previous_path):
+    previous = {case["case"]: case for case in json.loads(Path(previous_path).read_text())["cases"]}
+    print(f"\nCompared with {previous_path}:")
+    for case in results:
+        old = previous.get(case["case"])
+        if old is None:
+            print(f"  {case['case']}: new case")
+            continue
+        change = case["points_per_s"] / old["points_per_s"] - 1
+        flag = "  <-- slower" if change < -0.1 else ""
+        print(f"  {case['case']}: {old['points_per_s']:.1f} -> {case['points_per_s']:.1f} points/s ({change:+.0%}){flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parents[1],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan throughput benchmark against the simulated instruments")
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 10000], help="scan lengths to run")
+    parser.add_argument("--spectra", type=int, nargs="+", default=[1, 16], help="spectra per point for the spectrometer cases")
+    parser.add_argument("--pixels", type=int, default=2048, help="spectrometer pixels")
+    parser.add_argument("--plot-every", type=int, default=10, help="redraw the live plot every this many points")
+    parser.add_argument("--realtime", action="store_true", help="simulate the real instrument timing instead of the software overhead only")
+    parser.add_argument("--only", choices=["lockin", "spectrometer"], help="run only the lock-in or the spectrometer cases")
+    parser.add_argument("--output", help="result JSON file (default benchmarks/results/<date>_<time>.json)")
+    parser.add_argument("--compare", metavar="RESULT_JSON", help="earlier result file to compare points/s with")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        for points in args.points:
+            if args.only != "spectrometer":
+                results.append(run_case(f"lockin_step_{points}", lockin_case, points, folder, args.realtime, args.plot_every))
+            if args.only != "lockin":
+                for spectra in args.spectra:
+                    results.append(run_case(f"spectrometer_{points}x{spectra}", spectrometer_case, points, spectra,
+                                            folder, args.realtime, args.plot_every, args.pixels))
+
+    output = Path(args.output) if args.output else Path(__file__).resolve().parent / "results" / time.strftime("%Y%m%d_%H%M%S.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": git_commit(), "python": platform.python_version(),
+        "numpy": np.__version__, "platform": platform.platform(), "realtime": args.realtime,
+        "pixels": args.pixels, "plot_every": args.plot_every, "cases": results}, indent=2))
+    print(f"\nResults written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
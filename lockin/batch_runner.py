@@ -0,0 +1,119 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Device_Drivers.scan_recipe import load_recipes, recipe_plan
+from Device_Drivers.scan_store import ScanStore
+from Device_Drivers.simulators import SimulatedLab
+from lockinV1 import connect, create_scan, disconnect, measure_references, run_scan
+import argparse
+import contextlib
+import time
+import traceback
+
+"""
+README:
+
+Runs a queue of lockin scans described in recipe files (see Device_Drivers/scan_recipe.py) back to back, for unattended
+series (e.g. overnight). The UHFLI and the delay stage are connected once for the whole queue, so there is no
+reconnection, 2 s serial wait or stage initialization between scans.
+
+    python lockin/batch_runner.py recipes.yaml [more.yaml ...] [--simulate] [--dry-run] [--stop-on-error]
+
+Every scan gets its own folder in Desktop/RTA_scans (named after the recipe), exactly like a scan from lockinV1.py, so an
+interrupted one can be finished with lockinV1.py --resume. All recipes are checked before anything is measured.
+A scan that fails is reported and the queue carries on with the next one (unless --stop-on-error), after checking that
+the instruments are still there and reconnecting them if not.
+
+"""
+
+# This function gives the references (scan summary) a recipe asks for. previous is the last scan's summary (or None).
+# Both boxcar baselines are on afterwards, as after measure_references.
+def recipe_references(lockin, recipe, previous):
+    references = recipe["references"]
+    if references == "measure":
+        return measure_references(lockin, recipe["target_sem"])
+    if isinstance(references, dict):
+        summary = {"Absolute Transmission": float(references["T_ref"]), "NormT": float(references["NormT"]), "NormR": float(references["NormR"])}
+    elif references == "previous":
+        if previous is None:
+            raise ValueError("references: previous, but no scan has measured references yet (use measure for the first scan)")
+        summary = previous
+    else:
+        summary = ScanStore(references, mode="r").metadata["summary"]
+    # the baselines may be off (e.g. after a reference measurement on another connection), the scan needs them on
+    lockin.set_boxcar_baseline(1, 1)
+    lockin.set_boxcar_baseline(2, 1)
+    return summary
+
+
+# This function runs the recipes in order on one connection and returns [(name, scan folder or None, status, seconds)].
+def run_batch(recipes, lab=None, stop_on_error=False, attach=None):
+    lockin, stage, client = connect(lab, attach)
+    print(f"Instruments connected, {len(recipes)} scans queued")
+    results = []
+    previous = None
+    try:
+        for number, recipe in enumerate(recipes, 1):
+            print(f"\n=== Scan {number}/{len(recipes)}: {recipe['name']} ({recipe['source']}) ===")
+            started = time.monotonic()
+            scan_dir = None
+            try:
+                # attached: other clients of the server wait from the reference measurement until the scan is done
+                with client.lock() if client else contextlib.nullcontext():
+                    summary = recipe_references(lockin, recipe, previous)
+                    previous = summary
+                    plan = recipe_plan(recipe)
+                    print(f"{len(plan['positions'])} positions, {plan['mode']} scan, predicted stage motion time: "
+                          f"{stage.predict_scan_time(plan['positions']):.1f} s")
+                    store = create_scan(plan, summary, recipe["name"])
+                    scan_dir = store.path
+                    export = recipe["export"]
+                    run_scan(lockin, stage, store, export_path=scan_dir / f"{recipe['name']}.{export}" if export != "n" else None)
+                results.append((recipe["name"], scan_dir, "done", time.monotonic() - started))
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Scan {recipe['name']} failed: {e}")
+                results.append((recipe["name"], scan_dir, f"failed: {e}", time.monotonic() - started))
+                if stop_on_error:
+                    break
+                # carry on with the next scan, on new connections if these are gone
+                if not (lockin.is_connected() and stage.is_connected()):
+                    print("Lost an instrument, reconnecting...")
+                    disconnect(lockin, stage, client)
+                    lockin, stage, client = connect(lab, attach)
+    except KeyboardInterrupt:
+        print("\nBatch stopped.")
+    finally:
+        disconnect(lockin, stage, client)
+        print("Devices disconnected.")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a queue of lockin scan recipes on one instrument connection")
+    parser.add_argument("recipes", nargs="+", help="recipe files (YAML), run in the order given")
+    parser.add_argument("--simulate", action="store_true", help="run against simulated instruments (Device_Drivers/simulators.py), no hardware needed")
+    parser.add_argument("--dry-run", action="store_true", help="only check the recipes and list the scans")
+    parser.add_argument("--stop-on-error", action="store_true", help="stop the queue at the first failed scan")
+    parser.add_argument("--attach", nargs="?", const="localhost:6340", metavar="HOST:PORT",
+                        help="use the instruments of a running instrument server (python -m Device_Drivers.instrument_server)")
+    args = parser.parse_args()
+
+    try:
+        recipes = load_recipes(args.recipes)
+    except (OSError, ValueError) as e:
+        print("Recipe error:", e)
+        sys.exit(1)
+    for recipe in recipes:
+        print(f"{recipe['name']:24s} {recipe['mode']:9s} {recipe['start_mm']} -> {recipe['end_mm']} mm, {recipe['steps']} steps, "
+              f"{recipe['passes']} passes, references: {recipe['references']}, export: {recipe['export']}")
+    if args.dry_run:
+        sys.exit(0)
+
+    lab = SimulatedLab() if args.simulate and not args.attach else None
+    results = run_batch(recipes, lab, args.stop_on_error, args.attach)
+    print("\nBatch summary:")
+    for name, scan_dir, status, seconds in results:
+        print(f"  {name:24s} {status:10s} {seconds:8.1f} s  {scan_dir or ''}")
+    if len(results) < len(recipes):
+        print(f"  {len(recipes) - len(results)} scans not run")
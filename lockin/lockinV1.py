@@ -1,8 +1,17 @@
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
-from Device_Drivers import UHFLI, NewPort_Delay_Stage_225
-import pandas as pd
+from Device_Drivers import UHFLI, NewPort_Delay_Stage_225, fly_scan
+from Device_Drivers.instrument_server import InstrumentClient
+from Device_Drivers.instrument_worker import InstrumentWorker, acquire_ahead
+from Device_Drivers.scan_analysis import format_time_zero, normalize, position_to_delay_ps, reference_delays
+from Device_Drivers.scan_planner import AdaptivePlanner, serpentine_order, uniform_positions
+from Device_Drivers.scan_statistics import RunningStats
+from Device_Drivers.scan_store import ScanStore
+from Device_Drivers.scan_trace import format_summary, phase, start_trace, stop_trace
+from Device_Drivers.simulators import SimulatedLab
+import argparse
+import contextlib
 import time
 
 
@@ -37,11 +46,13 @@ This script performs the following steps:
 3. Collects Normalized Transmission (NormT) with the sample in.
 4. Collects Normalized Reflection (NormR).
 5. Optionally performs a quick sweep to find the overlap peak (If the user wants).
-6. Moves the stage to specified positions and collects data.
+6. Moves the stage to specified positions (or sweeps it continuously in fly scan mode) and collects data.
 7. Calculates delay in picoseconds based on the stage position.
 8. Exports the results to an Excel file on the Desktop.
 9. Disconnects the devices after data collection.
 
+If a scan is interrupted, run the script again with --resume <scan folder> to skip steps 1-5 and measure only the missing positions.
+
 """
 
 """
@@ -57,67 +68,183 @@ When running this script, look for errors within:
 
 """
 
-def main():
-    # -------------------------------------------------------------------------------
-    # Step 0: Initialize devices
-    # The UHFLI class is the lock‑in amplifier, and NewPort_Delay_Stage_225 is the delay stage
-    lockin = UHFLI()
-    if not lockin.is_connected():
-        print("Error: Didn't connect to the UHFLI")
-        return
-    stage = NewPort_Delay_Stage_225()
-    if not stage.is_connected():
-        print("Error: Didn't connect to the NewPort Delay Stage")
-        lockin.disconnect()
+# Columns saved for every step (dtype) and their Excel headers
+COLUMNS = {"target_mm": "f8", "position_mm": "f8", "delay_ps": "f8", "dT_mV": "f8", "dR_mV": "f8", "dA_mV": "f8",
+           "dT_pct": "f8", "dR_pct": "f8", "dA_pct": "f8"}
+HEADERS = {"position_mm": "Position [mm]", "delay_ps": "Delay [ps]", "dT_mV": "dT [mV]", "dR_mV": "dR [mV]", "dA_mV": "dA [mV]",
+           "dT_pct": "dT [%]", "dR_pct": "dR [%]", "dA_pct": "dA [%]"}
+# Extra columns for scans with repeated passes
+PASS_COLUMNS = {"dT_std_mV": "f8", "dR_std_mV": "f8", "passes": "i8"}
+PASS_HEADERS = {"dT_std_mV": "dT std [mV]", "dR_std_mV": "dR std [mV]", "passes": "Passes"}
+
+
+# This function moves to each position in turn and yields (step, position, measured position, dT, dR).
+# start skips the steps already done (when resuming a scan).
+# The stage and the lock-in run on their own worker threads one step ahead, so the stage is already moving to the
+# next position (and the lock-in reading it) while the caller calculates, prints and saves the current step.
+def step_scan_readings(lockin, stage, positions, start=0):
+    stage_worker = InstrumentWorker(stage, "stage")
+    lockin_worker = InstrumentWorker(lockin, "lockin")
+
+    # runs while the step before is still being processed, so the position is printed with the step's readings below
+    def move(pos):
+        return stage_worker.submit("move_to", pos)  # done once the controller reports the stage in position
+
+    # Read raw voltages from both boxcars in one request so dT and dR are from the same instant
+    steps = acquire_ahead(positions[start:], move, {"lockin": lambda: lockin_worker.submit("read_boxcars", (0, 1))})
+    try:
+        for i, (pos, actual_pos, readings) in enumerate(steps, start):
+            boxcars = readings["lockin"]["boxcars"]
+            print(f"\nStage at {actual_pos} mm")
+            yield i, pos, actual_pos, boxcars[0], boxcars[1]
+    finally:
+        steps.close()
+        stage_worker.close()
+        lockin_worker.close()
+
+
+# This function lets the planner pick each next position from the dT measured so far, yielding like step_scan_readings.
+# Points already added to the planner (when resuming a scan) are not measured again.
+def adaptive_scan_readings(lockin, stage, planner):
+    for i, pos in enumerate(planner, len(planner.positions)):
+        print(f"\nStep {i}/{planner.budget}: Moving to {pos} mm")
+        actual_pos = stage.move_to(pos)
+        boxcars = lockin.read_boxcars((0, 1))["boxcars"]
+        planner.add(pos, boxcars[0])
+        yield i, pos, actual_pos, boxcars[0], boxcars[1]
+
+
+# This function runs `passes` passes over the positions, every other pass backwards (no long return move to the start).
+# Readings are averaged per position online in `stats` (measured position, dT, dR) instead of being kept per pass,
+# then the averaged points are yielded like step_scan_readings.
+# With backlash > 0 the first point after each direction reversal is approached from the new direction.
+# checkpoint() is called after every complete pass (the script saves stats there), passes already in stats are skipped
+# and start skips averaged points that were already yielded (both for resuming a scan).
+# Nothing is yielded until the last pass is done, so stop (a threading.Event) is checked at every point: once it is set
+# the scan ends there, and a resumed scan redoes the interrupted pass.
+def serpentine_scan_readings(lockin, stage, positions, passes, stats, backlash=0.0, start=0, checkpoint=None, stop=None):
+    forward = 1 if positions[-1] >= positions[0] else -1
+    current_pass = None
+    for scan_pass, index, pos in serpentine_order(positions, passes, first_pass=int(stats.count.min())):
+        if stop is not None and stop.is_set():
+            print(f"\nStopped in pass {scan_pass + 1}/{passes}")
+            return
+        reversing = scan_pass != current_pass and scan_pass > 0
+        if scan_pass != current_pass:
+            if current_pass is not None and checkpoint is not None:
+                checkpoint()
+            print(f"\nPass {scan_pass + 1}/{passes}")
+            current_pass = scan_pass
+        direction = forward if scan_pass % 2 == 0 else -forward
+        actual_pos = stage.approach(pos, direction, backlash) if reversing else stage.move_to(pos)
+
+        boxcars = lockin.read_boxcars((0, 1))["boxcars"]
+        stats.add(index, (actual_pos, boxcars[0], boxcars[1]))
+        print(f"  {pos} mm: dT = {boxcars[0]:.3f} mV, dR = {boxcars[1]:.3f} mV")
+
+    if current_pass is not None and checkpoint is not None:
+        checkpoint()
+
+    for i, pos in enumerate(positions[start:], start):
+        actual_pos, dt, dr = stats.mean[i]
+        yield i, pos, actual_pos, dt, dr
+
+
+# This function runs one fly scan over the positions and yields the binned readings in the same form as step_scan_readings.
+# A fly scan is one sweep, so an interrupted one is swept again and only the missing points (from start on) are yielded.
+def fly_scan_readings(lockin, stage, positions, velocity, start=0):
+    if start >= len(positions):
         return
-    # -------------------------------------------------------------------------------
-
+    print(f"\nFly scan from {positions[0]} mm to {positions[-1]} mm at {velocity} mm/s")
+    result = fly_scan(lockin, stage, positions, velocity)
+    for i, pos in enumerate(positions[start:], start):
+        if result["counts"][i] == 0:
+            print(f"Warning: no lock-in samples landed in the bin at {pos} mm (lower the velocity)")
+        yield i, pos, pos, result["channels"][0]["mean"][i], result["channels"][1]["mean"][i]
+
+
+# This function measures the references (steps 1-3), wait(prompt) is called before each one so the sample can be changed.
+# Each streams until its standard error reaches target_sem (mV) or 10 s have passed.
+# Returns the scan "summary": {"Absolute Transmission": T_ref, "NormT": ..., "NormR": ...} (mV).
+def measure_references(lockin, target_sem=0.01, wait=input):
     # Step 1: Reference Transmission (T_ref)
-    input("Press Enter to collect 100% transmission (no sample in)... ")
+    wait("Press Enter to collect 100% transmission (no sample in)... ")
     # Turn OFF boxcar‑1 baseline
     lockin.set_boxcar_baseline(1, 0)
-    T_ref = lockin.average_boxcar_voltage(0)
-    print(f"T_ref = {T_ref:.3f} mV")
+    ref = lockin.measure_boxcar_voltage(0, target_sem)
+    T_ref = ref["mean"]
+    print(f"T_ref = {T_ref:.3f} ± {ref['sem']:.3f} mV ({ref['count']} samples in {ref['duration']:.2f} s)")
 
     # Step 2: Normalized Transmission (NormT)
-    input("Insert sample & press Enter to collect NormT... ")
-    normT = lockin.average_boxcar_voltage(0)
-    print(f"NormT = {normT:.3f} mV")
+    wait("Insert sample & press Enter to collect NormT... ")
+    ref = lockin.measure_boxcar_voltage(0, target_sem)
+    normT = ref["mean"]
+    print(f"NormT = {normT:.3f} ± {ref['sem']:.3f} mV ({ref['count']} samples in {ref['duration']:.2f} s)")
     # Turn ON boxcar‑1 baseline
     lockin.set_boxcar_baseline(1, 1)
  
     # Step 3: Normalized Reflection (NormR)
-    input("Press Enter to collect NormR... ")
+    wait("Press Enter to collect NormR... ")
     # Turn OFF boxcar‑2 baseline
     lockin.set_boxcar_baseline(2, 0)
-    normR = lockin.average_boxcar_voltage(1)
-    print(f"NormR = {normR:.3f} mV")
+    ref = lockin.measure_boxcar_voltage(1, target_sem)
+    normR = ref["mean"]
+    print(f"NormR = {normR:.3f} ± {ref['sem']:.3f} mV ({ref['count']} samples in {ref['duration']:.2f} s)")
     # Turn ON boxcar‑2 baseline
     lockin.set_boxcar_baseline(2, 1)
   
+    return {"Absolute Transmission": T_ref, "NormT": normT, "NormR": normR}
+
+
+# This function makes the scan folder for a plan (start_mm, end_mm, steps, mode, positions, settings) and the
+# reference summary. name is added to the folder name (the batch runner names each scan after its recipe).
+# scan_dir replaces the usual folder in Desktop/RTA_scans (e.g. the benchmark's temporary folder).
+def create_scan(plan, summary, name=None, scan_dir=None):
+    # Setup storage: every step is written to disk as soon as it is measured (see Device_Drivers/scan_store.py)
+    settings = plan["settings"]
+    columns = dict(COLUMNS)
+    if settings["passes"] > 1:
+        columns.update(PASS_COLUMNS)
+    if scan_dir is None:
+        folder = time.strftime("scan_%Y%m%d_%H%M%S") + (f"_{name}" if name else "")
+        scan_dir = Path.home() / "Desktop" / "RTA_scans" / folder
+    store = ScanStore.create(scan_dir, columns, capacity=settings["budget"], metadata={
+        "script": Path(sys.argv[0]).name or Path(__file__).name,     # lockinV1.py, lockinlive.py or batch_runner.py
+        **plan,
+        "summary": summary,
+        "headers": {**HEADERS, **(PASS_HEADERS if settings["passes"] > 1 else {})},
+    })
+    print(f"Saving scan to {scan_dir}")
+    return store
+
+
+# This function asks for a new scan (references, optional quick sweep, positions and scan mode) and creates its scan folder.
+# Everything needed to carry on later is saved in the folder, so an interrupted scan can be resumed with --resume.
+# Returns the ScanStore, or None when there is nothing to scan (quick sweep only). quick_sweep=False leaves the quick
+# sweep out (attached to an instrument server: find_peak takes the lock-in reading as a callback, which can't be sent).
+def new_scan(lockin, stage, quick_sweep=True):
+    # Reference measurements stream until their standard error reaches this target (or 10 s have passed)
+    target_sem = float(input("Enter target precision for T_ref/NormT/NormR in mV (standard error, e.g. 0.01): ") or 0.01)
+
+    summary = measure_references(lockin, target_sem)
+  
     # -------------------------------------------------------------------------------
     # Optional: Quick sweep to find overlap
-    if input("Quick sweep to find overlap? (y/n): ").strip().lower() == 'y':
+    if not quick_sweep:
+        print("Quick sweep not available through the instrument server, run it without --attach")
+    elif input("Quick sweep to find overlap? (y/n): ").strip().lower() == 'y':
         start_pos = float(input("Enter stage START position in mm (e.g. 150.34): "))
         end_pos   = float(input("Enter stage END position in mm (e.g. 160.67): "))
         ss = float(input("Enter each step size in mm: "))
-        sweep_positions = stage.quick_sweep(start_pos, end_pos, ss)
-
-        max_voltage = float('-inf')
-        max_pos = None
+        precision = float(input("Enter the precision wanted for the peak position in mm (e.g. 0.005): "))
+        # The voltage is read at each position as the stage gets there, then the search refines around the maximum
+        max_pos, max_voltage, sweep_readings = stage.find_peak(lambda: lockin.read_boxcar_voltage(0), start_pos, end_pos, ss, precision)
 
-        for pos in sweep_positions:
-            voltage = lockin.read_boxcar_voltage(0)
+        for pos, voltage in sweep_readings:
             print(f"Pos: {pos:.3f} mm, Voltage: {voltage:.3f} mV")
-            if voltage > max_voltage:
-                max_voltage = voltage
-                max_pos = pos
-
-        print(f"\nQuick sweep done >>> Overlap peak voltage found at {max_pos:.3f} mm: {max_voltage:.3f} mV")
-        stage.close()
-        lockin.disconnect()
-        print("Devices disconnected, exiting program.")
-        return
+
+        print(f"\nQuick sweep done >>> Overlap peak voltage found at {max_pos:.3f} mm: {max_voltage:.3f} mV ({len(sweep_readings)} stage moves)")
+        return None
     # -------------------------------------------------------------------------------
 
     # Step 4: Movement setup
@@ -131,103 +258,228 @@ def main():
     steps = int(input("Enter number of steps: "))
     if steps < 2:
         print("Number of steps should be at least 2")
-        return
+        return None
     step_size = (end_pos - start_pos) / (steps - 1)
-    positions = [round(start_pos + i * step_size, 2) for i in range(steps)]
+    positions = uniform_positions(start_pos, end_pos, steps)
 
     print(f"Step size: {step_size:.3f} mm")
     print(f"Positions: {positions}")
+    print(f"Predicted stage motion time: {stage.predict_scan_time(positions):.1f} s")
+
+    # Fly scan: the stage sweeps start -> end at a constant velocity while the lock-in streams, instead of stopping at every position
+    fly = input("Fly scan (stage moves continuously while the lock-in streams)? (y/n): ").strip().lower() == 'y'
+    adaptive = False
+    fly_velocity, budget, backlash = None, steps, 0.0
+    if fly:
+        fly_velocity = float(input("Enter fly scan velocity in mm/s (e.g. 0.05): "))
+    else:
+        # Adaptive scan: the positions above are a coarse pass, then extra points go where dT is large or changes fastest
+        adaptive = input("Adaptive scan (extra points around time zero and fast dynamics)? (y/n): ").strip().lower() == 'y'
+        if adaptive:
+            budget = int(input(f"Enter the total number of points (the {steps} steps above are the coarse pass): "))
+
+    # Repeated passes: back-and-forth over the same positions, averaged per point
+    passes = 1
+    if not fly and not adaptive:
+        passes = int(input("Enter number of passes (1 = single scan, more = back-and-forth repeats averaged per point): ") or 1)
+        if passes > 1:
+            backlash = float(input("Enter backlash compensation in mm for direction reversals (0 = none): ") or 0)
 
     
-    # Setup storage arrays
-    dT, dR, dA = [], [], []
-    dT_p, dR_p, dA_p = [], [], []
-    delays_ps = []
-    recorded_positions = []
-   
-    
-    # Step 5: Data collection & math
-    try:    #try here to ensure devices are closed properly even if an error occurs
-        
+    export_excel = input("Also export an Excel file to the Desktop when the scan finishes? (y/n): ").strip().lower() == 'y'
+
+    plan = {
+        "start_mm": start_pos, "end_mm": end_pos, "steps": steps,
+        "mode": "fly" if fly else "adaptive" if adaptive else "serpentine" if passes > 1 else "step",
+        "positions": positions,
+        "settings": {"fly_velocity": fly_velocity, "budget": budget, "passes": passes, "backlash": backlash, "decimals": 2,
+                     "export_excel": export_excel},
+    }
+    return create_scan(plan, summary)
+
+
+# This function gives the readings generator for a scan folder (new, or one to resume), picked by its scan mode,
+# and the RunningStats of a scan with repeated passes (None otherwise). stop is passed to the generators that measure
+# more than one point per yielded row.
+def scan_readings(lockin, stage, store, stop=None):
+    metadata = store.metadata
+    settings = metadata["settings"]
+    positions = metadata["positions"]
+    done = len(store)
+    if metadata["mode"] == "fly":
+        return fly_scan_readings(lockin, stage, positions, settings["fly_velocity"], start=done), None
+    if metadata["mode"] == "adaptive":
+        # rounded like the positions of the plan (folders made before the setting was saved used 2 decimals)
+        planner = AdaptivePlanner(metadata["start_mm"], metadata["end_mm"], metadata["steps"], settings["budget"],
+                                  decimals=settings.get("decimals", 2))
+        for pos, dt in zip(store.column("target_mm"), store.column("dT_mV")):
+            planner.add(float(pos), float(dt))
+        return adaptive_scan_readings(lockin, stage, planner), None
+    if settings["passes"] > 1:
+        # the per-position averages are saved after every pass so a resumed scan only redoes the interrupted pass
+        stats_file = store.path / "pass_stats.npz"
+        stats = RunningStats.load(stats_file) if stats_file.exists() else RunningStats(len(positions), 3)
+        return serpentine_scan_readings(lockin, stage, positions, settings["passes"], stats, settings["backlash"], start=done,
+                                        checkpoint=lambda: stats.save(stats_file), stop=stop), stats
+    return step_scan_readings(lockin, stage, positions, start=done), None
+
+
+# This function measures the missing steps of a scan folder on connected instruments and writes each one to the folder.
+# on_step(step, position, measured position, dT, dR) is called after each step is saved (lockinlive plots there),
+# stop is a threading.Event checked after every step (set to end the scan early).
+def collect_scan(lockin, stage, store, on_step=None, stop=None):
+    metadata = store.metadata
+    start_pos, steps = metadata["start_mm"], metadata["steps"]
+    T_ref = metadata["summary"]["Absolute Transmission"]
+    # timing of every command, move, reading and step goes to trace.jsonl next to the data (see Device_Drivers/scan_trace.py)
+    start_trace(store.path / "trace.jsonl")
+
+    try:
         print("Starting data collection...")
-        for i, pos in enumerate(positions):
-            print(f"\nStep {i}/{steps}: Moving to {pos} mm")
-            stage.move_to(pos)
-            time.sleep(0.4)  # 400 ms delay for stage to settle
-
-            # Read raw voltages from boxcars
-            dt = lockin.read_boxcar_voltage(0)
-            dr = lockin.read_boxcar_voltage(1)
-
-            # Calculations (verify these formulas)
-            da = - (dt + dr)
-            t_prct = (dt / T_ref) * 100
-            r_prct = (dr / T_ref) * 100
-            a_prct = (da / T_ref) * 100
-            rel_pos = pos - start_pos
-            delay_ps = (2 * rel_pos / 1000) / 3e8 * 1e12 # Convert mm to m, then to seconds, then to picoseconds (Should be multiplied by 2)
-
-            # Append results to storage arrays
-            dT.append(dt)
-            dR.append(dr)
-            dA.append(da)
-            recorded_positions.append(pos)
-            dT_p.append(t_prct)
-            dR_p.append(r_prct)
-            dA_p.append(a_prct)
-            delays_ps.append(delay_ps)
-
-            # Print results for each data collection step (Can remove if desired, for debugging)
-            print(f"Step {i}/{steps}:")
-            print(f"  Position: {pos} mm, Delay: {delay_ps:.2f} ps")
-            print(f"  dT = {dt:.3f} mV, dR = {dr:.3f} mV, dA = {da:.3f} mV")
-            print(f"  %T = {t_prct:.2f}, %R = {r_prct:.2f}, %A = {a_prct:.2f}")
-    
-    
-    # Step 6: Disconnect devices
-    finally:    #make sure devices are closed properly
+        readings, stats = scan_readings(lockin, stage, store, stop)
         try:
-            stage.close()
-        except Exception:   
-            pass
+            for i, pos, actual_pos, dt, dr in readings:
+                with phase("compute"):
+                    # Calculations (see Device_Drivers/scan_analysis.py), the delay is from the scan start until time zero is known
+                    values = normalize(dt, dr, T_ref)
+                    da, t_prct, r_prct, a_prct = values["dA_mV"], values["dT_pct"], values["dR_pct"], values["dA_pct"]
+                    delay_ps = position_to_delay_ps(pos, start_pos)
+                    row = {"target_mm": pos, "position_mm": actual_pos, "delay_ps": delay_ps, "dT_mV": dt, "dR_mV": dr, **values}
+                    if stats is not None:
+                        # spread of the individual passes around each averaged point
+                        row.update({"dT_std_mV": stats.std()[i, 1], "dR_std_mV": stats.std()[i, 2], "passes": stats.count[i]})
+
+                # Save this step to disk
+                with phase("persist"):
+                    store.append(row)
+                if on_step is not None:
+                    on_step(i, pos, actual_pos, dt, dr)
+
+                # Print results for each data collection step (Can remove if desired, for debugging)
+                print(f"Step {i}/{steps}:")
+                print(f"  Position: {pos} mm, Delay: {delay_ps:.2f} ps")
+                print(f"  dT = {dt:.3f} mV, dR = {dr:.3f} mV, dA = {da:.3f} mV")
+                print(f"  %T = {t_prct:.2f}, %R = {r_prct:.2f}, %A = {a_prct:.2f}")
+                if stop is not None and stop.is_set():
+                    break
+        finally:
+            readings.close()
+    finally:
+        print(format_summary(stop_trace()))
+
+
+# This function finds time zero of a measured scan and exports it. export_path overrides where the export goes
+# (.xlsx, .csv or .npz), and exports even when the scan settings didn't ask for it. Returns the scan folder.
+def finish_scan(store, export_path=None):
+    scan_dir = store.path
+    settings = store.metadata["settings"]
+
+    # Step 7: Time zero (fit of the rise of dT, see Device_Drivers/scan_analysis.py) & delays relative to it for excel
+    print(format_time_zero(reference_delays(store)))
+    store.close()
+    print(f"Scan saved to {scan_dir}")
+
+
+    # Step 8: Exporting results to Excel (optional, can also be done later with: python Device_Drivers/scan_store.py <scan folder> <file.xlsx>)
+    if export_path is not None or settings["export_excel"]:
+        export_path = Path(export_path or Path.home() / "Desktop" / "RTA_readings.xlsx")
+        # adaptive scans are measured out of order, so they get sorted by position
+        sort_by = "position_mm" if store.metadata["mode"] == "adaptive" else None
+        store = ScanStore(scan_dir, mode="r")
+        if export_path.suffix.lower() == ".csv":
+            store.export_csv(export_path, sort_by=sort_by)
+        elif export_path.suffix.lower() == ".npz":
+            store.export_npz(export_path, sort_by=sort_by)
+        else:
+            store.export_excel(export_path, sort_by=sort_by)
+        print(f"Results saved to {export_path}")
+    return scan_dir
+
+
+# This function runs a scan that has its folder (new from new_scan / create_scan, or one to resume) on connected
+# instruments, then finds time zero and exports the results. The instruments are left connected for the next scan
+# (see batch_runner.py). export_path is passed to finish_scan. Returns the scan folder.
+def run_scan(lockin, stage, store, export_path=None):
+    collect_scan(lockin, stage, store)
+    return finish_scan(store, export_path)
+
+
+# This function connects the lock-in and the stage (simulated with lab, or the ones of the instrument server at attach),
+# returns (lockin, stage, client) or raises ConnectionError. client is the InstrumentClient when attached, else None.
+def connect(lab=None, attach=None):
+    client = InstrumentClient(attach) if attach else None
+    lockin = client.instrument("lockin") if client else UHFLI(daq=lab.daq) if lab else UHFLI()
+    if not lockin.is_connected():
+        disconnect(lockin, None, client)
+        raise ConnectionError("Didn't connect to the UHFLI")
+    stage = client.instrument("stage") if client else NewPort_Delay_Stage_225(port=lab.stage.port) if lab else NewPort_Delay_Stage_225()
+    if not stage.is_connected():
+        disconnect(lockin, stage, client)
+        raise ConnectionError("Didn't connect to the NewPort Delay Stage")
+    return lockin, stage, client
+
+
+# This function closes both instruments and the server connection (attached, the instruments stay connected in the
+# server), ignoring errors (they may already be gone).
+def disconnect(lockin, stage, client=None):
+    for device, close in ((stage, "close"), (lockin, "disconnect"), (client, "close")):
+        if device is None:
+            continue
         try:
-            lockin.disconnect()
+            getattr(device, close)()
         except Exception:
             pass
+
+
+# This function gives the scan folder to measure: the one to resume (its references come from the folder), or a new
+# one from new_scan (quick_sweep as there). None when there is nothing to scan.
+def open_scan(lockin, stage, resume=None, quick_sweep=True):
+    if not resume:
+        return new_scan(lockin, stage, quick_sweep)
+    # Resume: the plan, settings and references come from the scan folder, finished steps are not measured again
+    store = ScanStore(resume)
+    print(f"Resuming scan {store.path} ({len(store)} steps already done)")
+    # the references are not measured again, so the baselines are switched on here
+    lockin.set_boxcar_baseline(1, 1)
+    lockin.set_boxcar_baseline(2, 1)
+    return store
+
+
+def main(resume=None, lab=None, attach=None):
+    # -------------------------------------------------------------------------------
+    # Step 0: Initialize devices
+    # The UHFLI class is the lock‑in amplifier, and NewPort_Delay_Stage_225 is the delay stage
+    # (lab is a simulators.SimulatedLab to run without the hardware, attach the address of a running
+    # instrument server, see Device_Drivers/instrument_server.py, whose instruments are used instead)
+    try:
+        lockin, stage, client = connect(lab, attach)
+    except ConnectionError as e:
+        print("Error:", e)
+        return
+    # -------------------------------------------------------------------------------
+
+    try:    #try here to ensure devices are closed properly even if an error occurs
+        # attached: other clients of the server wait from the reference measurement until the scan is done
+        with client.lock() if client else contextlib.nullcontext():
+            store = open_scan(lockin, stage, resume, quick_sweep=client is None)
+            if store is None:
+                return
+            run_scan(lockin, stage, store)
+
+    # Step 6: Disconnect devices
+    finally:    #make sure devices are closed properly (attached, the server keeps the instruments connected)
+        disconnect(lockin, stage, client)
         print("Devices disconnected.")
-    
-    
-    # Step 7: Peak detection & delay repositioning for excel 
-    peak_index = dT.index(max(dT, key = abs))
-    peak_position = positions[peak_index]
-    delays_ps = [((pos - peak_position) * 2 / 1000) / 3e8 * 1e12 for pos in positions] # Convert mm to m, then to seconds, then to picoseconds
-
-
-    # Step 8: Exporting results to Excel
-    desktop_path = Path.home() / "Desktop" / "RTA_readings.xlsx"
-    writer = pd.ExcelWriter(desktop_path, engine='xlsxwriter')
-
-    # Summary row with T_ref, NormT, NormR
-    pd.DataFrame([[T_ref, normT, normR]],columns=["Absolute Transmission", "NormT", "NormR"]).to_excel(writer, index=False, startrow=0, startcol=0)
-
-    # Full table of measured data
-    pd.DataFrame({
-        "Position [mm]": recorded_positions,
-        "Delay [ps]": delays_ps,
-        "dT [mV]": dT,
-        "dR [mV]": dR,
-        "dA [mV]": dA,
-        "dT [%]": dT_p,
-        "dR [%]": dR_p,
-        "dA [%]": dA_p
-    }).to_excel(writer, index=False, startrow=0, startcol=4)
-
-    writer.close()
-    print(f"Results saved to {desktop_path}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pump-probe delay scan with the UHFLI lock-in and the DL225 delay stage")
+    parser.add_argument("--resume", metavar="SCAN_FOLDER", help="carry on with an interrupted scan (a folder in Desktop/RTA_scans)")
+    parser.add_argument("--simulate", action="store_true", help="run against simulated instruments (Device_Drivers/simulators.py), no hardware needed")
+    parser.add_argument("--attach", nargs="?", const="localhost:6340", metavar="HOST:PORT",
+                        help="use the instruments of a running instrument server (python -m Device_Drivers.instrument_server)")
+    args = parser.parse_args()
     try:
-        main()
+        main(resume=args.resume, lab=SimulatedLab() if args.simulate and not args.attach else None, attach=args.attach)
     except KeyboardInterrupt:
         print("\nProgram stopped.")
 
@@ -1,10 +1,11 @@
 import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
-from Device_Drivers import UHFLI, NewPort_Delay_Stage_225
-import pandas as pd
-import numpy as np
-import time
+from Device_Drivers.live_view import LockinLiveView
+from Device_Drivers.simulators import SimulatedLab
+from lockinV1 import collect_scan, connect, disconnect, finish_scan, open_scan
+import argparse
+import contextlib
 import matplotlib.pyplot as plt
 
 """
@@ -42,11 +43,13 @@ This script performs the following steps:
 3. Collects Normalized Transmission (NormT) with the sample in.
 4. Collects Normalized Reflection (NormR).
 5. Optionally performs a quick sweep to find the overlap peak (If the user wants).
-6. Moves the stage to specified positions and collects data.
+6. Moves the stage to specified positions (or sweeps it continuously in fly scan mode) and collects data.
 7. Calculates delay in picoseconds based on the stage position.
 8. Exports the results to an Excel file on the Desktop.
 9. Disconnects the devices after data collection.
 
+If a scan is interrupted, run the script again with --resume <scan folder> to skip steps 1-5 and measure only the missing positions.
+
 """
 
 """
@@ -60,214 +63,62 @@ When running this script, look for errors within:
 - Make sure live plotting works as expected.
 """
 
-def main():
-    # -------------------------------------------------------------------------------
-    lockin = UHFLI()
-    if not lockin.is_connected():
-        print("Error: Didn't connect to the UHFLI")
-        return
-    stage = NewPort_Delay_Stage_225()
-    if not stage.is_connected():
-        print("Error: Didn't connect to the NewPort Delay Stage")
-        lockin.disconnect()
-        return
-    # -------------------------------------------------------------------------------
-
-    # Step 1: Reference Transmission (T_ref)
-    input("Press Enter to collect 100% transmission (no sample in)... ")
-    # Turn OFF boxcar‑1 baseline
-    lockin.set_boxcar_baseline(1, 0)
-    T_ref = lockin.average_boxcar_voltage(0)
-    print(f"T_ref = {T_ref:.3f} mV")
-
-    # Step 2: Normalized Transmission (NormT)
-    input("Insert sample & press Enter to collect NormT... ")
-    normT = lockin.average_boxcar_voltage(0)
-    print(f"NormT = {normT:.3f} mV")
-    # Turn ON boxcar‑1 baseline
-    lockin.set_boxcar_baseline(1, 1)
- 
-    # Step 3: Normalized Reflection (NormR)
-    input("Press Enter to collect NormR... ")
-    # Turn OFF boxcar‑2 baseline
-    lockin.set_boxcar_baseline(2, 0)
-    normR = lockin.average_boxcar_voltage(1)
-    print(f"NormR = {normR:.3f} mV")
-    # Turn ON boxcar‑2 baseline
-    lockin.set_boxcar_baseline(2, 1)
-  
+def main(resume=None, lab=None, attach=None):
     # -------------------------------------------------------------------------------
-    # Optional: Quick sweep to find overlap
-    if input("Quick sweep to find overlap? (y/n): ").strip().lower() == 'y':
-        start_pos = float(input("Enter stage START position in mm (e.g. 150.34): "))
-        end_pos   = float(input("Enter stage END position in mm (e.g. 160.67): "))
-        ss = float(input("Enter each step size in mm: "))
-        sweep_positions = stage.quick_sweep(start_pos, end_pos, ss)
-
-        max_voltage = float('-inf')
-        max_pos = None
-
-        for pos in sweep_positions:
-            voltage = lockin.read_boxcar_voltage(0)
-            print(f"Pos: {pos:.3f} mm, Voltage: {voltage:.3f} mV")
-            if voltage > max_voltage:
-                max_voltage = voltage
-                max_pos = pos
-
-        print(f"\nQuick sweep done >>> Overlap peak voltage found at {max_pos:.3f} mm: {max_voltage:.3f} mV")
-        stage.close()
-        lockin.disconnect()
-        print("Devices disconnected, exiting program.")
+    # Same devices, references, scan modes and scan folders as lockinV1.py (the scan code is shared from there),
+    # this script only adds the live plots
+    # (lab is a simulators.SimulatedLab to run without the hardware, attach the address of a running instrument server)
+    try:
+        lockin, stage, client = connect(lab, attach)
+    except ConnectionError as e:
+        print("Error:", e)
         return
     # -------------------------------------------------------------------------------
 
-    # Setup Live potting for dT
-    plt.ion()
-    fig1, ax_dT = plt.subplots(figsize=(8, 4))
-    line_dT, = ax_dT.plot([], [], 'o', label='dT (mV)')
-    ax_dT.set_xlabel('Step value')
-    ax_dT.set_ylabel('dT (mV)')
-    ax_dT.set_title('Live dT vs Step')
-    ax_dT.legend()
-    ax_dT.grid(True)
-
-    # Setup Live current position bar for move stage position (in mm)
-    fig2, ax_pos = plt.subplots(figsize=(8,2))
-    ax_pos.set_xlim(0, 225)
-    ax_pos.set_ylim(0, 1)
-    ax_pos.set_yticks([])
-    ax_pos.set_xlabel('Position (mm)')
-    ax_pos.set_ylabel('Current Position of stage')
-    major_positions = np.arange(0, 226, 25)
-    ax_pos.set_xticks(major_positions)
-    minor_positions = np.arange(0, 226, 5)
-    ax_pos.set_xticks(minor_positions, minor=True)
-    ax_pos.grid(which='minor', linestyle=':', linewidth=0.5)
-    bar = ax_pos.barh(y=0.5, width=0, left =0, height=0.3, color = 'red', edgecolor='black')
-    
-    
-
-    
-    # Step 4: Movement setup
-    while True:
-        start_pos = float(input("Enter stage START position in mm (e.g. 150.345): "))
-        end_pos   = float(input("Enter stage END position in mm (e.g. 160.675): "))
-        confirm = input(f"Start and End Positions Correct (y/n)?\n"f">>> START: {start_pos} >>> END: {end_pos}\n").strip().lower()
-        if confirm == 'y':
-            break
-
-    steps = int(input("Enter number of steps: "))
-    if steps < 2:
-        print("Number of steps should be at least 2")
-        return
-    step_size = (end_pos - start_pos) / (steps - 1)
-    positions = [round(start_pos + i * step_size, 2) for i in range(steps)]
-
-    print(f"Step size: {step_size:.3f} mm")
-    print(f"Positions: {positions}")
-
-    
-    # Setup storage arrays
-    dT, dR, dA = [], [], []
-    dT_p, dR_p, dA_p = [], [], []
-    delays_ps = []
-    recorded_positions = []
-   
+    store = None
     try:
-        # Step 5: Data collection & math
-        for i, pos in enumerate(positions):
-            print(f"\nStep {i}/{steps}: Moving to {pos} mm")
-            stage.move_to(pos)
-            time.sleep(0.4)  # 400 ms delay for stage to settle
-
-            # Read raw voltages from boxcars
-            dt = lockin.read_boxcar_voltage(0)
-            dr = lockin.read_boxcar_voltage(1)
-
-            # Calculations (verify these formulas)
-            da = - (dt + dr)
-            t_prct = (dt / T_ref) * 100
-            r_prct = (dr / T_ref) * 100
-            a_prct =  (da / T_ref) * 100
-            rel_pos = pos - start_pos
-            delay_ps = (2 * rel_pos / 1000) / 3e8 * 1e12 # Convert mm to m, then to seconds, then to picoseconds)
-
-            # Append results to storage arrays
-            dT.append(dt)
-            dR.append(dr)
-            dA.append(da)
-            recorded_positions.append(pos)
-            dT_p.append(t_prct)
-            dR_p.append(r_prct)
-            dA_p.append(a_prct)
-            delays_ps.append(delay_ps)
+        # attached: other clients of the server wait from the reference measurement until the scan is done
+        with client.lock() if client else contextlib.nullcontext():
+            store = open_scan(lockin, stage, resume, quick_sweep=client is None)
+            if store is None:
+                return
+
+            # Live plots of dT and the stage position (see Device_Drivers/live_view.py): redrawn on this thread at most
+            # 10 times per second while the scan runs on its own thread, so a slow plot window can't hold up the stage or the lock-in
+            view = LockinLiveView(fps=10)
+            for dt in store.column("dT_mV"):
+                view.put("point", float(dt))
+
+            # Hand each saved step to the live plots (they redraw on the main thread)
+            def on_step(i, pos, actual_pos, dt, dr):
+                view.put("point", dt)
+                view.put("position", actual_pos)
+
+            # This runs the scan on the acquisition thread, stop is set when the scan is interrupted (Ctrl-C)
+            view.run(lambda stop: collect_scan(lockin, stage, store, on_step, stop))
 
-            # Print results for each data collection step (Can remove if desired, for debugging)
-            print(f"Step {i}/{steps}:")
-            print(f"  Position: {pos} mm, Delay: {delay_ps:.2f} ps")
-            print(f"  dT = {dt:.3f} mV, dR = {dr:.3f} mV, dA = {da:.3f} mV")
-            print(f"  %T = {t_prct:.2f}, %R = {r_prct:.2f}, %A = {a_prct:.2f}")
-
-        # -- Live plotting of dT and current position bar --
-            line_dT.set_xdata(range(len(dT)))
-            line_dT.set_ydata(dT)
-            ax_dT.relim()
-            ax_dT.autoscale_view()
-            fig1.canvas.draw()
-            bar[0].set_width(pos)
-            fig2.canvas.draw()
-            plt.pause(0.001)
-        # --------------------------------------------------
-
-    
     # Step 6: Disconnect devices
     finally:    #make sure devices are closed properly
-        try:
-            stage.close()
-        except Exception:   
-            pass
-        try:
-            lockin.disconnect()
-        except Exception:
-            pass
+        disconnect(lockin, stage, client)
         print("Devices disconnected.")
 
     # Turn off interactive plotting (the final plot will remain open)
+    view.finish()
     plt.ioff()
     plt.show()
-    
-    
-    # Step 7: Peak detection & delay repositioning for excel 
-    peak_index = dT.index(max(dT, key = abs))
-    peak_position = positions[peak_index]
-    delays_ps = [((pos - peak_position) * 2 / 1000) / 3e8 * 1e12 for pos in positions]
-
-
-    # Step 8: Exporting results to Excel
-    desktop_path = Path.home() / "Desktop" / "RTA_readings.xlsx"
-    writer = pd.ExcelWriter(desktop_path, engine='xlsxwriter')
-
-    # Summary row with T_ref, NormT, NormR
-    pd.DataFrame([[T_ref, normT, normR]],columns=["Absolute Transmission", "NormT", "NormR"]).to_excel(writer, index=False, startrow=0, startcol=0)
-
-    # Full table of measured data
-    pd.DataFrame({
-        "Position [mm]": recorded_positions,
-        "Delay [ps]": delays_ps,
-        "dT [mV]": dT,
-        "dR [mV]": dR,
-        "dA [mV]": dA,
-        "dT [%]": dT_p,
-        "dR [%]": dR_p,
-        "dA [%]": dA_p
-    }).to_excel(writer, index=False, startrow=0, startcol=4)
 
-    writer.close()
-    print(f"Results saved to {desktop_path}")
+    # Steps 7 and 8: time zero and the optional export, like lockinV1.py
+    finish_scan(store)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pump-probe delay scan with the UHFLI lock-in and the DL225 delay stage")
+    parser.add_argument("--resume", metavar="SCAN_FOLDER", help="carry on with an interrupted scan (a folder in Desktop/RTA_scans)")
+    parser.add_argument("--simulate", action="store_true", help="run against simulated instruments (Device_Drivers/simulators.py), no hardware needed")
+    parser.add_argument("--attach", nargs="?", const="localhost:6340", metavar="HOST:PORT",
+                        help="use the instruments of a running instrument server (python -m Device_Drivers.instrument_server)")
+    args = parser.parse_args()
     try:
-        main()
+        main(resume=args.resume, lab=SimulatedLab() if args.simulate and not args.attach else None, attach=args.attach)
     except KeyboardInterrupt:
         print("\nProgram stopped.")
 
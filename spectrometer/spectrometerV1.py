@@ -3,19 +3,118 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 from Device_Drivers import stellarnet_driver3 as sn
 from Device_Drivers import NewPort_Delay_Stage_225  
-import pandas as pd
+from Device_Drivers.instrument_worker import InstrumentWorker, acquire_ahead
+from Device_Drivers.live_view import SpectrumLiveView
+from Device_Drivers.scan_analysis import block_mean, position_to_delay_ps
+from Device_Drivers.scan_planner import AdaptivePlanner, serpentine_order, uniform_positions
+from Device_Drivers.scan_statistics import RunningStats
+from Device_Drivers.scan_store import ScanStore
+from Device_Drivers.scan_trace import format_summary, phase, start_trace, stop_trace
+from Device_Drivers.simulators import SimulatedLab
+from Device_Drivers.spectrum_acquisition import burst_spectrum, enable_burst, read_burst, spectrum_counts
+from Device_Drivers.spectrum_calibration import CalibrationCache, SpectrumCalibration
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+import argparse
 import numpy as np
+import time
 
-# inputs for Spectrometer
-def main():
+# Most points (delay, wavelength) drawn in the final 3D surface, bigger scans are averaged down to this
+SURFACE_SIZE = (150, 200)
+
+# This function converts a stage position (mm) to the delay time (ps), two-way (see Device_Drivers/scan_analysis.py)
+def delay_ps(pos):
+    return round(float(position_to_delay_ps(pos)), 5)
+
+
+# This function takes the spectrum at the current stage position as a (frames x pixels) array:
+# a single driver reading (averaged by the driver), or burst_frames frames read through the FIFO.
+def take_frames(spec, wav, burst_frames):
+    with phase("read", instrument="spectrometer"):
+        if burst_frames:
+            return read_burst(sn, spec, burst_frames, len(wav))
+        return spectrum_counts(sn.array_spectrum(spec, wav))[None, :]
+
+
+# This function moves to each position and yields (step, position, measured position, frames).
+# Step scans run the stage and the spectrometer on their own worker threads one step ahead, so calibrating, printing
+# and saving a spectrum overlaps with the move to (and the reading at) the next position.
+# Adaptive scans go one position at a time, the planner needs each result to pick the next position.
+def scan_frames(stage, spec, wav, burst_frames, positions, planner=None, start=0):
+    if planner is not None:
+        for i, pos in enumerate(planner, start):
+            print(f"\nMoving to {pos} mm ({i+1}/{planner.budget})")
+            yield i, pos, stage.move_to(pos), take_frames(spec, wav, burst_frames)
+        return
+
+    stage_worker = InstrumentWorker(stage, "stage")
+    spec_worker = InstrumentWorker(sn, "spectrometer")
+
+    # the consumer loop prints each step once it is measured, moves are queued a step ahead and stay quiet
+    move = lambda pos: stage_worker.submit("move_to", pos)
+    steps = acquire_ahead(positions[start:], move, {"frames": lambda: spec_worker.submit(take_frames, spec, wav, burst_frames)})
+    try:
+        for i, (pos, actual_pos, readings) in enumerate(steps, start):
+            yield i, pos, actual_pos, readings["frames"]
+    finally:
+        steps.close()
+        stage_worker.close()
+        spec_worker.close()
+
+
+# This function reads the hot pixel list stored in the spectrometer (an empty list if the device has none or can't say).
+def hot_pixels(spec):
+    try:
+        return [int(p) for p in np.ravel(sn.getDeviceHotPixels(spec)) if int(p) > 0]
+    except Exception as e:
+        print("Could not read the hot pixels:", e)
+        return []
+
+
+# This function gives the dark or reference spectrum (raw counts) for the current settings:
+# the cached one if the user wants to keep it, otherwise a new one that replaces it in the cache.
+# With a simulated lab the beams are blocked for you.
+def calibration_spectrum(cache, kind, key, prompt, spec, wav, burst_frames, lab=None):
+    cached = cache.load(kind, key)
+    if cached is not None and input(f"Use the cached {kind} spectrum for these settings? (y/n): ").strip().lower() == 'y':
+        return cached
+    input(prompt)
+    if lab is not None:
+        lab.block(probe=kind == "dark", pump=kind == "reference")
+    spectrum = take_frames(spec, wav, burst_frames).mean(axis=0)
+    if lab is not None:
+        lab.block()
+    cache.save(kind, key, spectrum)
+    return spectrum
+
+
+# This function gives the signal the adaptive planner follows for a stored step: the mean |dT/T| with a reference spectrum,
+# otherwise the mean absolute change from the first spectrum (the baseline before time zero).
+def planner_signal(store, index, calibrate):
+    if calibrate:
+        return float(np.nanmean(np.abs(store.column("dT_T")[index])))
+    spectra = store.column("spectrum")
+    return float(np.mean(np.abs(spectra[index] - spectra[0])))
+
+
+# This function asks for the spectrometer and stage settings of a new scan.
+# They are saved in the scan folder, so an interrupted scan can be resumed with --resume.
+def new_scan_settings():
+    # inputs for Spectrometer
     try:
         integration_time = int(input("Enter integration time (ms): "))
         scans_avg = int(input("Enter number of scans to average: "))
         Digitizer_CRS = int(input("Enter digitizer clock rate (e.g., 3): "))
         smooth = int(input("Enter optical smoothing level (0 = none): "))
         spec_channel = int(input("Enter spectral channel (0/1 = default): "))
+        # Burst mode: frames are read through the spectrometer FIFO and averaged here, which also gives the noise per pixel
+        burst_frames = int(input("Enter burst frames per position (0 = off, the driver averages the scans): ") or 0)
+
+        # Calibration: hot pixels are always interpolated, the wavelength range and binning shrink the stored spectra
+        roi_text = input("Enter the wavelength range to keep in nm, e.g. 450-750 (blank = all): ").strip()
+        roi = [float(value) for value in roi_text.split("-")] if roi_text else None
+        binning = int(input("Enter pixel binning (1 = none): ") or 1)
+        calibrate = input("Subtract a dark spectrum and compute dT/T against a reference spectrum? (y/n): ").strip().lower() == 'y'
 
         # Inputs for Stage
         start_pos = float(input("Enter stage START position (mm): "))
@@ -24,18 +123,59 @@ def main():
 
         if num_steps < 2:
             raise ValueError("Number of steps must be at least 2.")
+
+        # Adaptive scan: the steps above are a coarse pass, then extra points go where the spectra change the most
+        adaptive = input("Adaptive scan (extra points around time zero and fast dynamics)? (y/n): ").strip().lower() == 'y'
+        budget = int(input(f"Enter the total number of points (the {num_steps} steps above are the coarse pass): ")) if adaptive else num_steps
+
+        # Repeated passes: back-and-forth over the same positions, averaged per point
+        passes = 1 if adaptive else int(input("Enter number of passes (1 = single scan, more = back-and-forth repeats averaged per point): ") or 1)
+        backlash = float(input("Enter backlash compensation in mm for direction reversals (0 = none): ") or 0) if passes > 1 else 0.0
+
+        export = input("Export the scan to the Desktop when it finishes? (n = no, csv, npz = NumPy binary, xlsx = Excel): ").strip().lower() or "n"
+        if export not in ("n", "csv", "npz", "xlsx"):
+            raise ValueError(f"unknown export format {export}")
     
     except ValueError as ve:
         print("Invalid input:", ve)
         sys.exit()
 
     # Calculate Stage Positions
-    step_size = (stop_pos - start_pos) / (num_steps - 1)
-    positions = [round(start_pos + i * step_size, 3) for i in range(num_steps)]
+    positions = uniform_positions(start_pos, stop_pos, num_steps, decimals=3)
+
+    return {
+        "script": Path(__file__).name,
+        "integration_time_ms": integration_time, "scans_avg": scans_avg, "smooth": smooth, "xtiming": Digitizer_CRS,
+        "channel": spec_channel, "burst_frames": burst_frames,
+        "roi_nm": roi, "binning": binning, "calibrate": calibrate,
+        "start_mm": start_pos, "stop_mm": stop_pos, "steps": num_steps,
+        "mode": "adaptive" if adaptive else "serpentine" if passes > 1 else "step",
+        "positions": positions,
+        "settings": {"budget": budget, "passes": passes, "backlash": backlash, "export": export},
+    }
+
 
-    # Convert Positions to Delay Times (in ps)
-    # Correct (one‐way mechanical to time in ps):
-    delay_times_ps = [round((2*pos/1000)  / 3e8 * 1e12, 5) for pos in positions] # Multiply pos by 2 for two way if this is the case
+def main(resume=None, lab=None, preview_bin=1):
+    global sn
+    if lab is not None:
+        sn = lab.stellarnet         # simulators.SimulatedLab, to run without the hardware
+    if sn is None:
+        print("Error: the StellarNet driver is not available for this platform/Python (--simulate runs without it)")
+        return
+    # Resume: the settings and the plan come from the scan folder, finished steps are not measured again
+    store = ScanStore(resume) if resume else None
+    metadata = store.metadata if resume else new_scan_settings()
+    integration_time, scans_avg = metadata["integration_time_ms"], metadata["scans_avg"]
+    smooth, Digitizer_CRS, spec_channel = metadata["smooth"], metadata["xtiming"], metadata["channel"]
+    burst_frames = metadata["burst_frames"]
+    roi, binning, calibrate = metadata["roi_nm"], metadata["binning"], metadata["calibrate"]
+    start_pos, stop_pos, num_steps = metadata["start_mm"], metadata["stop_mm"], metadata["steps"]
+    positions = metadata["positions"]
+    adaptive = metadata["mode"] == "adaptive"
+    budget, passes, backlash = metadata["settings"]["budget"], metadata["settings"]["passes"], metadata["settings"]["backlash"]
+    export = metadata["settings"]["export"]
+    if resume:
+        print(f"Resuming scan {store.path} ({len(store)} steps already done)")
 
     print(f"Stage positions: {positions}")
 
@@ -49,83 +189,215 @@ def main():
         print("Connected to Spectrometer:", device_id)
 
         # Set spectrometer parameters
-        sn.setParam(spec, integration_time, scans_avg, smooth, Digitizer_CRS, clear=True)
+        # (in burst mode every frame is a single scan, the frames are averaged here instead)
+        sn.setParam(spec, integration_time, 1 if burst_frames else scans_avg, smooth, Digitizer_CRS, clear=True)
+        if burst_frames:
+            enable_burst(sn, spec)
+            print(f"Burst mode: {burst_frames} frames per position")
+
+        # Calibration (see Device_Drivers/spectrum_calibration.py), dark and reference are cached per setting
+        calibration = SpectrumCalibration(wav, hot_pixels(spec), roi, binning)
+        wavelengths = calibration.wavelengths
+        print(f"Keeping {len(wavelengths)} of {len(np.ravel(wav))} pixels ({wavelengths[0]:.1f}-{wavelengths[-1]:.1f} nm), "
+              f"{len(calibration.hot_pixels)} hot pixels interpolated")
+        if calibrate:
+            if store is not None:
+                dark, reference = store.load_array("dark"), store.load_array("reference")
+            else:
+                cache = CalibrationCache(Path.home() / "Desktop" / "Spectrometer_scans" / "calibration")
+                key = {"device": device_id, "int": integration_time, "avg": burst_frames or scans_avg, "smooth": smooth, "xt": Digitizer_CRS}
+                dark = calibration_spectrum(cache, "dark", key, "Block the probe beam & press Enter to take the dark spectrum... ", spec, wav, burst_frames, lab)
+                reference = calibration_spectrum(cache, "reference", key, "Unblock the probe, block the pump & press Enter to take the reference spectrum... ", spec, wav, burst_frames, lab)
+            calibration.set_dark(dark)
+            calibration.set_reference(reference)
 
         # delay stage
-        stage = NewPort_Delay_Stage_225()
-        print(f"Stage initialized on port {stage.ser.port}. Beginning scan")
+        stage = NewPort_Delay_Stage_225(port=lab.stage.port) if lab else NewPort_Delay_Stage_225()
+        print(f"Stage initialized on port {stage.ser.port}. Predicted stage motion time: {stage.predict_scan_time(positions):.1f} s")
+        print("Beginning scan")
 
-        spectra = []
-        actual_positions = []
+        # Setup storage: every spectrum is written to disk as soon as it is measured (see Device_Drivers/scan_store.py)
+        # The spectra form a preallocated (steps x pixels) float32 cube, the wavelength axis is stored once
+        # (calibrated spectra: hot pixels interpolated, dark subtracted, only the kept range, binned)
+        if store is None:
+            scan_dir = Path.home() / "Desktop" / "Spectrometer_scans" / time.strftime("scan_%Y%m%d_%H%M%S")
+            columns = {"target_mm": "f8", "position_mm": "f8", "delay_ps": "f8", "spectrum": ("f4", len(wavelengths))}
+            headers = {"position_mm": "Stage Position (mm)", "delay_ps": "Delay Time (ps)", "spectrum": [f"{w:.2f} nm" for w in wavelengths]}
+            if burst_frames:
+                # noise per pixel (standard deviation of the frames) and the number of frames behind each point
+                columns.update({"spectrum_std": ("f4", len(wavelengths)), "frames": "i4"})
+            if calibrate:
+                columns["dT_T"] = ("f4", len(wavelengths))
+                headers["dT_T"] = [f"dT/T {w:.2f} nm" for w in wavelengths]
+            store = ScanStore.create(scan_dir, columns, capacity=budget, metadata=dict(
+                metadata, device_id=str(device_id), headers=headers, calibration=calibration.settings()))
+            store.save_array("wavelengths", wavelengths)
+            if calibrate:
+                store.save_array("dark", dark)
+                store.save_array("reference", reference)
+            print(f"Saving scan to {scan_dir}")
+        scan_dir = store.path
+        done = len(store)
+        # timing of every command, move, reading and step goes to trace.jsonl next to the data (see Device_Drivers/scan_trace.py)
+        start_trace(scan_dir / "trace.jsonl")
+        
+        planner = AdaptivePlanner(start_pos, stop_pos, num_steps, budget, decimals=3) if adaptive else None
+        if adaptive:
+            # replay the finished steps so the planner picks up where it stopped
+            for index, pos in enumerate(store.column("target_mm")):
+                planner.add(float(pos), planner_signal(store, index, calibrate))
         
+        # Live delay x wavelength image (see Device_Drivers/live_view.py): filled in one row per step, redrawn on this
+        # thread a few times per second while the scan runs on its own thread, so plotting never holds up the stage or the spectrometer
+        view = SpectrumLiveView(wavelengths, (delay_ps(start_pos), delay_ps(stop_pos)), budget if adaptive else len(positions),
+                                "dT/T" if calibrate else "Counts", preview_bin=preview_bin)
+        shown = "dT_T" if calibrate else "spectrum"
+        for index in range(done):
+            view.put("row", float(store.column("delay_ps")[index]), store.column(shown)[index])
+
+        # This runs on the acquisition thread, stop is set when the scan is interrupted (Ctrl-C)
+        def acquisition(stop):
+            if passes > 1:
+                # every other pass runs backwards, spectra are averaged per position online (nothing is kept per pass)
+                # the averages are saved after every pass so a resumed scan only redoes the interrupted pass
+                stats_file = scan_dir / "pass_stats.npz"
+                stats = RunningStats.load(stats_file) if stats_file.exists() else RunningStats(len(positions), len(wavelengths) + 1)
+                forward = 1 if positions[-1] >= positions[0] else -1
+                current_pass = None
+                for scan_pass, index, pos in serpentine_order(positions, passes, first_pass=int(stats.count.min())):
+                    if stop.is_set():
+                        return
+                    reversing = scan_pass != current_pass and scan_pass > 0
+                    if scan_pass != current_pass and current_pass is not None:
+                        stats.save(stats_file)
+                    current_pass = scan_pass
+                    direction = forward if scan_pass % 2 == 0 else -forward
+                    print(f"\nPass {scan_pass + 1}/{passes}: moving to {pos} mm")
+                    actual_pos = stage.approach(pos, direction, backlash) if reversing else stage.move_to(pos)
+                    frames = take_frames(spec, wav, burst_frames)
+                    with phase("compute"):
+                        frames = calibration.correct(frames)
+                        stats.add_many(index, np.column_stack([np.full(len(frames), actual_pos), frames]))
+                    # the live image shows the running average of the passes so far
+                    mean = stats.mean[index, 1:]
+                    view.put("row", delay_ps(pos), calibration.delta_t(mean) if calibrate else mean.copy())
+                if current_pass is not None:
+                    stats.save(stats_file)
+                for index, pos in enumerate(positions[done:], done):
+                    row = {"target_mm": pos, "position_mm": stats.mean[index, 0], "delay_ps": delay_ps(pos), "spectrum": stats.mean[index, 1:]}
+                    if burst_frames:
+                        row.update({"spectrum_std": stats.std()[index, 1:], "frames": stats.count[index]})
+                    if calibrate:
+                        row["dT_T"] = calibration.delta_t(stats.mean[index, 1:])
+                    with phase("persist"):
+                        store.append(row)
+                return
+
+            steps = scan_frames(stage, spec, wav, burst_frames, positions, planner, done)
+            try:
+                for i, pos, actual_pos, frames in steps:
+                    print(f"Step {i+1}/{budget} at {actual_pos:.4f} mm")
+                    with phase("compute"):
+                        result = burst_spectrum(calibration.correct(frames))
+                        spectrum = result["mean"]
+                        row = {"target_mm": pos, "position_mm": actual_pos, "delay_ps": delay_ps(pos), "spectrum": spectrum}
+                        if burst_frames:
+                            row.update({"spectrum_std": result["std"], "frames": result["frames"]})
+                        if calibrate:
+                            row["dT_T"] = calibration.delta_t(spectrum)
+                            peak = int(np.nanargmax(np.abs(row["dT_T"])))
+                    if burst_frames:
+                        print(f"{result['frames']} frames, median noise {np.median(result['std']):.1f} counts")
+                    if calibrate:
+                        print(f"dT/T: largest {row['dT_T'][peak]:.2e} at {wavelengths[peak]:.1f} nm")
+                    with phase("persist"):
+                        store.append(row)
+                    view.put("row", row["delay_ps"], row[shown])
+                    if adaptive:
+                        planner.add(pos, planner_signal(store, len(store) - 1, calibrate))
+                    if stop.is_set():
+                        break
+            finally:
+                steps.close()
+
         try:
-            for i, pos in enumerate(positions):
-                print(f"\nMoving to {pos} mm ({i+1}/{len(positions)})")
-                stage.move_to(pos)
-
-                print("Taking data readings")
-                spectrum = sn.array_spectrum(spec, wav)
-                spectra.append(spectrum)
-                actual_positions.append(pos)
+            view.run(acquisition)
         finally:
             #close devices
             sn.reset(spec)
             stage.close()
+            store.flush()
             print(" >>> Scan complete.")
+            print(f"Scan saved to {scan_dir}")
+            print(format_summary(stop_trace()))
+        view.finish()
+
+        # Adaptive scans are measured out of order, sort everything by position
+        order = np.argsort(store.column("target_mm"), kind="stable") if adaptive else slice(None)
+        positions = store.column("target_mm")[order]
+        delay_times_ps = store.column("delay_ps")[order]
 
         #plotting data on 2D and 3D plots
-        spectra_array = np.array(spectra)  # shape: (num_steps, num_wavelengths)
+        spectra_array = store.column("spectrum")[order]  # shape: (num_steps, num_wavelengths)
+        # with a reference spectrum the surface shows dT/T instead of counts
+        surface, surface_label = (store.column("dT_T")[order], "dT/T") if calibrate else (spectra_array, "Counts")
         fig = plt.figure(figsize=(14, 6))
 
         # 2D plot (left side)
         ax1 = fig.add_subplot(1, 2, 1)
         spectrum_idx = 0  # Change to another index to plot a different spectrum
-        ax1.plot(wav, spectra_array[spectrum_idx, :])
+        ax1.plot(wavelengths, spectra_array[spectrum_idx, :])
         ax1.set_title(f"2D: Spectrum at Step {spectrum_idx+1}")
         ax1.set_xlabel("Wavelength (nm)")
         ax1.set_ylabel("Amplitude (a.u.)")
         ax1.grid(True)
 
         # 3D subplot (right side)
+        # averaged down to at most SURFACE_SIZE points per axis: plot_surface slows down (and uses a lot of memory)
+        # with every extra point, and a screen can't show hundreds x thousands of them anyway
         ax2 = fig.add_subplot(1, 2, 2, projection='3d')
-        X, Y = np.meshgrid(delay_times_ps, wav) 
-        Z = spectra_array.T
+        Z = block_mean(block_mean(surface, SURFACE_SIZE[0], axis=0), SURFACE_SIZE[1], axis=1).T
+        X, Y = np.meshgrid(block_mean(delay_times_ps, SURFACE_SIZE[0]), block_mean(wavelengths, SURFACE_SIZE[1]))
 
-        surf = ax2.plot_surface(X, Y, Z, cmap='plasma', linewidth=0, antialiased=False)
-        ax2.set_title("3D Surface: Time vs Wavelength vs Counts")
+        surf = ax2.plot_surface(X, Y, Z, rcount=Z.shape[0], ccount=Z.shape[1], cmap='plasma', linewidth=0, antialiased=False)
+        ax2.set_title(f"3D Surface: Time vs Wavelength vs {surface_label}")
         ax2.set_xlabel("Time (ps)")
         ax2.set_ylabel("Wavelength (nm)")
-        ax2.set_zlabel("Counts")
+        ax2.set_zlabel(surface_label)
 
-        fig.colorbar(surf, ax=ax2, shrink=0.5, aspect=10, label="Counts")
+        fig.colorbar(surf, ax=ax2, shrink=0.5, aspect=10, label=surface_label)
 
         plt.tight_layout()
         plt.show()
 
-        #Save to excel
-        desktop_path = Path.home() / "Desktop" / "Spectrometer_readings.xlsx"
-
-        data_rows = []
-        for i, spectrum in enumerate(spectra):
-            row = [actual_positions[i], delay_times_ps[i]] + list(spectrum)
-            data_rows.append(row)
-
-        column_headers = ["Stage Position (mm)", "Delay Time (ps)"] + [f"{w:.2f} nm" for w in wav]
-        df = pd.DataFrame(data_rows, columns=column_headers)
+        #Export (optional, the scan folder already has everything: python Device_Drivers/scan_store.py <scan folder> <file>)
+        if export == "n":
+            return
+        desktop_path = Path.home() / "Desktop" / f"Spectrometer_readings.{export}"
+        sort_by = "target_mm" if adaptive else None
+        if export == "csv":
+            store.export_csv(desktop_path, sort_by=sort_by)
+        elif export == "npz":
+            store.export_npz(desktop_path, sort_by=sort_by)
+        else:
+            store.export_excel(desktop_path, sort_by=sort_by, sheet_name='Spectra Data')
 
-        with pd.ExcelWriter(desktop_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Spectra Data')
-
-        print("Data saved to Spectrometer_readings.xlsx on your Desktop.")
+        print(f"Data saved to {desktop_path.name} on your Desktop.")
 
     except Exception as e:
         print("Error during run:")
         print("Error:", e)
         sys.exit()
-    
-    if __name__ == "__main__":
-        try:
-            main()
-        except KeyboardInterrupt:
-            print("\nProgram stopped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pump-probe delay scan with the StellarNet spectrometer and the DL225 delay stage")
+    parser.add_argument("--resume", metavar="SCAN_FOLDER", help="carry on with an interrupted scan (a folder in Desktop/Spectrometer_scans)")
+    parser.add_argument("--simulate", action="store_true", help="run against simulated instruments (Device_Drivers/simulators.py), no hardware needed")
+    parser.add_argument("--preview-bin", type=int, default=1, metavar="N", help="average N neighbouring pixels in the live image (a coarser, quicker preview)")
+    args = parser.parse_args()
+    try:
+        main(resume=args.resume, lab=SimulatedLab() if args.simulate else None, preview_bin=args.preview_bin)
+    except KeyboardInterrupt:
+        print("\nProgram stopped.")
 